@@ -0,0 +1,210 @@
+# app/admin.py
+"""
+Результаты боёв из бота (только settings.ADMIN_IDS) — без Google Sheets на
+критическом пути:
+
+  /results              — бои без результата -> бой -> победитель / отмена -> подтвердить;
+  /close 12=1 13=2 14=0 — много боёв одной транзакцией (0 или void — отмена, ставки возвращаются).
+
+Закрытие пишет result_by, и sync_fights больше не перетирает статус/победителя
+из листа. Триггер fight_done будит settlement-воркер сразу, а сообщение с
+результатами правится на месте: сделки рассчитаны / выплаты отправлены по каждому бою.
+"""
+import asyncio
+import html
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple, Union
+
+from aiogram import Bot, F, Router
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from aiogram.types import BotCommand, BotCommandScopeChat, CallbackQuery, Message
+
+from .config import settings
+from . import db, metrics
+from .keyboards import kb_admin_confirm, kb_admin_fight, kb_admin_fights
+
+ADMIN_CLOSED = metrics.counter("admin_fights_closed_total", "Fights closed from the admin commands", ["result"])
+
+PROGRESS_EVERY_S = 2.0
+PROGRESS_MAX_S = 600.0
+# сильные ссылки на фоновые трекеры прогресса: цикл событий держит задачи слабо
+_trackers: Set["asyncio.Task[None]"] = set()
+
+USAGE = "Формат: <code>/close 12=1 13=2 14=0</code> — id боя = победитель (1, 2; 0 или void — отмена боя)"
+
+router = Router(name="admin")
+
+
+def _from_admin(event: Union[Message, CallbackQuery]) -> bool:
+    return event.from_user is not None and event.from_user.id in settings.ADMIN_IDS
+
+
+router.message.filter(_from_admin)
+router.callback_query.filter(_from_admin)
+
+
+def _winner_label(f: Mapping[str, Any], winner: Optional[int]) -> str:
+    if winner == 1:
+        return f"победил {html.escape(f['participant1_name'])}"
+    if winner == 2:
+        return f"победил {html.escape(f['participant2_name'])}"
+    return "бой отменён, ставки возвращаются"
+
+
+def parse_close_args(args: str) -> Tuple[List[Tuple[int, int]], List[str]]:
+    """«12=1 13=2 14=void» -> ([(12, 1), (13, 2), (14, 0)], нераспознанные куски)."""
+    results: Dict[int, int] = {}
+    bad: List[str] = []
+    for part in args.replace(",", " ").split():
+        fid, sep, w = part.partition("=")
+        w = w.strip().lower()
+        w = "0" if w == "void" else w
+        if not sep or not fid.strip().isdigit() or w not in ("0", "1", "2"):
+            bad.append(part)
+            continue
+        results[int(fid)] = int(w)
+    return list(results.items()), bad
+
+
+def progress_text(closed: List[Mapping[str, Any]], progress: Mapping[int, Mapping[str, Any]]) -> str:
+    lines = ["🏁 <b>Результаты записаны</b>"]
+    for f in closed:
+        p = progress.get(int(f["id"]))
+        head = f"<b>{html.escape(f['title'])}</b> — {_winner_label(f, f['winner_participant'])}"
+        if p is None:
+            lines.append(f"⏳ {head}")
+            continue
+        done = p["settled"] == p["deals"] and p["sent"] == p["payouts"]
+        lines.append(f"{'✅' if done else '⏳'} {head}\n"
+                     f"    сделки {p['settled']}/{p['deals']}, выплаты {p['sent']}/{p['payouts']}")
+    return "\n".join(lines)
+
+
+def _all_done(progress: Mapping[int, Mapping[str, Any]], ids: List[int]) -> bool:
+    return all(
+        (p := progress.get(fid)) is not None and p["settled"] == p["deals"] and p["sent"] == p["payouts"]
+        for fid in ids
+    )
+
+
+async def _track(msg: Message, closed: List[Mapping[str, Any]]) -> None:
+    """Правит одно сообщение со счётчиками, пока всё не рассчитано (или PROGRESS_MAX_S)."""
+    ids = [int(f["id"]) for f in closed]
+    deadline = asyncio.get_running_loop().time() + PROGRESS_MAX_S
+    last = msg.html_text
+    while True:
+        try:
+            progress = {int(r["fight_id"]): r for r in await db.settle_progress(ids)}
+        except Exception as e:
+            print(f"[ADMIN] progress query failed: {e!r}")
+            progress = {}
+        text = progress_text(closed, progress)
+        if text != last:
+            try:
+                await msg.edit_text(text)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    print(f"[ADMIN] progress edit failed: {e!r}")
+                    return
+            last = text
+        if _all_done(progress, ids) or asyncio.get_running_loop().time() > deadline:
+            return
+        await asyncio.sleep(PROGRESS_EVERY_S)
+
+
+async def _close(message: Message, results: List[Tuple[int, int]], admin_tg_id: int) -> None:
+    closed = await db.close_fights(results, admin_tg_id)
+    for f in closed:
+        ADMIN_CLOSED.inc(result="void" if f["winner_participant"] == 0 else "winner")
+    skipped = sorted({fid for fid, _ in results} - {int(f["id"]) for f in closed})
+    if not closed:
+        await message.answer("Ничего не закрыто: бои не найдены или результат уже выставлен.")
+        return
+    if skipped:
+        await message.answer("Пропущены (нет такого боя или результат уже есть): " + ", ".join(map(str, skipped)))
+    msg = await message.answer(progress_text(closed, {}))
+    task = asyncio.create_task(_track(msg, closed))
+    _trackers.add(task)
+    task.add_done_callback(_trackers.discard)
+
+
+# ===== /close: пачкой =====
+
+@router.message(Command("close"))
+async def cmd_close(m: Message, command: CommandObject):
+    results, bad = parse_close_args(command.args or "")
+    if bad or not results:
+        await m.answer((f"Не понял: {html.escape(' '.join(bad))}\n" if bad else "") + USAGE)
+        return
+    await _close(m, results, m.from_user.id)
+
+
+# ===== /results: по одному бою кнопками =====
+
+async def _edit(cq: CallbackQuery, text: str, markup: Any) -> None:
+    try:
+        await cq.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            await cq.message.answer(text, reply_markup=markup)
+
+
+@router.message(Command("results"))
+async def cmd_results(m: Message):
+    items = await db.list_unresolved()
+    if not items:
+        await m.answer("Все бои с результатом.")
+        return
+    await m.answer("Бои без результата:", reply_markup=kb_admin_fights(items))
+
+
+@router.callback_query(F.data == "adm_list")
+async def cb_list(cq: CallbackQuery):
+    items = await db.list_unresolved()
+    await _edit(cq, "Бои без результата:" if items else "Все бои с результатом.", kb_admin_fights(items))
+
+
+@router.callback_query(F.data.startswith("adm_fight:"))
+async def cb_fight(cq: CallbackQuery):
+    f = await db.get_fight(int(cq.data.split(":")[1]), stale_ok=False)
+    if not f:
+        return await cq.answer("Бой не найден", show_alert=True)
+    await _edit(cq, f"<b>{html.escape(f['title'])}</b>\n"
+                    f"{html.escape(f['participant1_name'])} vs {html.escape(f['participant2_name'])}\n\n"
+                    f"ID: {f['id']}, status={f['status']}\nКто победил?", kb_admin_fight(f))
+
+
+@router.callback_query(F.data.startswith("adm_set:"))
+async def cb_set(cq: CallbackQuery):
+    _, fid, w = cq.data.split(":")
+    f = await db.get_fight(int(fid), stale_ok=False)
+    if not f:
+        return await cq.answer("Бой не найден", show_alert=True)
+    await _edit(cq, f"<b>{html.escape(f['title'])}</b>: {_winner_label(f, int(w))}?\n"
+                    "Расчёт начнётся сразу, отменить нельзя.", kb_admin_confirm(int(fid), int(w)))
+
+
+@router.callback_query(F.data.startswith("adm_ok:"))
+async def cb_ok(cq: CallbackQuery):
+    _, fid, w = cq.data.split(":")
+    await cq.answer()
+    try:
+        await cq.message.delete()
+    except Exception:
+        pass
+    await _close(cq.message, [(int(fid), int(w))], cq.from_user.id)
+
+
+async def set_admin_commands(bot: Bot) -> None:
+    """Команды админки видны только в чатах админов."""
+    commands = [
+        BotCommand(command="start", description="Главное меню"),
+        BotCommand(command="results", description="Выставить результат боя"),
+        BotCommand(command="close", description="Закрыть бои пачкой: /close 12=1 13=2 14=0"),
+    ]
+    for aid in settings.ADMIN_IDS:
+        try:
+            await bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=aid))
+        except Exception as e:
+            # админ ещё не писал боту — чат не найден
+            print(f"[ADMIN] set_my_commands for {aid} failed: {e!r}")
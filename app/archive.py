@@ -0,0 +1,149 @@
+# app/archive.py
+"""
+Архив закрытых сделок: settled/void старше DEAL_ARCHIVE_AFTER_DAYS, у которых
+все payout отправлены, переезжают пачками в deal_archive (и их payout — в
+payout_archive) одним запросом на пачку: DELETE ... RETURNING -> INSERT.
+
+В deal остаются живые и недавние сделки — горячие экраны, матчинг и расчёт
+работают по маленькой куче и частичным индексам (deal_open_idx и др.), а не
+по всей истории. Архив секционирован по месяцу created_at; секции создаются
+здесь заранее, старые месяцы удаляются DROP TABLE секции без VACUUM.
+
+    python -m app.archive
+    python -m app.archive --watch --interval 3600
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+import asyncpg
+
+from .config import settings
+from . import db, metrics
+
+ARCHIVED = metrics.counter("deal_archived_total", "Deals moved to deal_archive")
+
+DEAL_COLS = (
+    "id, fight_id, user1_id, participant1, amount1_cents, paid1, invoice1_id, "
+    "user2_id, participant2, amount2_cents, paid2, invoice2_id, status, created_at"
+)
+PAYOUT_COLS = "id, deal_id, user_id, kind, amount_cents, fee_cents, status, batch_ref, created_at, sent_at"
+
+# самая старая кандидатская сделка и самый старый payout — с их месяца нужны секции
+# (у сделок до миграции created_at = время миграции, их payout бывают старше)
+SQL_OLDEST = """
+SELECT
+  (SELECT min(created_at) FROM deal WHERE status IN ('settled', 'void') AND created_at < $1) AS deal_min,
+  (SELECT min(created_at) FROM payout) AS payout_min
+"""
+
+# одна пачка: payout читаются из того же снимка, что и удаляемые сделки
+# (каскадное удаление payout срабатывает в конце запроса)
+SQL_ARCHIVE_BATCH = f"""
+WITH moved AS (
+  DELETE FROM deal
+  WHERE id IN (
+    SELECT d.id FROM deal d
+    WHERE d.status IN ('settled', 'void') AND d.created_at < $2
+      AND NOT EXISTS (SELECT 1 FROM payout p WHERE p.deal_id = d.id AND p.status <> 'sent')
+    ORDER BY d.id
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+  )
+  RETURNING {DEAL_COLS}
+), pays AS (
+  INSERT INTO payout_archive({PAYOUT_COLS})
+  SELECT {', '.join('p.' + c.strip() for c in PAYOUT_COLS.split(','))}
+  FROM payout p JOIN moved m ON m.id = p.deal_id
+)
+INSERT INTO deal_archive({DEAL_COLS})
+SELECT {DEAL_COLS} FROM moved
+"""
+
+
+def _month(ts: datetime) -> datetime:
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(ts: datetime) -> datetime:
+    return (_month(ts) + timedelta(days=32)).replace(day=1)
+
+
+async def ensure_partitions(conn: asyncpg.Connection, since: datetime, until: Optional[datetime] = None) -> List[str]:
+    """Месячные секции deal_archive / payout_archive от since до until (по умолчанию — следующий месяц)."""
+    until = until or _next_month(datetime.now(timezone.utc))
+    created: List[str] = []
+    m = _month(since.astimezone(timezone.utc))
+    while m <= until:
+        nxt = _next_month(m)
+        for table in ("deal_archive", "payout_archive"):
+            name = f"{table}_{m:%Y%m}"
+            exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name)
+            if not exists:
+                await conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{m.isoformat()}') TO ('{nxt.isoformat()}')"
+                )
+                created.append(name)
+        m = nxt
+    return created
+
+
+async def archive_once(
+    after_days: Optional[float] = None,
+    batch: Optional[int] = None,
+    max_batches: Optional[int] = None,
+) -> int:
+    """Переносит всё, что созрело для архива (или max_batches пачек). Возвращает число сделок."""
+    after_days = settings.DEAL_ARCHIVE_AFTER_DAYS if after_days is None else after_days
+    batch = batch or settings.DEAL_ARCHIVE_BATCH
+    cutoff = datetime.now(timezone.utc) - timedelta(days=after_days)
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(SQL_OLDEST, cutoff)
+        if row["deal_min"] is None:
+            return 0
+        # сверху хватит секций до текущего месяца: ни сделка, ни payout не создаются в будущем
+        created = await ensure_partitions(conn, min(t for t in row.values() if t is not None))
+        if created:
+            print(f"[ARCHIVE] partitions created: {', '.join(created)}")
+
+    moved = n = 0
+    while max_batches is None or n < max_batches:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                status = await conn.execute(SQL_ARCHIVE_BATCH, batch, cutoff)
+        done = int(status.split()[-1])
+        moved += done
+        n += 1
+        ARCHIVED.inc(done)
+        if done < batch:
+            break
+    return moved
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--after-days", type=float, default=None)
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--interval", type=int, default=3600)
+    args = parser.parse_args()
+
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                n = await archive_once(args.after_days)
+                print(f"[ARCHIVE] {n} deal(s) archived in {time.perf_counter() - t0:.1f}s")
+            except Exception as ex:
+                print(f"[ARCHIVE] ERROR: {ex!r}")
+            if not args.watch:
+                break
+            await asyncio.sleep(args.interval)
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
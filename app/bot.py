@@ -1,113 +1,123 @@
 # app/bot.py
 import asyncio
 import json
-from typing import List, Mapping, Any
+import time
+import uuid
+from typing import Dict, List, Mapping, Any, Optional, Tuple
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
-    InlineQuery, InlineQueryResultPhoto, InputMediaPhoto
+    InlineQuery,
 )
 
 from .config import settings
-from . import db
-from .payments import cryptopay
+from . import admin, db, leases, media, metrics, tracing
+from .instrumentation import HandlerMetricsMiddleware
+from .keyboards import (
+    kb_amounts, kb_pay_assets, kb_fight, kb_fights_list, kb_main, kb_open_deals, kb_open_empty,
+    kb_pay, kb_reply_link, kb_reply_one, kb_share_pick_chat,
+)
+from .payments import cryptopay, rates
+from .tg import get_bot
 
-bot = Bot(settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
+dp.include_router(admin.router)   # админские /results, /close — раньше общих хендлеров
+for _observer in (dp.message, dp.callback_query, dp.inline_query):
+    _observer.middleware(HandlerMetricsMiddleware())
 
-AMOUNTS_USDT = [1, 2, 4, 8, 16, 32, 64, 128, 256]
-
-# ===================== keyboards =====================
-def kb_main() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📅 События", callback_data="events")],
-        [InlineKeyboardButton(text="🎟 Текущие ставки", callback_data="mybets")],
-        [InlineKeyboardButton(text="📤 Поделиться ставкой", callback_data="share")],
-    ])
-
-def kb_fights_list(items: List[Mapping[str, Any]]) -> InlineKeyboardMarkup:
-    rows = []
-    for f in items[:]:
-        t = f"{f['participant1_name']} vs {f['participant2_name']}"
-        rows.append([InlineKeyboardButton(text=t, callback_data=f"fight:{f['id']}")])
-    rows.append([InlineKeyboardButton(text="⬅️ В меню", callback_data="back_main")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
-
-def kb_reply_link(deal_id: int, bot_username: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text="🤝 Ответить на ставку",
-            url=f"https://t.me/{bot_username}?start=reply_{deal_id}"
-        )]
-    ])
-
-def kb_fight(f: Mapping[str, Any]) -> InlineKeyboardMarkup:
-    p1 = f["participant1_name"]; p2 = f["participant2_name"]
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"Поставить на {p1}", callback_data=f"bet_side:{f['id']}:1")],
-        [InlineKeyboardButton(text=f"Поставить на {p2}", callback_data=f"bet_side:{f['id']}:2")],
-        [InlineKeyboardButton(text="📜 Открытые ставки", callback_data=f"open:{f['id']}")],
-        [InlineKeyboardButton(text="⬅️ К событиям", callback_data="events")],
-    ])
+def __getattr__(name: str) -> Any:
+    # app.bot.bot — как раньше, но Bot создаётся при первом обращении
+    if name == "bot":
+        return get_bot()
+    raise AttributeError(name)
 
-def kb_amounts(fid: int, side: int) -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
-    for i, amt in enumerate(AMOUNTS_USDT, start=1):
-        row.append(InlineKeyboardButton(text=f"{amt} USDT", callback_data=f"bet_amt:{fid}:{side}:{amt}"))
-        if i % 3 == 0:
-            rows.append(row); row = []
-    if row: rows.append(row)
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fid}")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
-
-def kb_open_deals(fight_id: int, deals: List[Mapping[str, Any]]) -> InlineKeyboardMarkup:
-    rows = []
-    for d in deals[:20]:
-        side = d["participant1"]; amt = d["amount1_cents"] / 100
-        rows.append([InlineKeyboardButton(
-            text=f"Ответить: {amt:.2f} USDT (на {'P2' if side==1 else 'P1'})",
-            callback_data=f"reply:{d['id']}"
-        )])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fight_id}")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
-
-def kb_pay(url: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💳 Оплатить в Mini App", url=url)],
-        [InlineKeyboardButton(text="⬅️ В меню", callback_data="back_main")],
-    ])
+PAYMENTS_PENDING = metrics.gauge("payments_pending_invoices", "invoice_wait rows awaiting payment")
 
-def kb_reply_one(deal_id: int, label: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=label, callback_data=f"reply:{deal_id}")],
-    ])
+# бой начался (DEAL_EXPIRE_AT_START) — новые ставки сразу истекли бы с возвратом
+BETS_CLOSED_TEXT = "Приём ставок на этот бой закрыт — он уже начался."
 
-def kb_share_pick_chat(deal_id: int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📤 Отправить другу", switch_inline_query=f"reply_{deal_id}")],
-        [InlineKeyboardButton(text="⬅️ В меню", callback_data="back_main")],
-    ])
+# один и тот же ответ на все нажатия, пока Crypto Pay недоступен (breaker open)
+PAYMENTS_DOWN_TEXT = "Оплата временно недоступна — платёжный сервис не отвечает. Попробуй через пару минут."
+PAYMENTS_FINALIZED = metrics.counter("payments_finalized_total", "Paid invoices turned into deals", ["kind", "source"])
+RENDERS = metrics.counter("bot_render_total", "Screen changes by Telegram call used", ["op"])
+INLINE_CACHE = metrics.counter("bot_inline_cache_total", "Inline share lookups by cache result", ["result"])
 
 # ===================== helpers =====================
 async def ensure_user(tg_user) -> Mapping[str, Any]:
     return await db.ensure_user_by_tg(tg_user.id, tg_user.username or tg_user.full_name)
 
-def fight_caption(f: Mapping[str, Any]) -> str:
+def pool_lines(f: Mapping[str, Any], pool: List[Mapping[str, Any]]) -> List[str]:
+    """Ликвидность по сторонам из db.get_fight_pool: «на P1: ждут ответа 3×8, 1×16 USDT; в игре 48.00 USDT»."""
+    unit = rates.unit()
+    lines = []
+    for side, name in ((1, f["participant1_name"]), (2, f["participant2_name"])):
+        rows = [p for p in pool if p["side"] == side]
+        waiting = ", ".join(f"{p['open_count']}×{p['amount_cents'] / 100:g}" for p in rows if p["open_count"] > 0)
+        matched = sum(int(p["matched_cents"]) for p in rows)
+        parts = []
+        if waiting: parts.append(f"ждут ответа {waiting} {unit}")
+        if matched: parts.append(f"в игре {matched / 100:.2f} {unit}")
+        if parts: lines.append(f"• на {name}: " + "; ".join(parts))
+    return lines
+
+def fight_caption(f: Mapping[str, Any], pool: Optional[List[Mapping[str, Any]]] = None) -> str:
     lines = [f"<b>{f['title']}</b>", f"{f['participant1_name']} vs {f['participant2_name']}"]
     if f.get("starts_at"): lines.append(f"Старт: {f['starts_at']}")
     if f.get("description"): lines += ["", f"{f['description']}"]
+    if not db.takes_bets(f): lines += ["", "⛔️ Приём ставок закрыт."]
+    market = pool_lines(f, pool or [])
+    if market: lines += ["", "📊 <b>Ставки</b>"] + market
     return "\n".join(lines)
 
-async def replace(cq: CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup):
+def _wait_until() -> str:
+    """Докуда открытая ставка ждёт оппонента (settlement_worker.SQL_EXPIRE_STALE)."""
+    parts = []
+    if settings.DEAL_EXPIRE_AT_START:
+        parts.append("до начала боя")
+    if settings.DEAL_EXPIRE_AFTER_H > 0:
+        parts.append(f"не дольше {settings.DEAL_EXPIRE_AFTER_H:g} ч")
+    return ", но ".join(parts) if parts else "до окончания боя"
+
+async def _payments_down(cq: CallbackQuery) -> None:
+    # алерт, а не новый экран: сообщение с кнопками сумм остаётся, можно нажать ещё раз
+    await cq.answer(PAYMENTS_DOWN_TEXT, show_alert=True)
+
+def _not_modified(e: TelegramBadRequest) -> bool:
+    return "message is not modified" in str(e)
+
+def _unchanged(msg: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> bool:
+    return msg.html_text == text and msg.reply_markup == reply_markup
+
+async def _delete_quietly(cq: CallbackQuery) -> None:
     try:
         await cq.message.delete()
     except Exception:
         pass
+
+async def replace(cq: CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup):
+    """
+    Текстовый экран вместо текущего: правим сообщение на месте (edit_text),
+    ничего не шлём, если экран тот же, и пересоздаём только если было фото.
+    """
+    msg = cq.message
+    if isinstance(msg, Message) and msg.text is not None:
+        if _unchanged(msg, text, reply_markup):
+            RENDERS.inc(op="skip")
+            return
+        try:
+            await msg.edit_text(text, reply_markup=reply_markup)
+            RENDERS.inc(op="edit_text")
+            return
+        except TelegramBadRequest as e:
+            if _not_modified(e):
+                RENDERS.inc(op="skip")
+                return
+    RENDERS.inc(op="resend")
+    await _delete_quietly(cq)
     await cq.message.answer(text, reply_markup=reply_markup)
 # === helpers (добавь рядом с show_main/replace) ===
 async def send_with_photo(target_msg_or_chat, photo_url: str, caption: str, reply_markup: InlineKeyboardMarkup):
@@ -116,25 +126,41 @@ async def send_with_photo(target_msg_or_chat, photo_url: str, caption: str, repl
     target_msg_or_chat: Message (для .answer_*) или сам Bot/ChatId — мы используем Message.
     """
     try:
-        await target_msg_or_chat.answer_photo(photo=photo_url, caption=caption, reply_markup=reply_markup)
+        await media.answer_photo(target_msg_or_chat, photo_url, caption, reply_markup)
     except Exception:
         # если вдруг фото битое — просто текстом
         await target_msg_or_chat.answer(caption, reply_markup=reply_markup)
 
-from aiogram.types import InputMediaPhoto, InlineKeyboardMarkup
-
 async def replace_with_photo(
     cq: CallbackQuery,
     photo_url: str,
     caption: str,
     reply_markup: InlineKeyboardMarkup | None = None
 ):
-    # безопасная замена: удаляем старое сообщение и отправляем новое фото
-    try:
-        await cq.message.delete()
-    except Exception:
-        pass
-    await cq.message.answer_photo(photo=photo_url, caption=caption, reply_markup=reply_markup)
+    """
+    Экран с фото: та же картинка — edit_caption (или ничего, если экран тот же),
+    другая — edit_media; текстовое сообщение удаляем и отправляем фото заново.
+    """
+    msg = cq.message
+    if isinstance(msg, Message) and msg.photo:
+        try:
+            if media.shows(msg, photo_url):
+                if _unchanged(msg, caption, reply_markup):
+                    RENDERS.inc(op="skip")
+                    return
+                await msg.edit_caption(caption=caption, reply_markup=reply_markup)
+                RENDERS.inc(op="edit_caption")
+            else:
+                await media.edit_photo(msg, photo_url, caption, reply_markup)
+                RENDERS.inc(op="edit_media")
+            return
+        except TelegramBadRequest as e:
+            if _not_modified(e):
+                RENDERS.inc(op="skip")
+                return
+    RENDERS.inc(op="resend")
+    await _delete_quietly(cq)
+    await media.answer_photo(cq.message, photo_url, caption, reply_markup)
 
 async def show_main(target_msg: Message):
     photo = getattr(settings, "MAIN_MENU_PHOTO_URL", None)
@@ -143,50 +169,70 @@ async def show_main(target_msg: Message):
     else:
         await target_msg.answer("Главное меню:", reply_markup=kb_main())
 
+async def finalize_paid_invoice(invoice_id: int, source: str) -> Optional[str]:
+    """
+    Оплаченный счёт -> NEW/MATCH сделка. Возвращает kind, "CREDITED" — сделки
+    нет (ставку уже сматчили), оплата осталась на балансе, или None, если счёт
+    уже обработан (нет записи в invoice_wait).
+    """
+    with tracing.span("finalize_paid_invoice", invoice_id=invoice_id, source=source) as sp:
+        res = await db.finalize_invoice(invoice_id)
+        if res is None:
+            return None
+        iw, deal_id = res
+        if iw["kind"] == "MATCH":
+            invalidate_inline(int(iw["deal_id"]))
+        outcome = iw["kind"] if deal_id is not None else "CREDITED"
+        sp.set(kind=outcome, deal_id=deal_id)
+        PAYMENTS_FINALIZED.inc(kind=outcome, source=source)
+        return outcome
+
 async def auto_check_and_finalize(cq: CallbackQuery, invoice_id: int):
     """
     30 сек, шаг 2 сек, опрашиваем CryptoPay. На paid — проводим NEW/MATCH и правим то же сообщение.
     Если не успели — показываем кнопки ручной проверки.
     """
-    for _ in range(15):  # ~30 сек
-        try:
-            invs = await cryptopay.get_invoices([invoice_id])
-            inv = next((x for x in invs if int(x.get("invoice_id", 0)) == invoice_id), None)
-        except Exception:
-            inv = None
-
-        if inv and inv.get("status") == "paid":
-            iw = await db.get_invoice_wait(invoice_id)
-            text = "Оплата уже обработана ✅."
-            if iw:
-                payload = json.loads(iw["payload"])
-                payer_tg = int(payload.get("tg_user_id"))
-                user = await db.ensure_user_by_tg(payer_tg, None)
-
-                if iw["kind"] == "NEW":
-                    await db.create_deal_after_paid(payload, invoice_id, user["id"])
-                    text = "✅ Оплата получена. Ставка активна и ждёт соперника."
-                elif iw["kind"] == "MATCH":
-                    await db.match_deal_after_paid(payload, invoice_id, user["id"])
-                    text = "✅ Оплата получена. Ставка сматчена!"
-
-                await db.del_invoice_wait(invoice_id)
-
+    with tracing.span("auto_check_and_finalize", invoice_id=invoice_id) as sp:
+        for attempt in range(15):  # ~30 сек
+            if not cryptopay.available():
+                await asyncio.sleep(2)
+                continue
             try:
-                if cq.message:
-                    await cq.message.edit_text(text, reply_markup=kb_main())
-                else:
-                    await bot.edit_message_caption(
-                        inline_message_id=cq.inline_message_id,
-                        caption=text,
-                        reply_markup=kb_main(),
-                        parse_mode=ParseMode.HTML
-                    )
+                invs = await cryptopay.get_invoices([invoice_id])
+                inv = next((x for x in invs if int(x.get("invoice_id", 0)) == invoice_id), None)
             except Exception:
-                pass
-            return
+                inv = None
 
-        await asyncio.sleep(2)
+            if inv and inv.get("status") == "paid":
+                sp.set(attempts=attempt + 1)
+                kind = await finalize_paid_invoice(invoice_id, "auto_check")
+                text = "Оплата уже обработана ✅."
+                if kind == "NEW":
+                    text = "✅ Оплата получена. Ставка активна и ждёт соперника."
+                elif kind == "MATCH":
+                    text = "✅ Оплата получена. Ставка сматчена!"
+                elif kind == "CREDITED":
+                    text = ("✅ Оплата получена, но ставка уже недоступна: её принял другой игрок "
+                            "или бой начался.\n"
+                            "Деньги на твоём балансе — их можно поставить снова или вывести.")
+
+                try:
+                    if cq.message:
+                        await cq.message.edit_text(text, reply_markup=kb_main())
+                    else:
+                        await get_bot().edit_message_caption(
+                            inline_message_id=cq.inline_message_id,
+                            caption=text,
+                            reply_markup=kb_main(),
+                            parse_mode=ParseMode.HTML
+                        )
+                except Exception:
+                    pass
+                return
+
+            await asyncio.sleep(2)
+
+        sp.set(timeout=True)
 
     # таймаут — оставить кнопки «Проверить оплату»
     rm = InlineKeyboardMarkup(inline_keyboard=[
@@ -197,7 +243,7 @@ async def auto_check_and_finalize(cq: CallbackQuery, invoice_id: int):
         if cq.message:
             await cq.message.edit_reply_markup(reply_markup=rm)
         else:
-            await bot.edit_message_reply_markup(inline_message_id=cq.inline_message_id, reply_markup=rm)
+            await get_bot().edit_message_reply_markup(inline_message_id=cq.inline_message_id, reply_markup=rm)
     except Exception:
         pass
 
@@ -225,11 +271,7 @@ async def start(m: Message):
         return
 
     u = await ensure_user(m.from_user)
-    d = await db.fetchrow("""
-        SELECT d.*, f.title, f.participant1_name p1, f.participant2_name p2, f.photo_url
-        FROM deal d JOIN fight f ON f.id=d.fight_id
-        WHERE d.id=$1
-    """, deal_id)
+    d = await db.get_deal_card(deal_id)
 
     if (not d) or (not d["paid1"]) or d["status"] != "awaiting_match":
         await m.answer("Эта ставка уже недоступна.", reply_markup=kb_main()); return
@@ -240,22 +282,21 @@ async def start(m: Message):
     need_side = 2 if d["participant1"] == 1 else 1
     amt = (d["amount1_cents"] or 0) / 100
     text = (f"<b>{d['title']}</b>\n{d['p1']} vs {d['p2']}\n\n"
-            f"Ставка друга: <b>{amt:.2f} USDT</b>\n"
+            f"Ставка друга: <b>{amt:.2f} {rates.unit()}</b>\n"
             f"Нужно поставить на: <b>{'P1' if need_side == 1 else 'P2'}</b>")
 
     if d.get("photo_url"):
-        await m.answer_photo(d["photo_url"], caption=text,
-                             reply_markup=kb_reply_one(deal_id, "🤝 Ответить на ставку"))
+        await media.answer_photo(m, d["photo_url"], text, kb_reply_one(deal_id, "🤝 Ответить на ставку"))
     else:
         await m.answer(text, reply_markup=kb_reply_one(deal_id, "🤝 Ответить на ставку"))
 
 @dp.callback_query(F.data == "back_main")
 async def back_main(cq: CallbackQuery):
-    try:
-        await cq.message.delete()
-    except Exception:
-        pass
-    await show_main(cq.message)   # покажет главное меню с обложкой
+    photo = getattr(settings, "MAIN_MENU_PHOTO_URL", None)
+    if photo:
+        await replace_with_photo(cq, photo, "Главное меню:", kb_main())   # главное меню с обложкой
+    else:
+        await replace(cq, "Главное меню:", kb_main())
 
 @dp.callback_query(F.data == "events")
 async def cb_events(cq: CallbackQuery):
@@ -283,127 +324,198 @@ async def cb_events(cq: CallbackQuery):
 async def cb_open(cq: CallbackQuery):
     fight_id = int(cq.data.split(":")[1])
     u = await ensure_user(cq.from_user)
-    deals = await db.list_open_deals(fight_id, exclude_user_id=u["id"])
+    async with db.acquire_read() as conn:
+        deals = await db.list_open_deals(fight_id, exclude_user_id=u["id"], conn=conn)
+        f = await db.get_fight(fight_id, conn=conn)
+        pool = await db.get_fight_pool(fight_id, conn=conn) if deals else []
     if not deals:
-        f = await db.get_fight(fight_id)
-        return await replace(cq, "Открытых ставок нет.\nСоздай свою:", InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"Поставить на {f['participant1_name']}", callback_data=f"bet_side:{fight_id}:1")],
-            [InlineKeyboardButton(text=f"Поставить на {f['participant2_name']}", callback_data=f"bet_side:{fight_id}:2")],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fight_id}")],
-        ]))
-    await replace(cq, "Открытые ставки:", kb_open_deals(fight_id, deals))
+        return await replace(cq, "Открытых ставок нет.\nСоздай свою:",
+                             kb_open_empty(fight_id, f["participant1_name"], f["participant2_name"]))
+    # в книге и свои ставки — кнопки ниже показывают только чужие
+    market = pool_lines(f, [p for p in pool if p["open_count"] > 0])
+    await replace(cq, "\n".join(["Открытые ставки:"] + market), kb_open_deals(fight_id, deals))
 
 @dp.callback_query(F.data.startswith("bet_side:"))
 async def cb_side(cq: CallbackQuery):
     _, fid, side = cq.data.split(":")
     await replace(cq, "Выбери сумму:", kb_amounts(int(fid), int(side)))
 
+async def _checkout(
+    cq: CallbackQuery,
+    u: Mapping[str, Any],
+    kind: str,
+    side: int,
+    amount_cents: int,
+    asset: str,
+    fight_id: Optional[int] = None,
+    deal_id: Optional[int] = None,
+) -> None:
+    """
+    Счёт в Crypto Pay на amount_cents расчётного актива, оплата в asset по
+    закешированному курсу (rates.quote), и авто-проверка оплаты на этой же карточке.
+    """
+    if not cryptopay.available():
+        return await _payments_down(cq)
+    if asset not in rates.assets():
+        # актив из callback_data: только CRYPTO_ASSETS (и расчётный) со свежим курсом
+        return await cq.answer(f"Оплата в {asset} недоступна — выбери другой актив.", show_alert=True)
+    try:
+        asset_amount, _ = rates.quote(amount_cents, asset)
+    except rates.RatesUnavailable:
+        return await cq.answer(f"Курс {asset} сейчас недоступен — выбери другой актив.", show_alert=True)
+    unit = rates.unit()
+    payload = {"kind": kind, "participant": side, "amount_cents": amount_cents, "tg_user_id": cq.from_user.id}
+    if kind == "NEW":
+        payload["fight_id"] = fight_id
+        attrs = {"fight_id": fight_id}
+    else:
+        payload["deal_id"] = deal_id
+        attrs = {"deal_id": deal_id}
+
+    with tracing.span("cb_amount" if kind == "NEW" else "cb_reply",
+                      participant=side, amount_cents=amount_cents, asset=asset, **attrs) as sp:
+        try:
+            inv = await cryptopay.create_invoice(
+                amount_cents=amount_cents,
+                asset=asset,
+                payload=json.dumps(payload),
+                expires_in=settings.INVOICE_TTL_S,
+                asset_amount=asset_amount if asset != unit else None,
+            )
+        except Exception as e:
+            sp.set(error=repr(e))
+            return await _payments_down(cq)
+        invoice_id = int(inv["invoice_id"])
+        sp.bind_invoice(invoice_id)
+        await db.add_invoice_wait(invoice_id, kind, u["id"], side, amount_cents,
+                                  fight_id=fight_id, deal_id=deal_id, ttl_s=settings.INVOICE_TTL_S,
+                                  asset=asset, asset_amount=asset_amount)
+
+    pay_url = inv.get("bot_invoice_url") or inv.get("pay_url") or inv.get("url")
+    stake = f"<b>{amount_cents / 100:.2f} {unit}</b>"
+    if asset != unit:
+        stake += f" (к оплате <b>{asset_amount} {asset}</b>)"
+    if kind == "NEW":
+        text = (f"Создан счёт на оплату: {stake}\n"
+                f"После оплаты ставка активируется и будет ждать оппонента {_wait_until()}; "
+                "без оппонента деньги вернутся на баланс.")
+    else:
+        text = f"Счёт на {stake} создан. После оплаты ставка будет сматчена."
+    # ВАЖНО: редактируем текущее сообщение (не delete+answer), чтобы авто-проверка могла его обновить
+    await cq.message.edit_text(text, reply_markup=kb_pay(pay_url))
+
+    # авто-проверка этой же карточки
+    asyncio.create_task(auto_check_and_finalize(cq, invoice_id))
+
 @dp.callback_query(F.data.startswith("bet_amt:"))
 async def cb_amount(cq: CallbackQuery):
     _, fid, side, amt = cq.data.split(":")
     fight_id, participant, amount = int(fid), int(side), int(amt)
-    await ensure_user(cq.from_user)
-
-    payload = {
-        "kind": "NEW",
-        "fight_id": fight_id,
-        "participant": participant,
-        "amount_cents": amount * 100,
-        "tg_user_id": cq.from_user.id,
-    }
-
-    inv = await cryptopay.create_invoice(
-        amount_cents=amount * 100,
-        asset=settings.CRYPTO_DEFAULT_ASSET,
-        payload=json.dumps(payload),
-    )
-    invoice_id = int(inv["invoice_id"])
-    await db.add_invoice_wait(invoice_id, "NEW", payload)
+    u = await ensure_user(cq.from_user)
+    unit = rates.unit()
+    if not await db.fight_takes_bets(fight_id):
+        return await cq.answer(BETS_CLOSED_TEXT, show_alert=True)
+
+    # хватает баланса (выигрыши/возвраты) — ставим сразу, без счёта в Crypto Pay
+    if await db.get_balance(u["id"]) >= amount * 100:
+        if await db.create_deal_after_paid(fight_id, participant, amount * 100, None, u["id"]):
+            await cq.message.edit_text(
+                f"✅ Ставка <b>{amount} {unit}</b> оплачена с баланса и ждёт соперника.",
+                reply_markup=kb_main(),
+            )
+            return
 
-    pay_url = inv.get("bot_invoice_url") or inv.get("pay_url") or inv.get("url")
-    await cq.message.edit_text(
-        f"Создан счёт на оплату: <b>{amount} USDT</b>\n"
-        "После оплаты ставка активируется и будет ждать оппонента до окончания боя.",
-        reply_markup=kb_pay(pay_url)
-    )
+    assets = rates.assets()
+    if len(assets) > 1:
+        return await replace(cq, f"Ставка <b>{amount} {unit}</b>. Чем оплатить?",
+                             kb_pay_assets(f"bet_pay:{fid}:{side}:{amt}", tuple(assets), f"bet_side:{fid}:{side}"))
+    await _checkout(cq, u, "NEW", participant, amount * 100, unit, fight_id=fight_id)
 
-    # авто-проверка этой же карточки
-    asyncio.create_task(auto_check_and_finalize(cq, invoice_id))
+@dp.callback_query(F.data.startswith("bet_pay:"))
+async def cb_amount_asset(cq: CallbackQuery):
+    _, fid, side, amt, asset = cq.data.split(":")
+    u = await ensure_user(cq.from_user)
+    if not await db.fight_takes_bets(int(fid)):
+        return await cq.answer(BETS_CLOSED_TEXT, show_alert=True)
+    await _checkout(cq, u, "NEW", int(side), int(amt) * 100, asset, fight_id=int(fid))
 
 @dp.callback_query(F.data.startswith("fight:"))
 async def cb_fight(cq: CallbackQuery):
     fid = int(cq.data.split(":")[1])
-    f = await db.get_fight(fid)
+    async with db.acquire_read() as conn:
+        f = await db.get_fight(fid, conn=conn)
+        pool = await db.get_fight_pool(fid, conn=conn) if f else []
     if not f:
         await cq.answer("Событие не найдено", show_alert=True)
         return
 
-    # пробуем отредактировать фото, если исходное сообщение — фото
+    caption = fight_caption(f, pool)
+    markup = kb_fight(f, db.takes_bets(f))
     if f.get("photo_url"):
         try:
-            await cq.message.edit_media(
-                InputMediaPhoto(media=f["photo_url"], caption=fight_caption(f)),
-                reply_markup=kb_fight(f)
-            )
+            await replace_with_photo(cq, f["photo_url"], caption, markup)
             return
         except Exception:
-            # не получилось редактировать (или исходное сообщение не фото) — просто заменим
+            # картинка битая / недоступна — покажем бой текстом
             pass
 
-    await replace(cq, fight_caption(f), kb_fight(f))
+    await replace(cq, caption, markup)
+
+async def _reply_target(cq: CallbackQuery, deal_id: int, u: Mapping[str, Any]) -> Optional[Tuple[int, int]]:
+    """(сторона ответа, сумма) или None — ставка недоступна (алерт уже показан)."""
+    d = await db.get_deal_card(deal_id)
+    if not d or not d["paid1"] or d["status"] != "awaiting_match":
+        await cq.answer("Эта ставка уже недоступна.", show_alert=True)
+        return None
+    if d["user1_id"] == u["id"]:
+        await cq.answer("Нельзя отвечать на свою ставку.", show_alert=True)
+        return None
+    if not await db.fight_takes_bets(deal_id=deal_id):
+        await cq.answer(BETS_CLOSED_TEXT, show_alert=True)
+        return None
+    return (2 if d["participant1"] == 1 else 1), int(d["amount1_cents"])
 
 @dp.callback_query(F.data.startswith("reply:"))
 async def cb_reply(cq: CallbackQuery):
     deal_id = int(cq.data.split(":")[1])
     u = await ensure_user(cq.from_user)
-    d = await db.fetchrow("""SELECT d.*, f.participant1_name p1, f.participant2_name p2
-                               FROM deal d JOIN fight f ON f.id=d.fight_id
-                              WHERE d.id=$1""", deal_id)
-    if not d or not d["paid1"] or d["status"] != "awaiting_match":
-        return await cq.answer("Эта ставка уже недоступна.", show_alert=True)
-    if d["user1_id"] == u["id"]:
-        return await cq.answer("Нельзя отвечать на свою ставку.", show_alert=True)
-
-    resp_side = 2 if d["participant1"] == 1 else 1
-    amt_cents = int(d["amount1_cents"])
-    payload = {"kind": "MATCH", "deal_id": deal_id, "participant": resp_side,
-               "amount_cents": amt_cents, "tg_user_id": cq.from_user.id}
-
-    inv = await cryptopay.create_invoice(
-        amount_cents=amt_cents,
-        asset=settings.CRYPTO_DEFAULT_ASSET,
-        payload=json.dumps(payload)
-    )
-    invoice_id = int(inv["invoice_id"])
-    await db.add_invoice_wait(invoice_id, "MATCH", payload)
-    pay_url = inv.get("bot_invoice_url") or inv.get("pay_url") or inv.get("url")
+    target = await _reply_target(cq, deal_id, u)
+    if target is None:
+        return
+    resp_side, amt_cents = target
+    unit = rates.unit()
+
+    if await db.get_balance(u["id"]) >= amt_cents:
+        if await db.match_deal_after_paid(deal_id, resp_side, amt_cents, None, u["id"]):
+            invalidate_inline(deal_id)
+            await cq.message.edit_text(
+                f"✅ Ставка <b>{amt_cents / 100:.2f} {unit}</b> оплачена с баланса и сматчена!",
+                reply_markup=kb_main(),
+            )
+            return
 
-    # ВАЖНО: редактируем текущее сообщение (не delete+answer), чтобы авто-проверка могла его обновить
-    await cq.message.edit_text(
-        f"Счёт на <b>{amt_cents / 100:.2f} USDT</b> создан. После оплаты ставка будет сматчена.",
-        reply_markup=kb_pay(pay_url),
-    )
+    assets = rates.assets()
+    if len(assets) > 1:
+        return await replace(cq, f"Ответ на ставку: <b>{amt_cents / 100:.2f} {unit}</b>. Чем оплатить?",
+                             kb_pay_assets(f"reply_pay:{deal_id}", tuple(assets), "back_main"))
+    await _checkout(cq, u, "MATCH", resp_side, amt_cents, unit, deal_id=deal_id)
 
-    asyncio.create_task(auto_check_and_finalize(cq, invoice_id))
+@dp.callback_query(F.data.startswith("reply_pay:"))
+async def cb_reply_asset(cq: CallbackQuery):
+    _, did, asset = cq.data.split(":")
+    deal_id = int(did)
+    u = await ensure_user(cq.from_user)
+    target = await _reply_target(cq, deal_id, u)
+    if target is None:
+        return
+    resp_side, amt_cents = target
+    await _checkout(cq, u, "MATCH", resp_side, amt_cents, asset, deal_id=deal_id)
 
 @dp.callback_query(F.data == "mybets")
 async def cb_mybets(cq: CallbackQuery):
     u = await ensure_user(cq.from_user)
 
-    rows = await db.fetch("""
-        SELECT d.*,
-               f.title,
-               f.participant1_name AS p1,
-               f.participant2_name AS p2,
-               f.status AS fight_status
-        FROM deal d
-        JOIN fight f ON f.id = d.fight_id
-        WHERE (d.user1_id = $1 OR d.user2_id = $1)
-          AND f.status IN ('upcoming','today','live')
-          AND d.status IN ('awaiting_match','matched')
-        ORDER BY d.id DESC
-        LIMIT 100
-    """, u["id"])
+    rows = await db.list_my_active_deals(u["id"])
 
     if not rows:
         await replace(cq, "Сейчас у тебя нет актуальных ставок.", kb_main())
@@ -416,34 +528,62 @@ async def cb_mybets(cq: CallbackQuery):
         side_txt = "на 1-го" if side == 1 else "на 2-го"
         amt = (b["amount1_cents"] if who == "P1" else (b["amount2_cents"] or 0)) / 100
         status_human = "ждёт оппонента" if b["status"] == "awaiting_match" else "сматчена"
-        lines.append(f"• <b>{b['title']}</b> — {side_txt} — {amt:.2f} {settings.CRYPTO_DEFAULT_ASSET} — {status_human}")
+        lines.append(f"• <b>{b['title']}</b> — {side_txt} — {amt:.2f} {rates.unit()} — {status_human}")
 
     await replace(cq, "\n".join(lines), kb_main())
 
+@dp.callback_query(F.data == "balance")
+async def cb_balance(cq: CallbackQuery):
+    u = await ensure_user(cq.from_user)
+    bal = await db.get_balance(u["id"])
+    rows = []
+    if bal > 0:
+        rows.append([InlineKeyboardButton(text="📤 Вывести в CryptoBot", callback_data="withdraw")])
+    rows.append([InlineKeyboardButton(text="⬅️ В меню", callback_data="back_main")])
+    await replace(
+        cq,
+        f"💰 Баланс: <b>{bal / 100:.2f} {rates.unit()}</b>\n"
+        "Выигрыши и возвраты можно сразу ставить снова — без нового счёта.",
+        InlineKeyboardMarkup(inline_keyboard=rows),
+    )
+
+@dp.callback_query(F.data == "withdraw")
+async def cb_withdraw(cq: CallbackQuery):
+    u = await ensure_user(cq.from_user)
+    txn_ref = f"withdraw:{u['id']}:{uuid.uuid4().hex[:12]}"
+    cents = await db.reserve_withdrawal(u["id"], txn_ref)
+    if cents <= 0:
+        return await cq.answer("Выводить нечего.", show_alert=True)
+    try:
+        await cryptopay.transfer(
+            tg_user_id=cq.from_user.id,
+            amount_cents=cents,
+            asset=rates.unit(),
+            spend_id=txn_ref,
+        )
+    except cryptopay.CryptoPayError as e:
+        print(f"[withdraw] transfer fail user={u['id']}: {e!r}")
+        if e.transient:
+            # таймаут/5xx: перевод мог пройти — резерв остаётся, сверка (reconcile)
+            # повторит его с тем же spend_id или вернёт деньги при явном отказе
+            return await replace(cq, "⏳ Вывод обрабатывается — деньги придут в CryptoBot в ближайшее время.",
+                                 kb_main())
+        # Crypto Pay отказал окончательно (и перевода с этим spend_id нет) — деньги обратно на баланс
+        await db.cancel_withdrawal(u["id"], txn_ref, cents)
+        return await cq.answer("Не удалось вывести, попробуй позже.", show_alert=True)
+    except Exception as e:
+        # сеть/таймаут вне CryptoPayError — исход неизвестен, как и выше
+        print(f"[withdraw] transfer unknown user={u['id']}: {e!r}")
+        return await replace(cq, "⏳ Вывод обрабатывается — деньги придут в CryptoBot в ближайшее время.",
+                             kb_main())
+    await replace(cq, f"✅ Выведено <b>{cents / 100:.2f} {rates.unit()}</b> в CryptoBot.", kb_main())
+
 @dp.callback_query(F.data == "share")
 async def cb_share(cq: CallbackQuery):
     u = await ensure_user(cq.from_user)
 
-    sql = """
-    SELECT
-        d.id,
-        d.amount1_cents,
-        d.participant1,
-        f.title,
-        f.participant1_name AS p1,
-        f.participant2_name AS p2
-    FROM deal AS d
-    JOIN fight AS f ON f.id = d.fight_id
-    WHERE d.user1_id = $1
-      AND d.status = 'awaiting_match'
-      AND d.paid1 = TRUE
-      AND d.user2_id IS NULL
-    ORDER BY d.id DESC
-    LIMIT 20
-    """
-
     try:
-        rows = await db.fetch(sql, u["id"])
+        rows = await db.list_shareable_deals(u["id"])
     except Exception as e:
         # временный лог — если вдруг опять что-то с SQL
         await cq.answer(f"Ошибка выборки: {type(e).__name__}", show_alert=True)
@@ -459,7 +599,7 @@ async def cb_share(cq: CallbackQuery):
         fighter = r["p1"] if int(r["participant1"]) == 1 else r["p2"]
         kb_rows.append([
             InlineKeyboardButton(
-                text=f"📤 {fighter} • {amt:.2f} USDT",
+                text=f"📤 {fighter} • {amt:.2f} {rates.unit()}",
                 callback_data=f"sharedeal:{r['id']}"
             )
         ])
@@ -471,19 +611,7 @@ async def cb_share(cq: CallbackQuery):
 async def cb_sharedeal(cq: CallbackQuery):
     deal_id = int(cq.data.split(":")[1])
 
-    # нормальный SQL без "..."
-    sql = """
-    SELECT
-        d.*,
-        f.title,
-        f.photo_url,
-        f.participant1_name AS p1,
-        f.participant2_name AS p2
-    FROM deal AS d
-    JOIN fight AS f ON f.id = d.fight_id
-    WHERE d.id = $1
-    """
-    d = await db.fetchrow(sql, deal_id)
+    d = await db.get_deal_card(deal_id)
 
     if (not d) or (not d["paid1"]) or d["status"] != "awaiting_match":
         await cq.answer("Эта ставка уже недоступна к пересылке.", show_alert=True)
@@ -499,84 +627,134 @@ async def cb_sharedeal(cq: CallbackQuery):
     else:
         await replace(cq, caption, markup)
 
+# ===================== inline share =====================
+_bot_username: Optional[str] = None
+
+async def bot_username() -> str:
+    """@username бота: один getMe на процесс (main() прогревает при старте)."""
+    global _bot_username
+    if _bot_username is None:
+        _bot_username = (await get_bot().me()).username
+    return _bot_username
+
+# deal_id -> (истекает, готовая карточка); «ставка недоступна» не кешируем
+_inline_cache: Dict[int, Tuple[float, Any]] = {}
+INLINE_CACHE_MAX = 10_000
+
+def invalidate_inline(deal_id: int) -> None:
+    _inline_cache.pop(deal_id, None)
+
+async def _inline_card(deal_id: int) -> Any:
+    now = time.monotonic()
+    hit = _inline_cache.get(deal_id)
+    if hit is not None and hit[0] > now:
+        INLINE_CACHE.inc(result="hit")
+        return hit[1]
+    INLINE_CACHE.inc(result="miss")
+
+    # карточка для пересылки — отставание реплики допустимо, /start всё равно перепроверит;
+    # но только что созданной ставки на реплике может ещё не быть — промах перечитываем с primary
+    d = await db.get_deal_card(deal_id, stale_ok=True)
+    if not (d and d["paid1"] and d["status"] == "awaiting_match"):
+        d = await db.get_deal_card(deal_id)
+    result = None
+    if d and d["paid1"] and d["status"] == "awaiting_match":
+        need_side   = 2 if d["participant1"] == 1 else 1
+        amt         = (d["amount1_cents"] or 0) / 100
+        picked_name = d["p1"] if d["participant1"] == 1 else d["p2"]
+
+        caption = (
+            f"<b>Ставка на {picked_name}</b>\n"
+            f"{d['p1']} vs {d['p2']}\n\n"
+            f"Сумма: <b>{amt:.2f} {rates.unit()}</b>\n"
+            f"Нужно поставить на: <b>{'P1' if need_side == 1 else 'P2'}</b>"
+        )
+        photo_url = d.get("photo_url") or "https://via.placeholder.com/800x500.png?text=Fight"
+
+        # по file_id, если картинку уже отправляли (без 'description' — у фото его нет)
+        result = await media.inline_photo(
+            str(deal_id), photo_url, caption, kb_reply_link(deal_id, await bot_username()),
+        )
+
+    if result is None:
+        return None
+    if len(_inline_cache) >= INLINE_CACHE_MAX:
+        for k in [k for k, v in _inline_cache.items() if v[0] <= now]:
+            del _inline_cache[k]
+        if len(_inline_cache) >= INLINE_CACHE_MAX:
+            _inline_cache.clear()
+    _inline_cache[deal_id] = (now + settings.INLINE_RESULT_TTL, result)
+    return result
+
 @dp.inline_query()
 async def inline_share(iq: InlineQuery):
     q = (iq.query or "").strip()
     if not q.startswith("reply_"):
-        return await bot.answer_inline_query(iq.id, [], cache_time=1, is_personal=True)
+        return await get_bot().answer_inline_query(iq.id, [], cache_time=1, is_personal=True)
 
     try:
         deal_id = int(q.split("_", 1)[1])
     except Exception:
-        return await bot.answer_inline_query(iq.id, [], cache_time=1, is_personal=True)
-
-    d = await db.fetchrow("""
-        SELECT d.*,
-               f.title,
-               f.participant1_name AS p1,
-               f.participant2_name AS p2,
-               f.photo_url
-        FROM deal d
-        JOIN fight f ON f.id = d.fight_id
-        WHERE d.id = $1
-    """, deal_id)
-    if not d or not d["paid1"] or d["status"] != "awaiting_match":
-        return await bot.answer_inline_query(iq.id, [], cache_time=1, is_personal=True)
+        return await get_bot().answer_inline_query(iq.id, [], cache_time=1, is_personal=True)
 
-    need_side   = 2 if d["participant1"] == 1 else 1
-    amt         = (d["amount1_cents"] or 0) / 100
-    picked_name = d["p1"] if d["participant1"] == 1 else d["p2"]
+    result = await _inline_card(deal_id)
+    if result is None:
+        return await get_bot().answer_inline_query(iq.id, [], cache_time=1, is_personal=True)
 
-    caption = (
-        f"<b>Ставка на {picked_name}</b>\n"
-        f"{d['p1']} vs {d['p2']}\n\n"
-        f"Сумма: <b>{amt:.2f} USDT</b>\n"
-        f"Нужно поставить на: <b>{'P1' if need_side == 1 else 'P2'}</b>"
-    )
-    photo_url = d.get("photo_url") or "https://via.placeholder.com/800x500.png?text=Fight"
-
-    # Важно: у InlineQueryResultPhoto НЕ используем поля 'description' (его нет).
-    result = InlineQueryResultPhoto(
-        id=str(deal_id),
-        photo_url=photo_url,
-        thumbnail_url=photo_url,
-        caption=caption,
-        parse_mode=ParseMode.HTML,
-        reply_markup=kb_reply_link(deal_id, (await bot.me()).username),
-    )
-    await bot.answer_inline_query(iq.id, [result], cache_time=0, is_personal=True)
+    # карточка одинакова для всех — пусть повторные запросы отвечает кеш Telegram
+    await get_bot().answer_inline_query(iq.id, [result], cache_time=settings.INLINE_CACHE_TIME, is_personal=False)
 
 # ===================== payments poller =====================
+async def payments_tick(shards: int = 1, owned: Optional[List[int]] = None) -> int:
+    """
+    Один проход поллера: проверяет ждущие счета (только своих шардов, если
+    заданы), возвращает число проведённых. Просрочка и чистка invoice_wait —
+    на каждом проходе, даже если опрашивать нечего.
+    """
+    if not cryptopay.available():
+        # breaker open — не долбим упавший API, ждём cooldown; по времени не истекаем:
+        # счёт, оплаченный в последний момент, должен пройти последний опрос
+        await db.expire_invoice_waits(by_time=False)
+        return 0
+    ids = await db.pending_invoice_ids(shards, owned)
+    PAYMENTS_PENDING.set(len(ids))
+    done = 0
+    expired: List[int] = []
+    if ids:
+        invs = await cryptopay.get_invoices(ids)
+        inv_map = {}
+        for x in invs:
+            if isinstance(x, dict):
+                try:
+                    inv_map[int(x.get("invoice_id", 0))] = x
+                except Exception:
+                    continue
+        for inv_id in ids:
+            inv = inv_map.get(int(inv_id))
+            if inv and inv.get("status") == "paid":
+                if await finalize_paid_invoice(int(inv_id), "poller"):
+                    done += 1
+            elif inv and inv.get("status") == "expired":
+                expired.append(int(inv_id))
+    # истёкшие в Crypto Pay и просроченные по expires_at (после последнего опроса) больше не опрашиваем
+    await db.expire_invoice_waits(expired)
+    return done
+
+
 async def payments_loop():
-    while True:
-        try:
-            ids = await db.pending_invoice_ids()
-            if ids:
-                invs = await cryptopay.get_invoices(ids)
-                inv_map = {}
-                for x in invs:
-                    if isinstance(x, dict):
-                        try:
-                            inv_map[int(x.get("invoice_id", 0))] = x
-                        except Exception:
-                            continue
-                for inv_id in ids:
-                    inv = inv_map.get(int(inv_id))
-                    if inv and inv.get("status") == "paid":
-                        iw = await db.get_invoice_wait(int(inv_id))
-                        if iw:
-                            payload = json.loads(iw["payload"])
-                            payer_tg = int(payload.get("tg_user_id"))
-                            user = await db.ensure_user_by_tg(payer_tg, None)
-                            if iw["kind"] == "NEW":
-                                await db.create_deal_after_paid(payload, int(inv_id), user["id"])
-                            elif iw["kind"] == "MATCH":
-                                await db.match_deal_after_paid(payload, int(inv_id), user["id"])
-                            await db.del_invoice_wait(int(inv_id))
-            await asyncio.sleep(6)
-        except Exception as e:
-            print(f"[payments_loop] tick error: {e!r}")
-            await asyncio.sleep(6)
+    # реплик бота может быть несколько — каждая опрашивает только свои шарды
+    lease = leases.ShardLease("payments", settings.PAYMENTS_SHARDS)
+    try:
+        while True:
+            try:
+                owned = await lease.refresh()
+                if owned:
+                    await payments_tick(lease.shards, owned)
+            except Exception as e:
+                print(f"[payments_loop] tick error: {e!r}")
+            await asyncio.sleep(settings.PAYMENTS_POLL_S)
+    finally:
+        await lease.release()
 
 from aiogram.types import BotCommand
 
@@ -585,11 +763,20 @@ async def set_bot_commands(bot: Bot):
         BotCommand(command="start", description="Главное меню"),
     ]
     await bot.set_my_commands(commands)
+    await admin.set_admin_commands(bot)
 
 async def main():
+    tracing.set_service("bot")
+    await metrics.start_http_server(settings.METRICS_PORT, settings.METRICS_HOST)
+    await bot_username()
     asyncio.create_task(payments_loop())
+    asyncio.create_task(rates.loop())   # курсы обновляются фоном, хендлеры берут из кеша
+    bot = get_bot()
     await set_bot_commands(bot)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await cryptopay.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,44 +1,42 @@
-# app/config.py  (Pydantic v2)
-from typing import List
-from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import Field
-
-
-class Settings(BaseSettings):
-    # Telegram
-    BOT_TOKEN: str = Field(...)
-    ADMINS_TG_IDS: str = Field("", description="comma-separated tg ids")
-
-    # Crypto Pay
-    CRYPTO_PAY_TOKEN: str = Field(...)
-    CRYPTO_DEFAULT_ASSET: str = Field("USDT")
-    CRYPTO_NETWORK: str = Field("MAIN_NET")   # ← добавил
-
-    # Комиссия
-    FEE_PCT: float = Field(0.10)
-
-    # PostgreSQL
-    PGUSER: str = Field(...)
-    PGPASSWORD: str = Field("")
-    PGDATABASE: str = Field(...)
-    PGHOST: str = Field("127.0.0.1")
-    PGPORT: int = Field(5432)
-
-    # Google Sheets
-    GSHEET_CREDENTIALS_JSON: str = Field("service_account.json")
-    GSHEET_SPREADSHEET_ID: str = Field(...)
-    GSHEET_WORKSHEET_NAME: str = Field("Лист"
-                                       "1")
-    GSHEET_RANGE: str = Field("Лист1!A2:G")   # ← добавил
-    MAIN_MENU_PHOTO_URL: str = Field("")
-    EVENTS_MENU_PHOTO_URL: str = Field("")
-    model_config = SettingsConfigDict(env_file=".env", case_sensitive=True)
-
-    @property
-    def ADMIN_IDS(self) -> List[int]:
-        if not self.ADMINS_TG_IDS:
-            return []
-        return [int(x.strip()) for x in self.ADMINS_TG_IDS.split(",") if x.strip()]
-
-
-settings = Settings()
\ No newline at end of file
+# app/config.py
+"""
+Ленивые настройки: `from .config import settings` ничего не стоит, pydantic
+и чтение .env происходят при первом обращении к атрибуту (settings.BOT_TOKEN).
+Короткоживущие CLI (db --init, sync_fights, cron) не платят за то, что не
+используют, а ошибка в .env всплывает там, где настройка реально нужна.
+"""
+from typing import TYPE_CHECKING, Any, Optional
+
+if TYPE_CHECKING:
+    from .config_model import Settings
+
+_instance: Optional["Settings"] = None
+
+
+def get_settings() -> "Settings":
+    global _instance
+    if _instance is None:
+        from .config_model import Settings
+        _instance = Settings()
+    return _instance
+
+
+class _LazySettings:
+    __slots__ = ()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_settings(), name)
+
+    def __repr__(self) -> str:
+        return repr(_instance) if _instance is not None else "<settings: not loaded>"
+
+
+settings: "Settings" = _LazySettings()  # type: ignore[assignment]
+
+
+def __getattr__(name: str) -> Any:
+    # from app.config import Settings — как раньше, но без импорта pydantic заранее
+    if name == "Settings":
+        from .config_model import Settings
+        return Settings
+    raise AttributeError(name)
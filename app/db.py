@@ -1,53 +1,627 @@
 # app/db.py
 import argparse
+import asyncio
+import time
 import asyncpg
-from typing import Any, Dict, List, Mapping, Optional
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Tuple
 
 from .config import settings
+from . import metrics, tracing
 
 _pool: Optional[asyncpg.Pool] = None
+_read_pool: Optional[asyncpg.Pool] = None
+_pool_lock = asyncio.Lock()
+
+# реплика недоступна/отстаёт — до этого момента (monotonic) читаем с primary
+_read_down_until = 0.0
+_read_lag_checked_at = 0.0
+
+# ошибки, при которых читающий запрос повторяется на primary
+_REPLICA_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.SerializationError,   # conflict with recovery на hot standby
+)
+
+# насыщение пулов: сколько корутин ждут соединение и сколько ждали
+_pool_counters: Dict[str, Dict[str, float]] = {
+    role: {"waiters": 0, "acquires": 0, "acquire_total_s": 0.0, "acquire_max_s": 0.0}
+    for role in ("primary", "replica")
+}
+
+
+DB_QUERY_SECONDS = metrics.histogram("db_query_seconds", "Latency of DB statements", ["statement"])
+DB_QUERY_ERRORS = metrics.counter("db_query_errors_total", "Failed DB statements", ["statement"])
+DB_ACQUIRE_SECONDS = metrics.histogram("db_pool_acquire_seconds", "Time waiting for a pool connection", ["role"])
+DB_POOL_SIZE = metrics.gauge("db_pool_size", "Open connections in the pool", ["role"])
+DB_POOL_BUSY = metrics.gauge("db_pool_busy", "Connections currently checked out", ["role"])
+DB_POOL_WAITERS = metrics.gauge("db_pool_waiters", "Coroutines waiting for a connection", ["role"])
 
 
 # ===== pool / helpers =====
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """Серверные настройки сессии — выполняется на каждом новом соединении пула."""
+    await conn.execute(
+        "SELECT set_config('application_name', $1, false),"
+        "       set_config('statement_timeout', $2, false),"
+        "       set_config('idle_in_transaction_session_timeout', $3, false)",
+        settings.PG_APPLICATION_NAME,
+        str(int(settings.PG_STATEMENT_TIMEOUT_MS)),
+        str(int(settings.PG_IDLE_IN_TX_TIMEOUT_MS)),
+    )
+
+
+def _pool_kwargs() -> Dict[str, Any]:
+    return dict(
+        min_size=settings.PG_POOL_MIN_SIZE,
+        max_size=settings.PG_POOL_MAX_SIZE,
+        max_queries=settings.PG_POOL_MAX_QUERIES,
+        max_inactive_connection_lifetime=settings.PG_POOL_MAX_INACTIVE_LIFETIME,
+        command_timeout=settings.PG_COMMAND_TIMEOUT,
+        statement_cache_size=settings.PG_STATEMENT_CACHE_SIZE,
+        max_cached_statement_lifetime=settings.PG_MAX_CACHED_STATEMENT_LIFETIME,
+        init=_init_connection,
+    )
+
+
 async def get_pool() -> asyncpg.Pool:
     global _pool
-    if _pool is None:
-        _pool = await asyncpg.create_pool(
-            user=settings.PGUSER,
-            password=getattr(settings, "PGPASSWORD", None),
-            database=settings.PGDATABASE,
-            host=settings.PGHOST,
-            port=settings.PGPORT,
-            min_size=1,
-            max_size=10,
-        )
+    if _pool is not None:
+        return _pool
+    async with _pool_lock:
+        # второй ждавший не создаёт пул повторно
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                user=settings.PGUSER,
+                password=getattr(settings, "PGPASSWORD", None),
+                database=settings.PGDATABASE,
+                host=settings.PGHOST,
+                port=settings.PGPORT,
+                **_pool_kwargs(),
+            )
     return _pool
 
 
-async def execute(sql: str, *args) -> str:
+async def connect() -> asyncpg.Connection:
+    """
+    Отдельное соединение мимо пула — для session-level состояния (advisory locks),
+    которое не должно уехать к другому владельцу после release(). Закрывает вызывающий.
+    """
+    return await asyncpg.connect(
+        user=settings.PGUSER,
+        password=getattr(settings, "PGPASSWORD", None),
+        database=settings.PGDATABASE,
+        host=settings.PGHOST,
+        port=settings.PGPORT,
+        command_timeout=settings.PG_COMMAND_TIMEOUT,
+        statement_cache_size=0,
+    )
+
+
+# на primary (не в recovery) отставание = 0; на standby без новых WAL — тоже 0
+SQL_REPLICA_LAG = """
+SELECT CASE
+         WHEN NOT pg_is_in_recovery() THEN 0
+         WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+         ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+       END::float8
+"""
+
+
+def _mark_read_down(reason: Any) -> None:
+    global _read_down_until
+    _read_down_until = time.monotonic() + settings.PG_READ_RETRY_S
+    print(f"[DB] replica disabled for {settings.PG_READ_RETRY_S:.0f}s: {reason!r}")
+
+
+async def get_read_pool() -> Optional[asyncpg.Pool]:
+    """
+    Пул реплики (PG_READ_DSN) или None, если реплики нет, она недоступна
+    или отстаёт больше PG_READ_MAX_LAG_S — тогда читающие хелперы идут на primary.
+    """
+    global _read_pool, _read_lag_checked_at
+    if not settings.PG_READ_DSN or time.monotonic() < _read_down_until:
+        return None
+    if _read_pool is None:
+        async with _pool_lock:
+            if _read_pool is None:
+                try:
+                    _read_pool = await asyncpg.create_pool(dsn=settings.PG_READ_DSN, **_pool_kwargs())
+                except _REPLICA_ERRORS as e:
+                    _mark_read_down(e)
+                    return None
+
+    now = time.monotonic()
+    if now - _read_lag_checked_at >= settings.PG_READ_LAG_CHECK_S:
+        _read_lag_checked_at = now
+        try:
+            async with _acquire_from(_read_pool, "replica") as conn:
+                lag = await conn.fetchval(SQL_REPLICA_LAG)
+        except _REPLICA_ERRORS as e:
+            _mark_read_down(e)
+            return None
+        if lag is not None and lag > settings.PG_READ_MAX_LAG_S:
+            _mark_read_down(f"lag {lag:.1f}s")
+            return None
+    return _read_pool
+
+
+async def close_pool() -> None:
+    global _pool, _read_pool
+    async with _pool_lock:
+        for p in (_pool, _read_pool):
+            if p is not None:
+                await p.close()
+        _pool = _read_pool = None
+
+
+@asynccontextmanager
+async def _acquire_from(pool: asyncpg.Pool, role: str = "primary") -> AsyncIterator[asyncpg.Connection]:
+    c = _pool_counters[role]
+    c["waiters"] += 1
+    t0 = time.perf_counter()
+    try:
+        conn = await pool.acquire()
+    finally:
+        c["waiters"] -= 1
+    waited = time.perf_counter() - t0
+    c["acquires"] += 1
+    c["acquire_total_s"] += waited
+    c["acquire_max_s"] = max(c["acquire_max_s"], waited)
+    DB_ACQUIRE_SECONDS.observe(waited, role=role)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+def pool_stats(role: str = "primary") -> Dict[str, Any]:
+    """Снимок насыщения пула: размер, свободные, ожидающие, латентность acquire."""
+    pool = _pool if role == "primary" else _read_pool
+    c = _pool_counters[role]
+    size = pool.get_size() if pool is not None else 0
+    idle = pool.get_idle_size() if pool is not None else 0
+    return {
+        "size": size,
+        "idle": idle,
+        "busy": size - idle,
+        "max_size": settings.PG_POOL_MAX_SIZE,
+        "waiters": int(c["waiters"]),
+        "acquires": int(c["acquires"]),
+        "acquire_avg_ms": (c["acquire_total_s"] / c["acquires"] * 1000) if c["acquires"] else 0.0,
+        "acquire_max_ms": c["acquire_max_s"] * 1000,
+    }
+
+
+def _collect_pool_metrics() -> None:
+    for role in ("primary", "replica"):
+        st = pool_stats(role)
+        DB_POOL_SIZE.set(st["size"], role=role)
+        DB_POOL_BUSY.set(st["busy"], role=role)
+        DB_POOL_WAITERS.set(st["waiters"], role=role)
+
+
+metrics.add_collector(_collect_pool_metrics)
+
+
+@asynccontextmanager
+async def _timed(statement: str) -> AsyncIterator[None]:
+    t0 = time.perf_counter()
+    try:
+        with tracing.span("db." + statement, child_only=True):
+            yield
+    except Exception:
+        DB_QUERY_ERRORS.inc(statement=statement)
+        raise
+    finally:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - t0, statement=statement)
+
+
+@asynccontextmanager
+async def acquire() -> AsyncIterator[asyncpg.Connection]:
+    """
+    Одно соединение на несколько запросов хендлера:
+        async with db.acquire() as conn:
+            u = await db.q_fetchrow("user_by_tg", tg_id, conn=conn)
+            f = await db.q_fetchrow("fight_by_id", fid, conn=conn)
+    """
     pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with _acquire_from(pool) as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def acquire_read() -> AsyncIterator[asyncpg.Connection]:
+    """
+    Соединение для нескольких читающих запросов, которым допустимо отставание:
+    реплика, если она есть и здорова, иначе primary.
+    Ошибку посреди блока не повторяем — это делает _run для одиночных запросов.
+    """
+    pool = await get_read_pool()
+    if pool is not None:
+        async with _acquire_from(pool, "replica") as conn:
+            yield conn
+        return
+    async with acquire() as conn:
+        yield conn
+
+
+async def execute(sql: str, *args) -> str:
+    async with acquire() as conn, _timed("adhoc"):
         return await conn.execute(sql, *args)
 
 
 async def fetch(sql: str, *args) -> List[Mapping[str, Any]]:
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn, _timed("adhoc"):
         return await conn.fetch(sql, *args)
 
 
 async def fetchrow(sql: str, *args) -> Optional[Mapping[str, Any]]:
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn, _timed("adhoc"):
         return await conn.fetchrow(sql, *args)
 
 
 async def fetchval(sql: str, *args) -> Any:
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn, _timed("adhoc"):
         return await conn.fetchval(sql, *args)
 
 
+# ===== named statements =====
+# Имя -> SQL с явной проекцией колонок (никаких SELECT * / d.*).
+# Подготовку делает asyncpg: у каждого соединения свой LRU-кэш prepared
+# statements по тексту запроса, так что постоянный текст = один PREPARE
+# на соединение, дальше только Bind/Execute.
+FIGHT_COLS = (
+    "id, title, participant1_name, participant2_name, photo_url, "
+    "description, starts_at, status, winner_participant"
+)
+
+DEAL_CARD_COLS = """
+    d.id, d.fight_id, d.user1_id, d.participant1, d.amount1_cents, d.paid1, d.status,
+    f.title, f.participant1_name AS p1, f.participant2_name AS p2, f.photo_url
+"""
+
+STATEMENTS: Dict[str, str] = {
+    # users
+    "user_by_tg": "SELECT id, tg_user_id, username FROM app_user WHERE tg_user_id=$1",
+    "user_insert": """
+        INSERT INTO app_user(tg_user_id, username) VALUES($1,$2)
+        ON CONFLICT (tg_user_id) DO UPDATE SET username=COALESCE(EXCLUDED.username, app_user.username)
+        RETURNING id, tg_user_id, username
+    """,
+    "user_set_username": "UPDATE app_user SET username=$1 WHERE id=$2",
+    "user_tg_id": "SELECT tg_user_id FROM app_user WHERE id=$1",
+
+    # fights
+    "fights_upcoming": f"""
+        SELECT {FIGHT_COLS} FROM fight
+        WHERE status IN ('upcoming','today','live')
+        ORDER BY starts_at NULLS LAST, id
+    """,
+    "fight_by_id": f"SELECT {FIGHT_COLS} FROM fight WHERE id=$1",
+    # принимает ли бой (по id или по id сделки) новые ставки и ответы; $3 — DEAL_EXPIRE_AT_START:
+    # начавшийся бой закрыт, иначе его ставки истечёт settlement_worker.SQL_EXPIRE_STALE
+    "fight_takes_bets": """
+        SELECT f.status <> 'done'
+           AND NOT ($3::boolean AND (f.status = 'live' OR COALESCE(f.starts_at <= now(), FALSE)))
+        FROM fight f
+        WHERE f.id = COALESCE($1::bigint, (SELECT fight_id FROM deal WHERE id = $2::bigint))
+    """,
+    # админка: бои без результата (в т.ч. done из листа, где победителя не указали)
+    "fights_unresolved": f"""
+        SELECT {FIGHT_COLS} FROM fight
+        WHERE status <> 'done' OR winner_participant IS NULL
+        ORDER BY starts_at NULLS LAST, id
+        LIMIT $1
+    """,
+    # результат по многим боям одним UPDATE (winner 0 — void); уже закрытые не трогаем
+    "fights_close": """
+        UPDATE fight f
+           SET status='done', winner_participant=v.win, result_by=$3, result_at=now()
+        FROM unnest($1::bigint[], $2::int[]) AS v(id, win)
+        WHERE f.id = v.id AND (f.status <> 'done' OR f.winner_participant IS NULL)
+        RETURNING f.id, f.title, f.participant1_name, f.participant2_name, f.winner_participant
+    """,
+    # прогресс расчёта по боям: сделки settled / всего, payout отправлено / всего
+    "fights_settle_progress": """
+        SELECT v.id AS fight_id, dd.deals, dd.settled, pp.payouts, pp.sent
+        FROM unnest($1::bigint[]) AS v(id)
+        CROSS JOIN LATERAL (
+            SELECT count(*) AS deals, count(*) FILTER (WHERE status = 'settled') AS settled
+            FROM deal WHERE fight_id = v.id AND paid1 AND status IN ('matched', 'awaiting_match', 'settled')
+        ) dd
+        CROSS JOIN LATERAL (
+            SELECT count(*) AS payouts, count(*) FILTER (WHERE p.status = 'sent') AS sent
+            FROM payout p JOIN deal d ON d.id = p.deal_id
+            WHERE d.fight_id = v.id
+        ) pp
+    """,
+
+    # deals
+    # экран «открытые ставки»: по одной (самой старой) на сторону и сумму — список
+    # не растёт с книгой, и ответ идёт в очередь FIFO, как deal_find_opposite
+    "deals_open": """
+        SELECT DISTINCT ON (d.participant1, d.amount1_cents) d.id, d.participant1, d.amount1_cents
+        FROM deal d
+        WHERE d.fight_id = $1
+          AND d.status = 'awaiting_match'
+        ORDER BY d.participant1, d.amount1_cents, d.id
+        LIMIT $2
+    """,
+    "deals_open_excl_user": """
+        SELECT DISTINCT ON (d.participant1, d.amount1_cents) d.id, d.participant1, d.amount1_cents
+        FROM deal d
+        WHERE d.fight_id = $1
+          AND d.status = 'awaiting_match'
+          AND d.user1_id <> $2
+        ORDER BY d.participant1, d.amount1_cents, d.id
+        LIMIT $3
+    """,
+    # история: живые сделки + архив (archive.py), последние 100
+    "deals_my": """
+        SELECT d.id, d.fight_id, d.user1_id, d.user2_id, d.participant1, d.participant2,
+               d.amount1_cents, d.amount2_cents, d.status,
+               f.title, f.participant1_name AS p1, f.participant2_name AS p2
+        FROM (
+            (SELECT id, fight_id, user1_id, user2_id, participant1, participant2,
+                    amount1_cents, amount2_cents, status
+             FROM deal WHERE user1_id=$1 OR user2_id=$1
+             ORDER BY id DESC LIMIT 100)
+            UNION ALL
+            (SELECT id, fight_id, user1_id, user2_id, participant1, participant2,
+                    amount1_cents, amount2_cents, status
+             FROM deal_archive WHERE user1_id=$1 OR user2_id=$1
+             ORDER BY id DESC LIMIT 100)
+        ) d
+        JOIN fight f ON f.id=d.fight_id
+        ORDER BY d.id DESC
+        LIMIT 100
+    """,
+    "deals_my_active": """
+        SELECT d.id, d.user1_id, d.user2_id, d.participant1, d.participant2,
+               d.amount1_cents, d.amount2_cents, d.status, f.title
+        FROM deal d
+        JOIN fight f ON f.id = d.fight_id
+        WHERE (d.user1_id = $1 OR d.user2_id = $1)
+          AND f.status IN ('upcoming','today','live')
+          AND d.status IN ('awaiting_match','matched')
+        ORDER BY d.id DESC
+        LIMIT 100
+    """,
+    "deals_shareable": """
+        SELECT d.id, d.amount1_cents, d.participant1,
+               f.title, f.participant1_name AS p1, f.participant2_name AS p2
+        FROM deal AS d
+        JOIN fight AS f ON f.id = d.fight_id
+        WHERE d.user1_id = $1
+          AND d.status = 'awaiting_match'
+          AND d.paid1 = TRUE
+          AND d.user2_id IS NULL
+        ORDER BY d.id DESC
+        LIMIT 20
+    """,
+    "deal_card": f"""
+        SELECT {DEAL_CARD_COLS}
+        FROM deal d JOIN fight f ON f.id=d.fight_id
+        WHERE d.id=$1
+    """,
+    # встречная ставка блокируется до конца транзакции: параллельный матч или
+    # истечение (settlement_worker.SQL_EXPIRE_STALE) её пропустят
+    "deal_find_opposite": """
+        SELECT id FROM deal
+        WHERE fight_id=$1
+          AND paid1=TRUE
+          AND user2_id IS NULL
+          AND status='awaiting_match'
+          AND participant1 = CASE WHEN $2=1 THEN 2 ELSE 1 END
+          AND amount1_cents = $3
+          AND user1_id <> $4
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    """,
+
+    "deal_fill_side2": """
+        UPDATE deal
+        SET user2_id=$1,
+            participant2=$2,
+            amount2_cents=$3,
+            paid2=TRUE,
+            invoice2_id=$4,
+            status='matched'
+        WHERE id=$5
+    """,
+    "deal_insert_open": """
+        INSERT INTO deal (fight_id, user1_id, participant1, amount1_cents, paid1, invoice1_id, status)
+        VALUES ($1,$2,$3,$4,TRUE,$5,'awaiting_match')
+        RETURNING id
+    """,
+    "deal_match": """
+        UPDATE deal
+        SET user2_id=$1,
+            participant2=$2,
+            amount2_cents=$3,
+            paid2=TRUE,
+            invoice2_id=$4,
+            status='matched'
+        WHERE id=$5
+          AND status='awaiting_match'
+          AND user2_id IS NULL
+        RETURNING id, fight_id, participant1, amount1_cents
+    """,
+    # агрегаты книги боя: дельты по (сторона, сумма) одной пачкой
+    "pool_add": """
+        INSERT INTO fight_pool AS p (fight_id, side, amount_cents, open_count, matched_count, matched_cents)
+        SELECT $1, * FROM unnest($2::int[], $3::bigint[], $4::int[], $5::int[], $6::bigint[])
+        ON CONFLICT (fight_id, side, amount_cents) DO UPDATE
+        SET open_count    = p.open_count + EXCLUDED.open_count,
+            matched_count = p.matched_count + EXCLUDED.matched_count,
+            matched_cents = p.matched_cents + EXCLUDED.matched_cents
+    """,
+    "fight_pool": """
+        SELECT side, amount_cents, open_count, matched_count, matched_cents
+        FROM fight_pool
+        WHERE fight_id = $1 AND (open_count > 0 OR matched_count > 0)
+        ORDER BY side, amount_cents
+    """,
+
+    # ledger
+    "ledger_post": """
+        WITH legs AS (
+            SELECT * FROM unnest($2::text[], $3::text[], $4::bigint[], $5::bigint[])
+                     WITH ORDINALITY AS t(kind, account, user_id, amount_cents, leg)
+        ), ins AS (
+            INSERT INTO ledger(txn_ref, leg, kind, account, user_id, amount_cents, deal_id)
+            SELECT $1, leg, kind, account, user_id, amount_cents, $6 FROM legs
+            ON CONFLICT (txn_ref, leg) DO NOTHING
+            RETURNING id, account, user_id, amount_cents
+        ), pend AS (
+            INSERT INTO balance_pending(ledger_id, user_id, amount_cents)
+            SELECT id, user_id, amount_cents FROM ins WHERE account = 'user'
+        )
+        SELECT count(*) FROM ins
+    """,
+    "balance_lock": "SELECT balance_cents FROM app_user WHERE id=$1 FOR UPDATE",
+    "balance_pending_sum": "SELECT COALESCE(sum(amount_cents), 0) FROM balance_pending WHERE user_id=$1",
+    "balance_get": """
+        SELECT u.balance_cents
+             + COALESCE((SELECT sum(p.amount_cents) FROM balance_pending p WHERE p.user_id = u.id), 0)
+        FROM app_user u WHERE u.id=$1
+    """,
+    "balance_materialize": """
+        WITH b AS (
+            DELETE FROM balance_pending
+            WHERE ledger_id IN (
+                SELECT ledger_id FROM balance_pending ORDER BY ledger_id LIMIT $1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING user_id, amount_cents
+        ), s AS (
+            SELECT user_id, sum(amount_cents) AS delta, count(*) AS n FROM b GROUP BY user_id
+        ), u AS (
+            UPDATE app_user au SET balance_cents = au.balance_cents + s.delta
+            FROM s WHERE au.id = s.user_id
+        )
+        SELECT COALESCE(sum(n), 0)::bigint FROM s
+    """,
+
+    # Telegram file_id по URL картинки
+    "file_id_get": "SELECT file_id FROM tg_file_cache WHERE url=$1",
+    "file_id_put": """
+        INSERT INTO tg_file_cache(url, file_id) VALUES ($1, $2)
+        ON CONFLICT (url) DO UPDATE SET file_id=EXCLUDED.file_id, updated_at=now()
+    """,
+    "file_id_forget": "DELETE FROM tg_file_cache WHERE url = ANY($1::text[])",
+
+    # invoices
+    "invoice_wait_add": """
+        INSERT INTO invoice_wait(invoice_id, kind, user_id, fight_id, deal_id, side, amount_cents, expires_at,
+                                 asset, asset_amount)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, now() + make_interval(secs => $8), $9, $10)
+        ON CONFLICT (invoice_id) DO NOTHING
+    """,
+    # оплата пришла: забираем запись (повтор/гонка поллера и авто-проверки получат пусто);
+    # 'expired' тоже — деньги, оплаченные в последний момент, не теряем
+    "invoice_wait_claim": """
+        DELETE FROM invoice_wait
+        WHERE invoice_id=$1 AND user_id IS NOT NULL
+        RETURNING invoice_id, kind, user_id, fight_id, deal_id, side, amount_cents
+    """,
+    # сверка: оплаченный счёт, запись о котором пропала — восстанавливаем из payload счёта
+    # ('expired' — поллер её не подхватит, проведёт finalize_invoice сверки);
+    # уже проведённый депозит не восстанавливаем
+    "invoice_wait_restore": """
+        INSERT INTO invoice_wait(invoice_id, kind, user_id, fight_id, deal_id, side, amount_cents,
+                                 asset, asset_amount, status, payload)
+        SELECT $1, x.p->>'kind', u.id, (x.p->>'fight_id')::bigint, (x.p->>'deal_id')::bigint,
+               (x.p->>'participant')::int, (x.p->>'amount_cents')::bigint, $3, $4, 'expired', x.p
+        FROM (SELECT $2::jsonb AS p) x
+        JOIN app_user u ON u.tg_user_id = (x.p->>'tg_user_id')::bigint
+        WHERE NOT EXISTS (SELECT 1 FROM ledger WHERE txn_ref = 'invoice:' || $1::bigint)
+        ON CONFLICT (invoice_id) DO NOTHING
+    """,
+    # $1 шардов, из них свои $2 (invoice_id % $1) — см. leases.ShardLease
+    "invoice_wait_pending": """
+        SELECT invoice_id FROM invoice_wait
+        WHERE status='pending'
+          AND (expires_at IS NULL OR expires_at > now() - make_interval(secs => $3::float8))
+          AND invoice_id % $1 = ANY($2::int[])
+        ORDER BY created_at
+    """,
+    # заодно пачкой удаляем expired старше INVOICE_WAIT_RETENTION_H: брошенные счета
+    # не копятся (оплату после этого срока сверка восстановит из payload счёта)
+    "invoice_wait_expire": """
+        WITH gone AS (
+            DELETE FROM invoice_wait
+            WHERE invoice_id IN (
+                SELECT invoice_id FROM invoice_wait
+                WHERE status='expired' AND created_at < now() - make_interval(secs => $2::float8 * 3600)
+                ORDER BY created_at
+                LIMIT $3
+            )
+        )
+        UPDATE invoice_wait SET status='expired'
+        WHERE status='pending'
+          AND (($4::boolean AND expires_at <= now() - make_interval(secs => $5::float8))
+               OR invoice_id = ANY($1::bigint[]))
+    """,
+}
+
+
+async def _run(
+    method: str,
+    name: str,
+    args: tuple,
+    conn: Optional[asyncpg.Connection],
+    stale_ok: bool = False,
+) -> Any:
+    """
+    stale_ok=True — запрос можно выполнить на реплике; при её ошибке
+    автоматически повторяем на primary.
+    """
+    sql = STATEMENTS[name]
+    if conn is not None:
+        async with _timed(name):
+            return await getattr(conn, method)(sql, *args)
+    if stale_ok:
+        pool = await get_read_pool()
+        if pool is not None:
+            try:
+                async with _acquire_from(pool, "replica") as c, _timed(name):
+                    return await getattr(c, method)(sql, *args)
+            except _REPLICA_ERRORS as e:
+                _mark_read_down(e)
+    async with acquire() as c, _timed(name):
+        return await getattr(c, method)(sql, *args)
+
+
+async def q_fetch(
+    name: str, *args, conn: Optional[asyncpg.Connection] = None, stale_ok: bool = False,
+) -> List[Mapping[str, Any]]:
+    return await _run("fetch", name, args, conn, stale_ok)
+
+
+async def q_fetchrow(
+    name: str, *args, conn: Optional[asyncpg.Connection] = None, stale_ok: bool = False,
+) -> Optional[Mapping[str, Any]]:
+    return await _run("fetchrow", name, args, conn, stale_ok)
+
+
+async def q_fetchval(
+    name: str, *args, conn: Optional[asyncpg.Connection] = None, stale_ok: bool = False,
+) -> Any:
+    return await _run("fetchval", name, args, conn, stale_ok)
+
+
+async def q_execute(name: str, *args, conn: Optional[asyncpg.Connection] = None) -> str:
+    return await _run("execute", name, args, conn)
+
+
 # ===== schema =====
 SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS app_user (
@@ -67,8 +641,11 @@ CREATE TABLE IF NOT EXISTS fight (
     description         TEXT,
     starts_at           TIMESTAMPTZ,
     status              TEXT NOT NULL DEFAULT 'upcoming',  -- upcoming|today|live|done
-    winner_participant  INT NULL                            -- 1|2
+    winner_participant  INT NULL                            -- 1|2, 0 — бой отменён (void)
 );
+-- результат выставил админ из бота (tg id): sync_fights его больше не перетирает
+ALTER TABLE fight ADD COLUMN IF NOT EXISTS result_by BIGINT NULL;
+ALTER TABLE fight ADD COLUMN IF NOT EXISTS result_at TIMESTAMPTZ NULL;
 
 CREATE TABLE IF NOT EXISTS deal (
     id              BIGSERIAL PRIMARY KEY,
@@ -92,46 +669,259 @@ CREATE TABLE IF NOT EXISTS deal (
 );
 
 CREATE TABLE IF NOT EXISTS invoice_wait (
-    invoice_id  BIGINT PRIMARY KEY,
-    kind        TEXT NOT NULL,        -- NEW | MATCH
-    payload     JSONB NOT NULL,
-    created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+    invoice_id    BIGINT PRIMARY KEY,
+    kind          TEXT NOT NULL,        -- NEW | MATCH
+    user_id       BIGINT NULL REFERENCES app_user(id) ON DELETE CASCADE,
+    fight_id      BIGINT NULL,          -- NEW
+    deal_id       BIGINT NULL,          -- MATCH
+    side          INT NULL,             -- 1|2
+    amount_cents  BIGINT NULL,          -- в расчётном активе (CRYPTO_DEFAULT_ASSET)
+    asset         TEXT NULL,            -- чем выставлен счёт
+    asset_amount  NUMERIC NULL,         -- сколько в asset (по курсу на момент счёта)
+    status        TEXT NOT NULL DEFAULT 'pending',  -- pending|expired (оплаченные удаляются)
+    expires_at    TIMESTAMPTZ NULL,
+    payload       JSONB NULL,           -- legacy: до типизированных колонок
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+-- апгрейд старой схемы: колонки + перенос ждущих счетов из JSON
+ALTER TABLE invoice_wait
+    ADD COLUMN IF NOT EXISTS user_id BIGINT NULL REFERENCES app_user(id) ON DELETE CASCADE,
+    ADD COLUMN IF NOT EXISTS fight_id BIGINT NULL,
+    ADD COLUMN IF NOT EXISTS deal_id BIGINT NULL,
+    ADD COLUMN IF NOT EXISTS side INT NULL,
+    ADD COLUMN IF NOT EXISTS amount_cents BIGINT NULL,
+    ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'pending',
+    ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ NULL,
+    ADD COLUMN IF NOT EXISTS asset TEXT NULL,
+    ADD COLUMN IF NOT EXISTS asset_amount NUMERIC NULL,
+    ALTER COLUMN payload DROP NOT NULL;
+UPDATE invoice_wait w
+SET user_id      = u.id,
+    fight_id     = (w.payload->>'fight_id')::bigint,
+    deal_id      = (w.payload->>'deal_id')::bigint,
+    side         = (w.payload->>'participant')::int,
+    amount_cents = (w.payload->>'amount_cents')::bigint
+FROM app_user u
+WHERE w.user_id IS NULL
+  AND w.payload IS NOT NULL
+  AND u.tg_user_id = (w.payload->>'tg_user_id')::bigint;
+CREATE INDEX IF NOT EXISTS invoice_wait_pending_idx ON invoice_wait(expires_at, created_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS invoice_wait_expired_idx ON invoice_wait(created_at) WHERE status = 'expired';
+
+-- двойная запись: у каждой проводки (txn_ref) сумма ног = 0
+-- счета: user (user_id), escrow (ставки в игре), house (комиссия), cryptopay (внешний кошелёк)
+CREATE TABLE IF NOT EXISTS ledger (
+    id            BIGSERIAL PRIMARY KEY,
+    txn_ref       TEXT NOT NULL,      -- invoice:<id> | stake:<deal>:<side> | payout:<deal> | ...
+    leg           INT NOT NULL,
+    kind          TEXT NOT NULL,      -- deposit|stake_lock|payout|fee|refund|withdrawal
+    account       TEXT NOT NULL,      -- user|escrow|house|cryptopay|hold (выплата ждёт перевода)
+    user_id       BIGINT NULL REFERENCES app_user(id),
+    amount_cents  BIGINT NOT NULL,    -- + приход на счёт, - расход
+    deal_id       BIGINT NULL,
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    UNIQUE (txn_ref, leg)
+);
+CREATE INDEX IF NOT EXISTS ledger_user_idx ON ledger(user_id, id) WHERE user_id IS NOT NULL;
+-- окно по времени для сверки (reconcile.py): created_at растёт вместе с id, BRIN почти бесплатен
+CREATE INDEX IF NOT EXISTS ledger_created_brin ON ledger USING brin(created_at);
+
+-- снапшот баланса + ещё не применённые к нему ноги (разгребаются пачками)
+ALTER TABLE app_user ADD COLUMN IF NOT EXISTS balance_cents BIGINT NOT NULL DEFAULT 0;
+CREATE TABLE IF NOT EXISTS balance_pending (
+    ledger_id     BIGINT PRIMARY KEY,
+    user_id       BIGINT NOT NULL,
+    amount_cents  BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS balance_pending_user_idx ON balance_pending(user_id);
+
+-- расчёт по сделкам: строка на участника (аудит) + очередь сетевых переводов
+CREATE TABLE IF NOT EXISTS payout (
+    id            BIGSERIAL PRIMARY KEY,
+    deal_id       BIGINT NOT NULL REFERENCES deal(id) ON DELETE CASCADE,
+    user_id       BIGINT NOT NULL REFERENCES app_user(id) ON DELETE CASCADE,
+    kind          TEXT NOT NULL,                    -- win|loss|refund
+    amount_cents  BIGINT NOT NULL DEFAULT 0,        -- причитается пользователю
+    fee_cents     BIGINT NOT NULL DEFAULT 0,
+    status        TEXT NOT NULL DEFAULT 'pending',  -- pending|sending|sent
+    batch_ref     TEXT NULL,                        -- spend_id общего перевода
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    sent_at       TIMESTAMPTZ NULL,
+    UNIQUE (deal_id, user_id, kind)
+);
+CREATE INDEX IF NOT EXISTS payout_open_idx ON payout(user_id, id) WHERE status <> 'sent';
+CREATE INDEX IF NOT EXISTS payout_batch_idx ON payout(batch_ref) WHERE batch_ref IS NOT NULL;
+CREATE INDEX IF NOT EXISTS deal_fight_status_idx ON deal(fight_id, status);
+
+-- горячие статусы: живые экраны и матчинг ходят только по этим частичным индексам,
+-- история (settled/void) в них не попадает и со временем уезжает в deal_archive
+ALTER TABLE deal ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+CREATE INDEX IF NOT EXISTS deal_open_idx
+    ON deal(fight_id, participant1, amount1_cents, id) WHERE status = 'awaiting_match';
+CREATE INDEX IF NOT EXISTS deal_active_user1_idx
+    ON deal(user1_id, id) WHERE status IN ('awaiting_match', 'matched');
+CREATE INDEX IF NOT EXISTS deal_active_user2_idx
+    ON deal(user2_id, id) WHERE status IN ('awaiting_match', 'matched');
+
+-- книга боя в разрезе (сторона создателя, сумма): сколько ставок ждут ответа и
+-- сколько сматчено. Ведётся инкрементально там же, где меняется статус сделки
+-- (_create_deal/_match_deal, SQL_SETTLE_FIGHT, SQL_EXPIRE_STALE) — карточка боя
+-- читает несколько строк по PK и не агрегирует deal
+CREATE TABLE IF NOT EXISTS fight_pool (
+    fight_id       BIGINT NOT NULL REFERENCES fight(id) ON DELETE CASCADE,
+    side           INT NOT NULL,                 -- 1|2, на кого ставка
+    amount_cents   BIGINT NOT NULL,
+    open_count     INT NOT NULL DEFAULT 0,       -- awaiting_match
+    matched_count  INT NOT NULL DEFAULT 0,       -- ставок этой стороны в сматченных сделках
+    matched_cents  BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (fight_id, side, amount_cents)
+);
+-- первый запуск: заполнить из живых сделок (пустая таблица = ещё не вели)
+INSERT INTO fight_pool (fight_id, side, amount_cents, open_count, matched_count, matched_cents)
+SELECT fight_id, side, amount, count(*) FILTER (WHERE is_open), count(*) FILTER (WHERE NOT is_open),
+       COALESCE(sum(amount) FILTER (WHERE NOT is_open), 0)
+FROM (
+    SELECT fight_id, participant1 AS side, amount1_cents AS amount, status = 'awaiting_match' AS is_open
+    FROM deal
+    WHERE status = 'awaiting_match' OR (status IN ('matched', 'settled') AND user2_id IS NOT NULL)
+    UNION ALL
+    SELECT fight_id, participant2, amount2_cents, FALSE
+    FROM deal
+    WHERE status IN ('matched', 'settled') AND user2_id IS NOT NULL
+) s
+WHERE NOT EXISTS (SELECT 1 FROM fight_pool)
+GROUP BY fight_id, side, amount;
+
+-- архив закрытых сделок и их payout (archive.py), секции по месяцу created_at
+-- создаёт архиватор; без FK на fight — удаление боя историю не трогает,
+-- старый месяц удаляется DROP/DETACH секции
+CREATE TABLE IF NOT EXISTS deal_archive (
+    id              BIGINT NOT NULL,
+    fight_id        BIGINT NOT NULL,
+    user1_id        BIGINT NOT NULL,
+    participant1    INT NOT NULL,
+    amount1_cents   BIGINT NOT NULL,
+    paid1           BOOLEAN NOT NULL,
+    invoice1_id     BIGINT NULL,
+    user2_id        BIGINT NULL,
+    participant2    INT NULL,
+    amount2_cents   BIGINT NULL,
+    paid2           BOOLEAN NOT NULL,
+    invoice2_id     BIGINT NULL,
+    status          TEXT NOT NULL,
+    created_at      TIMESTAMPTZ NOT NULL,
+    archived_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+CREATE INDEX IF NOT EXISTS deal_archive_user1_idx ON deal_archive(user1_id, id);
+CREATE INDEX IF NOT EXISTS deal_archive_user2_idx ON deal_archive(user2_id, id) WHERE user2_id IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS payout_archive (
+    id            BIGINT NOT NULL,
+    deal_id       BIGINT NOT NULL,
+    user_id       BIGINT NOT NULL,
+    kind          TEXT NOT NULL,
+    amount_cents  BIGINT NOT NULL,
+    fee_cents     BIGINT NOT NULL,
+    status        TEXT NOT NULL,
+    batch_ref     TEXT NULL,
+    created_at    TIMESTAMPTZ NOT NULL,
+    sent_at       TIMESTAMPTZ NULL,
+    archived_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+CREATE INDEX IF NOT EXISTS payout_archive_deal_idx ON payout_archive(deal_id);
+
+-- бой стал done (или у done-боя сменился победитель) -> NOTIFY settlement-воркеру;
+-- уходит при COMMIT, одинаковые payload в одной транзакции Postgres схлопывает
+CREATE OR REPLACE FUNCTION fight_done_notify() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status = 'done' AND (TG_OP = 'INSERT'
+        OR OLD.status IS DISTINCT FROM 'done'
+        OR OLD.winner_participant IS DISTINCT FROM NEW.winner_participant) THEN
+        PERFORM pg_notify('fight_done', NEW.id::text);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS fight_done_notify ON fight;
+CREATE TRIGGER fight_done_notify
+    AFTER INSERT OR UPDATE OF status, winner_participant ON fight
+    FOR EACH ROW EXECUTE FUNCTION fight_done_notify();
+
+-- URL картинки -> file_id, полученный от Telegram при первой отправке
+CREATE TABLE IF NOT EXISTS tg_file_cache (
+    url         TEXT PRIMARY KEY,
+    file_id     TEXT NOT NULL,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 """
 
 
 # ===== users =====
 async def ensure_user_by_tg(tg_user_id: int, username: Optional[str]) -> Mapping[str, Any]:
-    row = await fetchrow(
-        "SELECT * FROM app_user WHERE tg_user_id=$1",
-        tg_user_id,
-    )
-    if row:
-        # обновим username, если поменялся
-        if username and row["username"] != username:
-            await execute("UPDATE app_user SET username=$1 WHERE id=$2", username, row["id"])
-        return row
-
-    await execute(
-        "INSERT INTO app_user(tg_user_id, username) VALUES($1,$2)",
-        tg_user_id, username,
-    )
-    return await fetchrow("SELECT * FROM app_user WHERE tg_user_id=$1", tg_user_id)
+    async with acquire() as conn:
+        row = await q_fetchrow("user_by_tg", tg_user_id, conn=conn)
+        if row:
+            # обновим username, если поменялся
+            if username and row["username"] != username:
+                await q_execute("user_set_username", username, row["id"], conn=conn)
+            return row
+
+        return await q_fetchrow("user_insert", tg_user_id, username, conn=conn)
 
 
 # ===== fights =====
-async def list_upcoming() -> List[Mapping[str, Any]]:
-    return await fetch(
-        """
-        SELECT * FROM fight
-        WHERE status IN ('upcoming','today','live')
-        ORDER BY starts_at NULLS LAST, id
-        """
-    )
+async def list_upcoming(stale_ok: bool = True) -> List[Mapping[str, Any]]:
+    return await q_fetch("fights_upcoming", stale_ok=stale_ok)
+
+
+async def get_fight(
+    fight_id: int,
+    conn: Optional[asyncpg.Connection] = None,
+    stale_ok: bool = True,
+) -> Optional[Mapping[str, Any]]:
+    return await q_fetchrow("fight_by_id", fight_id, conn=conn, stale_ok=stale_ok)
+
+
+def takes_bets(f: Mapping[str, Any]) -> bool:
+    """То же, что fight_takes_bets, по уже прочитанной строке боя (для карточки)."""
+    if f["status"] == "done":
+        return False
+    if not settings.DEAL_EXPIRE_AT_START:
+        return True
+    starts_at = f.get("starts_at")
+    return f["status"] != "live" and not (starts_at is not None and starts_at <= datetime.now(timezone.utc))
+
+
+async def fight_takes_bets(
+    fight_id: Optional[int] = None,
+    deal_id: Optional[int] = None,
+    conn: Optional[asyncpg.Connection] = None,
+) -> bool:
+    """Бой (или бой сделки deal_id) принимает ставки; читаем с primary — перед счётом."""
+    return bool(await q_fetchval("fight_takes_bets", fight_id, deal_id, settings.DEAL_EXPIRE_AT_START, conn=conn))
+
+
+async def list_unresolved(limit: int = 50) -> List[Mapping[str, Any]]:
+    return await q_fetch("fights_unresolved", limit)
+
+
+async def close_fights(results: List[Tuple[int, int]], admin_tg_id: int) -> List[Mapping[str, Any]]:
+    """
+    [(fight_id, winner)] -> status='done' одной транзакцией (winner 0 — void,
+    все ставки возвращаются). Триггер fight_done будит settlement-воркер.
+    Возвращает реально закрытые бои; уже закрытые с победителем пропускаются.
+    """
+    if not results:
+        return []
+    ids = [int(fid) for fid, _ in results]
+    wins = [int(w) for _, w in results]
+    return await q_fetch("fights_close", ids, wins, admin_tg_id)
 
 
-async def get_fight(fight_id: int) -> Optional[Mapping[str, Any]]:
-    return await fetchrow("SELECT * FROM fight WHERE id=$1", fight_id)
+async def settle_progress(fight_ids: List[int]) -> List[Mapping[str, Any]]:
+    return await q_fetch("fights_settle_progress", fight_ids)
 
 
 async def upsert_fights(items: List[Dict[str, Any]]) -> None:
@@ -147,8 +937,7 @@ async def upsert_fights(items: List[Dict[str, Any]]) -> None:
       - status (str)  'upcoming'|'today'|'live'|'done'
       - winner_participant (int|None)
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             for it in items:
                 await conn.execute(
@@ -179,154 +968,373 @@ async def upsert_fights(items: List[Dict[str, Any]]) -> None:
 
 
 # ===== deals (ставки) =====
-async def list_open_deals(fight_id: int, exclude_user_id: Optional[int] = None) -> List[Mapping[str, Any]]:
+OPEN_DEALS_LIMIT = 20   # строк на экране «открытые ставки» (kb_open_deals)
+
+async def list_open_deals(
+    fight_id: int,
+    exclude_user_id: Optional[int] = None,
+    conn: Optional[asyncpg.Connection] = None,
+    stale_ok: bool = True,
+) -> List[Mapping[str, Any]]:
     if exclude_user_id:
-        return await fetch(
-            """
-            SELECT d.*
-            FROM deal d
-            WHERE d.fight_id = $1
-              AND d.status = 'awaiting_match'
-              AND d.user1_id <> $2
-            ORDER BY d.id
-            """,
-            fight_id, exclude_user_id
-        )
-    else:
-        return await fetch(
-            """
-            SELECT d.*
-            FROM deal d
-            WHERE d.fight_id = $1
-              AND d.status = 'awaiting_match'
-            ORDER BY d.id
-            """,
-            fight_id
-        )
+        return await q_fetch("deals_open_excl_user", fight_id, exclude_user_id, OPEN_DEALS_LIMIT,
+                             conn=conn, stale_ok=stale_ok)
+    return await q_fetch("deals_open", fight_id, OPEN_DEALS_LIMIT, conn=conn, stale_ok=stale_ok)
 
 
-async def list_my_deals(user_id: int) -> List[Mapping[str, Any]]:
-    return await fetch(
-        """
-        SELECT d.*, f.title, f.participant1_name AS p1, f.participant2_name AS p2
-        FROM deal d
-        JOIN fight f ON f.id=d.fight_id
-        WHERE d.user1_id=$1 OR d.user2_id=$1
-        ORDER BY d.id DESC
-        LIMIT 100
-        """,
-        user_id,
-    )
+async def get_fight_pool(
+    fight_id: int,
+    conn: Optional[asyncpg.Connection] = None,
+    stale_ok: bool = True,
+) -> List[Mapping[str, Any]]:
+    """Ликвидность боя из fight_pool: строка на (сторону, сумму) с открытыми или сматченными ставками."""
+    return await q_fetch("fight_pool", fight_id, conn=conn, stale_ok=stale_ok)
+
+
+async def list_my_deals(user_id: int, stale_ok: bool = True) -> List[Mapping[str, Any]]:
+    return await q_fetch("deals_my", user_id, stale_ok=stale_ok)
+
+
+async def list_my_active_deals(user_id: int, stale_ok: bool = False) -> List[Mapping[str, Any]]:
+    """
+    Ставки пользователя по ещё не закончившимся боям (экран «Текущие ставки»).
+    По умолчанию с primary: сразу после оплаты юзер должен видеть свою ставку.
+    """
+    return await q_fetch("deals_my_active", user_id, stale_ok=stale_ok)
+
+
+async def list_shareable_deals(user_id: int, stale_ok: bool = False) -> List[Mapping[str, Any]]:
+    return await q_fetch("deals_shareable", user_id, stale_ok=stale_ok)
+
+
+async def get_deal_card(deal_id: int, stale_ok: bool = False) -> Optional[Mapping[str, Any]]:
+    """
+    Сделка + поля боя для карточки (reply / share / inline).
+    Перед выставлением счёта статус читаем с primary (stale_ok=False),
+    иначе можно взять деньги за уже сматченную ставку.
+    """
+    return await q_fetchrow("deal_card", deal_id, stale_ok=stale_ok)
 
 # --- AUTO CHECK (универсально для обычных и inline-сообщений) ---
 
 # == invoices wait ==
-import json
+async def add_invoice_wait(
+    invoice_id: int,
+    kind: str,
+    user_id: int,
+    side: int,
+    amount_cents: int,
+    fight_id: Optional[int] = None,
+    deal_id: Optional[int] = None,
+    ttl_s: Optional[float] = None,
+    asset: Optional[str] = None,
+    asset_amount: Optional[Decimal] = None,
+) -> None:
+    """
+    kind=NEW — ставка на бой fight_id, kind=MATCH — ответ на сделку deal_id.
+    amount_cents — в расчётном активе; asset/asset_amount — чем и сколько выставлено в счёте.
+    """
+    await q_execute("invoice_wait_add", invoice_id, kind, user_id, fight_id, deal_id, side, amount_cents, ttl_s,
+                    asset, asset_amount)
+
+
+async def pending_invoice_ids(shards: int = 1, owned: Optional[List[int]] = None) -> List[int]:
+    """
+    Ждущие оплаты счета; с шардированием — только из шардов owned (invoice_id % shards).
+    Просроченные по expires_at ещё INVOICE_EXPIRE_GRACE_S в выборке — последний опрос.
+    """
+    if owned is None:
+        owned = list(range(shards))
+    rows = await q_fetch("invoice_wait_pending", shards, owned, settings.INVOICE_EXPIRE_GRACE_S)
+    return [int(r["invoice_id"]) for r in rows]
+
+
+async def restore_invoice_wait(
+    invoice_id: int,
+    payload: str,
+    asset: Optional[str] = None,
+    asset_amount: Optional[Decimal] = None,
+) -> None:
+    """Сверка: запись invoice_wait оплаченного счёта пропала — восстанавливаем из его payload."""
+    await q_execute("invoice_wait_restore", invoice_id, payload, asset, asset_amount)
+
+
+INVOICE_WAIT_PURGE_BATCH = 1000   # expired-строк, удаляемых за один вызов expire_invoice_waits
+
+
+async def expire_invoice_waits(
+    invoice_ids: Optional[List[int]] = None,
+    by_time: bool = True,
+    grace_s: Optional[float] = None,
+) -> None:
+    """
+    Просроченные больше не опрашиваем: invoice_ids (истекли в Crypto Pay) и, если by_time,
+    все с expires_at старше grace_s (INVOICE_EXPIRE_GRACE_S) — поллер успел их опросить
+    в последний раз. by_time=False — опроса не было (breaker open), по времени не трогаем.
+    expired старше INVOICE_WAIT_RETENTION_H удаляются.
+    """
+    grace_s = settings.INVOICE_EXPIRE_GRACE_S if grace_s is None else grace_s
+    await q_execute("invoice_wait_expire", invoice_ids or [], settings.INVOICE_WAIT_RETENTION_H,
+                    INVOICE_WAIT_PURGE_BATCH, by_time, grace_s)
+
+
+async def finalize_invoice(invoice_id: int) -> Optional[Tuple[Mapping[str, Any], Optional[int]]]:
+    """
+    Оплаченный счёт -> сделка, одной транзакцией: DELETE ... RETURNING забирает
+    запись invoice_wait, её колонки сразу идут в создание/матч сделки.
+    Возвращает (запись, id сделки) или None, если счёт уже обработан.
+    """
+    async with acquire() as conn:
+        async with conn.transaction():
+            w = await q_fetchrow("invoice_wait_claim", invoice_id, conn=conn)
+            if w is None:
+                return None
+            if w["kind"] == "MATCH":
+                deal_id = await _match_deal(conn, int(w["deal_id"]), int(w["side"]), int(w["amount_cents"]),
+                                            invoice_id, int(w["user_id"]))
+            else:
+                deal_id = await _create_deal(conn, int(w["fight_id"]), int(w["side"]), int(w["amount_cents"]),
+                                             invoice_id, int(w["user_id"]))
+            return w, deal_id
+
+
+# ===== telegram file_id cache =====
+async def get_file_id(url: str) -> Optional[str]:
+    return await q_fetchval("file_id_get", url, stale_ok=True)
+
 
-async def add_invoice_wait(invoice_id: int, kind: str, payload: dict) -> None:
-    await execute(
-        "INSERT INTO invoice_wait(invoice_id, kind, payload) VALUES($1,$2,$3) "
-        "ON CONFLICT (invoice_id) DO UPDATE SET kind=EXCLUDED.kind, payload=EXCLUDED.payload",
-        invoice_id, kind, json.dumps(payload, ensure_ascii=False)
+async def put_file_id(url: str, file_id: str) -> None:
+    await q_execute("file_id_put", url, file_id)
+
+
+async def forget_file_ids(urls: List[str]) -> None:
+    if urls:
+        await q_execute("file_id_forget", list(urls))
+
+
+# ===== ledger =====
+async def post_ledger(
+    conn: asyncpg.Connection,
+    txn_ref: str,
+    legs: List[Tuple[str, str, Optional[int], int]],
+    deal_id: Optional[int] = None,
+) -> bool:
+    """
+    Проводка из нескольких ног (kind, account, user_id, amount_cents), сумма = 0.
+    Идемпотентна по txn_ref: повтор вернёт False и ничего не запишет.
+    Ноги счёта user попадают в balance_pending и доезжают до снапшота пачкой.
+    """
+    if sum(l[3] for l in legs) != 0:
+        raise ValueError(f"unbalanced ledger txn {txn_ref}: {legs}")
+    n = await q_fetchval(
+        "ledger_post",
+        txn_ref,
+        [l[0] for l in legs], [l[1] for l in legs], [l[2] for l in legs], [l[3] for l in legs],
+        deal_id,
+        conn=conn,
     )
+    return bool(n)
 
 
-async def get_invoice_wait(invoice_id: int) -> Optional[Mapping[str, Any]]:
-    return await fetchrow("SELECT * FROM invoice_wait WHERE invoice_id=$1", invoice_id)
+def legs_deposit(user_id: int, cents: int) -> List[Tuple[str, str, Optional[int], int]]:
+    return [("deposit", "cryptopay", None, -cents), ("deposit", "user", user_id, cents)]
 
 
-async def del_invoice_wait(invoice_id: int) -> None:
-    await execute("DELETE FROM invoice_wait WHERE invoice_id=$1", invoice_id)
+def legs_stake(user_id: int, cents: int) -> List[Tuple[str, str, Optional[int], int]]:
+    return [("stake_lock", "user", user_id, -cents), ("stake_lock", "escrow", None, cents)]
 
 
-async def pending_invoice_ids() -> List[int]:
-    rows = await fetch("SELECT invoice_id FROM invoice_wait ORDER BY created_at")
-    return [int(r["invoice_id"]) for r in rows]
+def legs_payout(user_id: int, payout_cents: int, fee_cents: int) -> List[Tuple[str, str, Optional[int], int]]:
+    return [
+        ("payout", "escrow", None, -(payout_cents + fee_cents)),
+        ("payout", "user", user_id, payout_cents),
+        ("fee", "house", None, fee_cents),
+    ]
+
+
+def legs_refund(user_id: int, cents: int) -> List[Tuple[str, str, Optional[int], int]]:
+    return [("refund", "escrow", None, -cents), ("refund", "user", user_id, cents)]
+
+
+def legs_withdrawal(user_id: int, cents: int) -> List[Tuple[str, str, Optional[int], int]]:
+    return [("withdrawal", "user", user_id, -cents), ("withdrawal", "cryptopay", None, cents)]
+
+
+def legs_hold_withdrawal(user_id: int, cents: int) -> List[Tuple[str, str, Optional[int], int]]:
+    """Выплата расчёта ушла переводом: со счёта hold (в баланс она не попадала)."""
+    return [("withdrawal", "hold", user_id, -cents), ("withdrawal", "cryptopay", None, cents)]
+
+
+def legs_hold_release(user_id: int, cents: int) -> List[Tuple[str, str, Optional[int], int]]:
+    """Перевод выплаты окончательно отклонён — с hold на баланс."""
+    return [("withdrawal", "hold", user_id, -cents), ("withdrawal", "user", user_id, cents)]
+
+
+async def get_balance(user_id: int) -> int:
+    """Доступный баланс: снапшот + ещё не материализованные ноги (O(1) + горстка pending)."""
+    return int(await q_fetchval("balance_get", user_id) or 0)
+
+
+async def _lock_balance(conn: asyncpg.Connection, user_id: int) -> int:
+    """Внутри транзакции: блокирует строку пользователя и возвращает точный баланс."""
+    snap = await q_fetchval("balance_lock", user_id, conn=conn)
+    pending = await q_fetchval("balance_pending_sum", user_id, conn=conn)
+    return int(snap or 0) + int(pending or 0)
+
+
+async def materialize_balances(batch: int = 5000) -> int:
+    """Переносит до batch pending-ног в app_user.balance_cents. Возвращает число ног."""
+    async with acquire() as conn:
+        async with conn.transaction():
+            return int(await q_fetchval("balance_materialize", batch, conn=conn) or 0)
+
+
+async def reserve_withdrawal(user_id: int, txn_ref: str) -> int:
+    """
+    Списывает весь доступный баланс под вывод (до перевода в Crypto Pay).
+    Возвращает сумму или 0, если выводить нечего.
+    """
+    async with acquire() as conn:
+        async with conn.transaction():
+            available = await _lock_balance(conn, user_id)
+            if available <= 0:
+                return 0
+            await post_ledger(conn, txn_ref, legs_withdrawal(user_id, available))
+            return available
+
+
+async def cancel_withdrawal(user_id: int, txn_ref: str, cents: int) -> None:
+    """Перевод не прошёл — возвращаем деньги на баланс обратной проводкой."""
+    async with acquire() as conn:
+        async with conn.transaction():
+            await post_ledger(conn, f"{txn_ref}:reversal", [
+                ("withdrawal", "cryptopay", None, -cents), ("withdrawal", "user", user_id, cents),
+            ])
 
 
 # == create/match after paid ==
-async def create_deal_after_paid(payload: Dict[str, Any], invoice_id: int, user_id: int) -> None:
+async def _pool_add(conn: asyncpg.Connection, fight_id: int, deltas: List[Tuple[int, int, int, int]]) -> None:
     """
-    Платёж первой стороны прошёл.
-    payload: { fight_id, participant, amount_cents, tg_user_id }
+    Дельты fight_pool: (сторона, сумма, открытых, сматченных). Строки в порядке
+    ключа — встречные ставки одного боя блокируют их в одном порядке, без дедлоков.
+    """
+    acc: Dict[Tuple[int, int], Tuple[int, int]] = {}
+    for side, amount, opened, matched in deltas:
+        o, m = acc.get((side, amount), (0, 0))
+        acc[(side, amount)] = (o + opened, m + matched)
+    keys = sorted(acc)
+    await q_execute(
+        "pool_add", fight_id,
+        [k[0] for k in keys], [k[1] for k in keys],
+        [acc[k][0] for k in keys], [acc[k][1] for k in keys], [acc[k][1] * k[1] for k in keys],
+        conn=conn,
+    )
+
+
+def _pool_match(open_side: int, open_cents: int, side: int, amount_cents: int) -> List[Tuple[int, int, int, int]]:
+    """Ответ на открытую ставку: она уходит из книги, обе стороны — в сматченные."""
+    return [(open_side, open_cents, -1, 1), (side, amount_cents, 0, 1)]
+
+
+async def _create_deal(
+    conn: asyncpg.Connection,
+    fight_id: int,
+    side: int,
+    amount_cents: int,
+    invoice_id: Optional[int],
+    user_id: int,
+) -> Optional[int]:
+    """
+    Платёж первой стороны прошёл (внутри транзакции вызывающего).
     Логика:
       1) пытаемся найти встречную СУЩЕСТВУЮЩУЮ ставку (оплачена 1-й стороной, противоположная сторона, та же сумма).
          Если нашли — дописываем её как user2 (наш пользователь), статус -> matched.
       2) иначе создаём новую запись как awaiting_match.
+    invoice_id=None — ставка с баланса (без счёта); если баланса не хватает, вернёт None.
+    None и если бой уже не принимает ставки (fight_takes_bets) — оплата остаётся на балансе.
+    Возвращает id сделки.
     """
-    fight_id = int(payload["fight_id"])
-    side = int(payload["participant"])
-    amount_cents = int(payload["amount_cents"])
+    if invoice_id is None:
+        if await _lock_balance(conn, user_id) < amount_cents:
+            return None
+    elif not await post_ledger(conn, f"invoice:{invoice_id}", legs_deposit(user_id, amount_cents)):
+        # депозит по счёту уже проведён (гонка со сверкой) — второй ставки из него нет
+        return None
+    if not await fight_takes_bets(fight_id, conn=conn):
+        # бой начался, пока шла оплата — деньги остаются на балансе
+        return None
 
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            # ищем встречную открытую
-            opp = await conn.fetchrow(
-                """
-                SELECT * FROM deal
-                WHERE fight_id=$1
-                  AND paid1=TRUE
-                  AND user2_id IS NULL
-                  AND status='awaiting_match'
-                  AND participant1 = CASE WHEN $2=1 THEN 2 ELSE 1 END
-                  AND amount1_cents = $3
-                  AND user1_id <> $4
-                ORDER BY id
-                LIMIT 1
-                """,
-                fight_id, side, amount_cents, user_id,
-            )
-            if opp:
-                await conn.execute(
-                    """
-                    UPDATE deal
-                    SET user2_id=$1,
-                        participant2=$2,
-                        amount2_cents=$3,
-                        paid2=TRUE,
-                        invoice2_id=$4,
-                        status='matched'
-                    WHERE id=$5
-                    """,
-                    user_id, side, amount_cents, invoice_id, opp["id"]
-                )
-                return
-
-            # нет встречной — создаём новую как «ждёт ответ»
-            await conn.execute(
-                """
-                INSERT INTO deal (fight_id, user1_id, participant1, amount1_cents, paid1, invoice1_id, status)
-                VALUES ($1,$2,$3,$4,TRUE,$5,'awaiting_match')
-                """,
-                fight_id, user_id, side, amount_cents, invoice_id
-            )
+    # ищем встречную открытую
+    opp = await q_fetchrow("deal_find_opposite", fight_id, side, amount_cents, user_id, conn=conn)
+    if opp:
+        deal_id, leg_side = int(opp["id"]), 2
+        await q_execute("deal_fill_side2", user_id, side, amount_cents, invoice_id, deal_id, conn=conn)
+        await _pool_add(conn, fight_id, _pool_match(2 if side == 1 else 1, amount_cents, side, amount_cents))
+    else:
+        # нет встречной — создаём новую как «ждёт ответ»
+        deal_id, leg_side = int(await q_fetchval(
+            "deal_insert_open", fight_id, user_id, side, amount_cents, invoice_id, conn=conn
+        )), 1
+        await _pool_add(conn, fight_id, [(side, amount_cents, 1, 0)])
+
+    await post_ledger(conn, f"stake:{deal_id}:{leg_side}", legs_stake(user_id, amount_cents), deal_id)
+    return deal_id
 
 
-async def match_deal_after_paid(payload: Dict[str, Any], invoice_id: int, user_id: int) -> None:
+async def _match_deal(
+    conn: asyncpg.Connection,
+    deal_id: int,
+    side: int,
+    amount_cents: int,
+    invoice_id: Optional[int],
+    user_id: int,
+) -> Optional[int]:
     """
-    Ответ на конкретную ставку (вариант «Reply» из бота).
-    payload: { deal_id, participant, amount_cents, tg_user_id }
+    Ответ на конкретную ставку (вариант «Reply» из бота), внутри транзакции вызывающего.
+    Возвращает id сделки или None, если её уже сматчили или бой уже не принимает
+    ставки — тогда оплата остаётся на балансе пользователя (deposit проведён, stake — нет).
+    invoice_id=None — ответ с баланса.
     """
-    deal_id = int(payload["deal_id"])
-    side = int(payload["participant"])
-    amount_cents = int(payload["amount_cents"])
+    if invoice_id is None:
+        if await _lock_balance(conn, user_id) < amount_cents:
+            return None
+    elif not await post_ledger(conn, f"invoice:{invoice_id}", legs_deposit(user_id, amount_cents)):
+        # депозит по счёту уже проведён (гонка со сверкой) — второй ставки из него нет
+        return None
+    if not await fight_takes_bets(deal_id=deal_id, conn=conn):
+        return None
 
-    await execute(
-        """
-        UPDATE deal
-        SET user2_id=$1,
-            participant2=$2,
-            amount2_cents=$3,
-            paid2=TRUE,
-            invoice2_id=$4,
-            status='matched'
-        WHERE id=$5
-          AND status='awaiting_match'
-          AND user2_id IS NULL
-        """,
-        user_id, side, amount_cents, invoice_id, deal_id
-    )
+    matched = await q_fetchrow("deal_match", user_id, side, amount_cents, invoice_id, deal_id, conn=conn)
+    if not matched:
+        return None
+    await _pool_add(conn, int(matched["fight_id"]), _pool_match(
+        int(matched["participant1"]), int(matched["amount1_cents"]), side, amount_cents))
+    await post_ledger(conn, f"stake:{deal_id}:2", legs_stake(user_id, amount_cents), deal_id)
+    return int(matched["id"])
+
+
+async def create_deal_after_paid(
+    fight_id: int,
+    side: int,
+    amount_cents: int,
+    invoice_id: Optional[int],
+    user_id: int,
+) -> Optional[int]:
+    async with acquire() as conn:
+        async with conn.transaction():
+            return await _create_deal(conn, fight_id, side, amount_cents, invoice_id, user_id)
+
+
+async def match_deal_after_paid(
+    deal_id: int,
+    side: int,
+    amount_cents: int,
+    invoice_id: Optional[int],
+    user_id: int,
+) -> Optional[int]:
+    async with acquire() as conn:
+        async with conn.transaction():
+            return await _match_deal(conn, deal_id, side, amount_cents, invoice_id, user_id)
 
 
 # ===== CLI: init db =====
@@ -341,7 +1349,9 @@ async def list_deals_to_settle(limit: int = 100) -> List[Mapping[str, Any]]:
     """
     return await fetch(
         """
-        SELECT d.*, f.winner_participant, f.title, f.participant1_name, f.participant2_name
+        SELECT d.id, d.user1_id, d.user2_id, d.participant1, d.participant2,
+               d.amount1_cents, d.amount2_cents, d.invoice1_id, d.invoice2_id,
+               f.winner_participant, f.title, f.participant1_name, f.participant2_name
         FROM deal d
         JOIN fight f ON f.id=d.fight_id
         WHERE f.status='done'
@@ -357,8 +1367,6 @@ def main_cli():
     parser.add_argument("--init", action="store_true")
     args = parser.parse_args()
 
-    import asyncio
-
     async def _run():
         if args.init:
             await init_db()
@@ -14,7 +14,6 @@ from app.config import settings
 # ======================
 # BOT
 # ======================
-bot = Bot(settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
 # ======================
@@ -196,6 +195,7 @@ async def cb_toggle(cq: CallbackQuery):
 # ENTRYPOINT
 # ======================
 async def main():
+    bot = Bot(settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
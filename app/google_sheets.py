@@ -1,10 +1,12 @@
-import gspread
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+from datetime import datetime, tzinfo
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
 from pathlib import Path
 
 from .config import settings
 
+HEADERS = ["external_id", "title", "p1", "p2", "photo_url", "starts_at", "status", "description", "winner"]
+STATUSES = {"upcoming", "today", "live", "done"}
+
 
 def _client():
     json_path = Path(settings.GSHEET_CREDENTIALS_JSON)
@@ -12,6 +14,7 @@ def _client():
         json_path = Path.cwd() / json_path
     if not json_path.exists():
         raise RuntimeError(f"GSHEET_CREDENTIALS_JSON not found: {json_path}")
+    import gspread   # тяжёлый (google-auth, requests) — только когда реально идём в Sheets
     gc = gspread.service_account(filename=str(json_path))
     return gc
 
@@ -25,39 +28,177 @@ def _ws():
         # fallback: первый лист
         return sh.sheet1
 
-def _parse_dt(s: str) -> Optional[datetime]:
-    s = (s or "").strip()
-    if not s:
-        return None
-    # 2025-09-10 20:00 or 2025-09-10
-    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+
+class FightRow:
+    """Строка листа после нормализации; record() — кортеж в порядке COPY_COLUMNS."""
+    __slots__ = ("external_id", "title", "p1", "p2", "photo_url", "starts_at", "status", "description", "winner")
+
+    COPY_COLUMNS = ("external_id", "title", "participant1_name", "participant2_name",
+                    "photo_url", "description", "starts_at", "status", "winner_participant")
+
+    def __init__(self, external_id: str, title: str, p1: str, p2: str, photo_url: Optional[str],
+                 starts_at: Optional[datetime], status: str, description: Optional[str], winner: Optional[int]):
+        self.external_id = external_id
+        self.title = title
+        self.p1 = p1
+        self.p2 = p2
+        self.photo_url = photo_url
+        self.starts_at = starts_at
+        self.status = status
+        self.description = description
+        self.winner = winner
+
+    def record(self) -> Tuple:
+        return (self.external_id, self.title, self.p1, self.p2, self.photo_url,
+                self.description, self.starts_at, self.status, self.winner)
+
+
+class RowError(NamedTuple):
+    row: int        # номер строки в листе (заголовок — 1)
+    field: str
+    value: str
+    message: str
+
+
+# ===== даты =====
+
+# запасные форматы, если не ISO (fromisoformat) — формат угадывается один раз на «форму» строки
+_DT_FORMATS = ("%d.%m.%Y %H:%M", "%d.%m.%Y", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%Y/%m/%d %H:%M", "%Y/%m/%d")
+_fmt_by_shape: Dict[str, str] = {}
+
+
+def _shape(s: str) -> str:
+    # «2025-09-10 20:00» -> «9-9-9 9:9»: одинаковые формы парсятся одним форматом
+    out = []
+    prev_digit = False
+    for ch in s:
+        d = ch.isdigit()
+        if not (d and prev_digit):
+            out.append("9" if d else ch)
+        prev_digit = d
+    return "".join(out)
+
+
+def _strptime_cached(s: str) -> datetime:
+    # в кеш — только формат, который реально распарсил значение: битая ячейка
+    # («32.01.2025») не должна ломать все следующие значения той же формы
+    key = _shape(s)
+    cached = _fmt_by_shape.get(key)
+    for fmt in ((cached,) if cached else ()) + tuple(f for f in _DT_FORMATS if f != cached):
         try:
-            return datetime.strptime(s, fmt)
-        except Exception:
-            pass
-    return None
+            dt = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        _fmt_by_shape[key] = fmt
+        return dt
+    raise ValueError("unknown date format")
+
+
+def _tz() -> tzinfo:
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(settings.GSHEET_TZ)
+
+
+def parse_dt_column(col: Sequence[str], tz: tzinfo) -> Tuple[List[Optional[datetime]], Dict[int, str]]:
+    """
+    Колонка строк -> datetime (aware). Каждое уникальное значение парсится один
+    раз. Возвращает (значения, {индекс: текст ошибки}); пустые ячейки -> None.
+    """
+    seen: Dict[str, object] = {}
+    out: List[Optional[datetime]] = []
+    errors: Dict[int, str] = {}
+    for i, s in enumerate(col):
+        if not s:
+            out.append(None)
+            continue
+        v = seen.get(s)
+        if v is None:
+            try:
+                try:
+                    dt = datetime.fromisoformat(s)
+                except ValueError:
+                    dt = _strptime_cached(s)
+                v = dt if dt.tzinfo else dt.replace(tzinfo=tz)
+            except ValueError as e:
+                v = e
+            seen[s] = v
+        if isinstance(v, datetime):
+            out.append(v)
+        else:
+            out.append(None)
+            errors[i] = str(v)
+    return out, errors
+
+
+# ===== лист -> строки =====
+
+def parse_sheet(values: List[List[str]], tz: Optional[tzinfo] = None) -> Tuple[List[FightRow], List[RowError]]:
+    """
+    get_all_values() -> (строки, ошибки). Разбор по колонкам, а не по dict на строку.
+    Строка без external_id, с неизвестным status или повтором external_id
+    пропускается; битые starts_at / winner обнуляются — всё это попадает в ошибки.
+    """
+    if not values:
+        return [], []
+    header = [h.strip().lower() for h in values[0]]
+    missing = [h for h in HEADERS if h not in header]
+    if missing:
+        raise RuntimeError(f"sheet is missing columns: {', '.join(missing)}")
+    body = values[1:]
+    n = len(body)
+    tz = tz or _tz()
+
+    def column(name: str) -> List[str]:
+        i = header.index(name)
+        return [r[i].strip() if i < len(r) else "" for r in body]
+
+    ext, title, p1, p2 = column("external_id"), column("title"), column("p1"), column("p2")
+    photo, status, desc = column("photo_url"), column("status"), column("description")
+    raw_dt, raw_winner = column("starts_at"), column("winner")
+
+    starts_at, dt_errors = parse_dt_column(raw_dt, tz)
+    errors: List[RowError] = [RowError(i + 2, "starts_at", raw_dt[i], msg) for i, msg in dt_errors.items()]
+
+    rows: List[FightRow] = []
+    seen_ext = set()
+    for i in range(n):
+        row_no = i + 2
+        e = ext[i]
+        if not e:
+            if any(r for r in (title[i], p1[i], p2[i])):
+                errors.append(RowError(row_no, "external_id", "", "empty external_id, row skipped"))
+            continue
+        if e in seen_ext:
+            errors.append(RowError(row_no, "external_id", e, "duplicate external_id, row skipped"))
+            continue
+        st = status[i].lower() or "upcoming"
+        if st not in STATUSES:
+            errors.append(RowError(row_no, "status", status[i], "unknown status, row skipped"))
+            continue
+        w = raw_winner[i]
+        winner: Optional[int] = None
+        if w:
+            if w in ("0", "1", "2"):
+                winner = int(w)
+            else:
+                errors.append(RowError(row_no, "winner", w, "winner must be 1, 2 or 0 (void), ignored"))
+        seen_ext.add(e)
+        rows.append(FightRow(e, title[i], p1[i], p2[i], photo[i] or None,
+                             starts_at[i], st, desc[i] or None, winner))
+    errors.sort(key=lambda x: x.row)
+    return rows, errors
+
 
-def fetch_fights_from_sheet() -> List[Dict[str, Any]]:
+def fetch_fights_from_sheet(on_error: Optional[Callable[[RowError], None]] = None) -> List[FightRow]:
     """
     Ожидаемые заголовки (в верхней строке):
       external_id | title | p1 | p2 | photo_url | starts_at | status | description | winner
+    Ошибки по строкам печатаются (или уходят в on_error).
     """
-    ws = _ws()
-    rows = ws.get_all_records(expected_headers=[
-        "external_id", "title", "p1", "p2", "photo_url", "starts_at", "status", "description", "winner"
-    ])
-
-    items: List[Dict[str, Any]] = []
-    for r in rows:
-        items.append({
-            "external_id": str(r.get("external_id") or "").strip() or None,
-            "title": (r.get("title") or "").strip(),
-            "p1": (r.get("p1") or "").strip(),
-            "p2": (r.get("p2") or "").strip(),
-            "photo_url": (r.get("photo_url") or "").strip() or None,
-            "starts_at": _parse_dt(r.get("starts_at") or ""),
-            "status": (r.get("status") or "upcoming").strip().lower(),
-            "description": (r.get("description") or "").strip() or None,
-            "winner": int(r.get("winner") or 0) if str(r.get("winner") or "").strip().isdigit() else None,
-        })
-    return items
\ No newline at end of file
+    rows, errors = parse_sheet(_ws().get_all_values())
+    for err in errors:
+        if on_error is not None:
+            on_error(err)
+        else:
+            print(f"[SHEET] row {err.row} {err.field}={err.value!r}: {err.message}")
+    return rows
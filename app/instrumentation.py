@@ -0,0 +1,79 @@
+# app/instrumentation.py
+"""
+aiogram-часть метрик: латентность хендлеров (по префиксу callback_data)
+и исходящих запросов к Telegram Bot API (включая flood-wait).
+"""
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.types import CallbackQuery, InlineQuery, Message, TelegramObject
+
+from . import metrics
+
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Update handler latency", ["handler"])
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Update handlers that raised", ["handler"])
+TG_SECONDS = metrics.histogram("telegram_request_seconds", "Telegram Bot API latency", ["method"])
+TG_ERRORS = metrics.counter("telegram_errors_total", "Failed Telegram Bot API calls", ["method"])
+TG_FLOOD_WAITS = metrics.counter("telegram_flood_waits_total", "429 Too Many Requests from Telegram", ["method"])
+TG_FLOOD_WAIT_SECONDS = metrics.counter("telegram_flood_wait_seconds_total", "Sum of retry_after from Telegram", ["method"])
+
+
+def handler_label(event: TelegramObject) -> str:
+    """fight:12 -> cb:fight, /start -> msg:/start, inline -> inline."""
+    if isinstance(event, CallbackQuery):
+        return "cb:" + (event.data or "").split(":", 1)[0]
+    if isinstance(event, Message):
+        text = event.text or ""
+        return "msg:" + text.split(maxsplit=1)[0].split("@", 1)[0] if text.startswith("/") else "msg"
+    if isinstance(event, InlineQuery):
+        return "inline"
+    return type(event).__name__
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        label = handler_label(event)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, handler=label)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        name = method.__api_method__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            TG_FLOOD_WAITS.inc(method=name)
+            TG_FLOOD_WAIT_SECONDS.inc(e.retry_after, method=name)
+            raise
+        except Exception:
+            TG_ERRORS.inc(method=name)
+            raise
+        finally:
+            TG_SECONDS.observe(time.perf_counter() - t0, method=name)
+
+
+def instrument_bot(bot: Bot) -> Bot:
+    bot.session.middleware(TelegramRequestMetrics())
+    return bot
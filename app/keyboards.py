@@ -0,0 +1,171 @@
+# app/keyboards.py
+"""
+Клавиатуры бота. Сборка pydantic-моделей — заметная доля CPU хендлера, поэтому:
+  статичные меню собраны один раз при импорте;
+  параметризованные (бой/сторона/сделка) — memo через lru_cache;
+  повторяющиеся кнопки («⬅️ В меню» и т.п.) — общие экземпляры.
+Готовые клавиатуры общие для всех апдейтов — после сборки их не мутируем.
+
+    python -m bench.bench_keyboards   # CPU на сборку и на апдейт: до/после
+"""
+from functools import lru_cache
+from typing import Any, List, Mapping, Tuple
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from .config import settings
+
+BTN_BACK_MAIN = InlineKeyboardButton(text="⬅️ В меню", callback_data="back_main")
+BTN_TO_EVENTS = InlineKeyboardButton(text="⬅️ К событиям", callback_data="events")
+
+KB_MAIN = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📅 События", callback_data="events")],
+    [InlineKeyboardButton(text="🎟 Текущие ставки", callback_data="mybets")],
+    [InlineKeyboardButton(text="📤 Поделиться ставкой", callback_data="share")],
+    [InlineKeyboardButton(text="💰 Баланс", callback_data="balance")],
+])
+
+
+def kb_main() -> InlineKeyboardMarkup:
+    return KB_MAIN
+
+
+def kb_fights_list(items: List[Mapping[str, Any]]) -> InlineKeyboardMarkup:
+    return _kb_fights_list(tuple((f["id"], f["participant1_name"], f["participant2_name"]) for f in items))
+
+
+@lru_cache(maxsize=64)
+def _kb_fights_list(fights: Tuple[Tuple[int, str, str], ...]) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=f"{p1} vs {p2}", callback_data=f"fight:{fid}")] for fid, p1, p2 in fights]
+    rows.append([BTN_BACK_MAIN])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@lru_cache(maxsize=4096)
+def kb_reply_link(deal_id: int, bot_username: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text="🤝 Ответить на ставку",
+            url=f"https://t.me/{bot_username}?start=reply_{deal_id}"
+        )]
+    ])
+
+
+def kb_fight(f: Mapping[str, Any], bets_open: bool = True) -> InlineKeyboardMarkup:
+    return _kb_fight(f["id"], f["participant1_name"], f["participant2_name"], bets_open)
+
+
+@lru_cache(maxsize=1024)
+def _kb_fight(fid: int, p1: str, p2: str, bets_open: bool = True) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text=f"Поставить на {p1}", callback_data=f"bet_side:{fid}:1")],
+        [InlineKeyboardButton(text=f"Поставить на {p2}", callback_data=f"bet_side:{fid}:2")],
+        [InlineKeyboardButton(text="📜 Открытые ставки", callback_data=f"open:{fid}")],
+    ] if bets_open else []
+    rows.append([BTN_TO_EVENTS])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@lru_cache(maxsize=1024)
+def kb_open_empty(fid: int, p1: str, p2: str) -> InlineKeyboardMarkup:
+    """«Открытых ставок нет» — сразу предложить поставить самому."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"Поставить на {p1}", callback_data=f"bet_side:{fid}:1")],
+        [InlineKeyboardButton(text=f"Поставить на {p2}", callback_data=f"bet_side:{fid}:2")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fid}")],
+    ])
+
+
+@lru_cache(maxsize=1)
+def stake_amounts() -> Tuple[int, ...]:
+    """Суммы ставок на кнопках (settings.STAKE_AMOUNTS), в расчётном активе."""
+    return tuple(int(x) for x in settings.STAKE_AMOUNTS.split(",") if x.strip())
+
+
+@lru_cache(maxsize=2048)
+def kb_amounts(fid: int, side: int) -> InlineKeyboardMarkup:
+    unit = settings.CRYPTO_DEFAULT_ASSET
+    buttons = [
+        InlineKeyboardButton(text=f"{amt} {unit}", callback_data=f"bet_amt:{fid}:{side}:{amt}")
+        for amt in stake_amounts()
+    ]
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fid}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def kb_open_deals(fight_id: int, deals: List[Mapping[str, Any]]) -> InlineKeyboardMarkup:
+    return _kb_open_deals(fight_id, tuple((d["id"], d["participant1"], d["amount1_cents"]) for d in deals[:20]))
+
+
+@lru_cache(maxsize=1024)
+def _kb_open_deals(fight_id: int, deals: Tuple[Tuple[int, int, int], ...]) -> InlineKeyboardMarkup:
+    rows = []
+    for deal_id, side, cents in deals:
+        rows.append([InlineKeyboardButton(
+            text=f"Ответить: {cents / 100:.2f} {settings.CRYPTO_DEFAULT_ASSET} (на {'P2' if side==1 else 'P1'})",
+            callback_data=f"reply:{deal_id}"
+        )])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fight_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@lru_cache(maxsize=4096)
+def kb_pay_assets(data_prefix: str, assets: Tuple[str, ...], back: str) -> InlineKeyboardMarkup:
+    """Выбор актива оплаты: callback_data = f"{data_prefix}:{asset}"."""
+    buttons = [InlineKeyboardButton(text=a, callback_data=f"{data_prefix}:{a}") for a in assets]
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=back)])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def kb_pay(url: str) -> InlineKeyboardMarkup:
+    # url уникален для счёта — кешировать нечего, общая только кнопка «В меню»
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💳 Оплатить в Mini App", url=url)],
+        [BTN_BACK_MAIN],
+    ])
+
+
+@lru_cache(maxsize=4096)
+def kb_reply_one(deal_id: int, label: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=f"reply:{deal_id}")],
+    ])
+
+
+@lru_cache(maxsize=4096)
+def kb_share_pick_chat(deal_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📤 Отправить другу", switch_inline_query=f"reply_{deal_id}")],
+        [BTN_BACK_MAIN],
+    ])
+
+
+# ===== админка (результаты боёв) — редкие экраны, не кешируем =====
+
+def kb_admin_fights(items: List[Mapping[str, Any]]) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text=f"{f['participant1_name']} vs {f['participant2_name']}",
+                              callback_data=f"adm_fight:{f['id']}")]
+        for f in items
+    ]
+    rows.append([BTN_BACK_MAIN])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def kb_admin_fight(f: Mapping[str, Any]) -> InlineKeyboardMarkup:
+    fid = f["id"]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"🏆 {f['participant1_name']}", callback_data=f"adm_set:{fid}:1")],
+        [InlineKeyboardButton(text=f"🏆 {f['participant2_name']}", callback_data=f"adm_set:{fid}:2")],
+        [InlineKeyboardButton(text="↩️ Отменить бой (возврат всем)", callback_data=f"adm_set:{fid}:0")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="adm_list")],
+    ])
+
+
+def kb_admin_confirm(fid: int, winner: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"adm_ok:{fid}:{winner}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"adm_fight:{fid}")],
+    ])
@@ -0,0 +1,100 @@
+# app/leases.py
+"""
+Координация реплик через advisory locks Postgres.
+
+Работа (например, опрос счетов) делится на `shards` шардов; шард s принадлежит
+тому, кто держит pg_advisory_lock(key, s). Каждая живая реплика дополнительно
+держит «членский» лок (member_key, slot) — по ним считаем живых и берём
+честную долю ceil(shards / живых). shards=1 — обычный выбор лидера.
+
+Локи session-level, на отдельном соединении (db.connect, не из пула): реплика
+умерла или потеряла связь с БД — Postgres сам снимает её локи, остальные
+забирают шарды на следующем refresh(). Сама реплика при ошибке соединения
+сразу считает, что ничем не владеет. За pgbouncer в transaction mode не работает —
+нужен прямой коннект к Postgres.
+
+    lease = ShardLease("payments", shards=8)
+    owned = await lease.refresh()      # раз в тик; [] — сейчас не наша очередь
+"""
+import zlib
+from typing import List, Optional, Set
+
+import asyncpg
+
+from . import db, metrics
+
+LEASE_SHARDS = metrics.gauge("lease_shards_owned", "Shards held by this replica", ["lease"])
+LEASE_MEMBERS = metrics.gauge("lease_members", "Live replicas competing for the lease", ["lease"])
+LEASE_LOST = metrics.counter("lease_lost_total", "Lease connection failures (all shards dropped)", ["lease"])
+
+MAX_MEMBERS = 64
+
+# локи с двумя int4-ключами видны в pg_locks как classid/objid, objsubid=2
+SQL_MEMBERS = """
+SELECT count(*) FROM pg_locks
+WHERE locktype='advisory' AND objsubid=2 AND granted
+  AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+  AND classid::bigint = $1
+"""
+
+_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError)
+
+
+def _key(name: str) -> int:
+    # стабильный между процессами int4 > 0 (hash() рандомизирован)
+    return zlib.crc32(name.encode()) & 0x7FFFFFFF
+
+
+class ShardLease:
+    def __init__(self, name: str, shards: int = 1):
+        self.name = name
+        self.shards = max(1, shards)
+        self.key = _key(name)
+        self.member_key = _key(name + ":member")
+        self.owned: Set[int] = set()
+        self._conn: Optional[asyncpg.Connection] = None
+
+    async def _join(self) -> None:
+        self._conn = await db.connect()
+        for slot in range(MAX_MEMBERS):
+            if await self._conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", self.member_key, slot):
+                return
+        raise RuntimeError(f"lease {self.name}: more than {MAX_MEMBERS} replicas")
+
+    async def refresh(self) -> List[int]:
+        """Добрать/отдать шарды до честной доли. Возвращает свои шарды (отсортированы)."""
+        try:
+            if self._conn is None or self._conn.is_closed():
+                self.owned.clear()
+                await self._join()
+            conn = self._conn
+            members = max(1, await conn.fetchval(SQL_MEMBERS, self.member_key))
+            share = -(-self.shards // members)
+
+            # пришла новая реплика — отдаём лишнее, она подберёт на своём тике
+            for s in sorted(self.owned, reverse=True)[:max(0, len(self.owned) - share)]:
+                await conn.fetchval("SELECT pg_advisory_unlock($1, $2)", self.key, s)
+                self.owned.discard(s)
+            for s in range(self.shards):
+                if len(self.owned) >= share:
+                    break
+                if s not in self.owned and await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", self.key, s):
+                    self.owned.add(s)
+            LEASE_MEMBERS.set(members, lease=self.name)
+        except _ERRORS as e:
+            # без соединения локов у нас уже нет (или скоро не будет) — ничего не делаем
+            print(f"[LEASE] {self.name}: connection lost, dropping {len(self.owned)} shard(s): {e!r}")
+            LEASE_LOST.inc(lease=self.name)
+            await self.release()
+        LEASE_SHARDS.set(len(self.owned), lease=self.name)
+        return sorted(self.owned)
+
+    async def release(self) -> None:
+        """Закрыть соединение — Postgres снимает все локи этой реплики."""
+        conn, self._conn = self._conn, None
+        self.owned.clear()
+        if conn is not None and not conn.is_closed():
+            try:
+                await conn.close(timeout=5)
+            except _ERRORS:
+                conn.terminate()
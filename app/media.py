@@ -0,0 +1,131 @@
+# app/media.py
+"""
+Картинки по URL -> Telegram file_id.
+
+Первая отправка идёт по URL (Telegram сам скачивает картинку), file_id из
+ответа запоминается в памяти процесса и в tg_file_cache — дальше шлём по
+file_id без похода к источнику. Если file_id протух, один раз пробуем по URL.
+sync_fights чистит записи, когда у боя меняется photo_url.
+
+«Та же ли картинка в сообщении» сравниваем по file_unique_id (file_id у одной
+и той же картинки бывает разным от отправки к отправке) — он запоминается в
+памяти процесса при каждой отправке/правке.
+"""
+from typing import Dict, Optional, Union
+
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    InlineKeyboardMarkup, InlineQueryResultCachedPhoto, InlineQueryResultPhoto,
+    InputMediaPhoto, Message,
+)
+
+from . import db, metrics
+
+FILE_CACHE = metrics.counter("tg_file_cache_total", "Photo sends by file_id cache result", ["result"])
+
+_file_ids: Dict[str, str] = {}
+_unique_ids: Dict[str, str] = {}   # url -> file_unique_id
+
+
+async def file_id_for(url: str) -> Optional[str]:
+    fid = _file_ids.get(url)
+    if fid is None:
+        try:
+            fid = await db.get_file_id(url)
+        except Exception as e:
+            print(f"[MEDIA] file_id lookup failed: {e!r}")
+            fid = None
+        if fid:
+            _file_ids[url] = fid
+    FILE_CACHE.inc(result="hit" if fid else "miss")
+    return fid
+
+
+def shows(msg: Message, url: str) -> bool:
+    """В сообщении уже картинка url (по file_unique_id; неизвестно — False)."""
+    uid = _unique_ids.get(url)
+    return uid is not None and bool(msg.photo) and msg.photo[-1].file_unique_id == uid
+
+
+async def remember(url: str, msg: Union[Message, bool, None]) -> None:
+    if not isinstance(msg, Message) or not msg.photo:
+        return
+    fid = msg.photo[-1].file_id
+    _unique_ids[url] = msg.photo[-1].file_unique_id
+    if _file_ids.get(url) == fid:
+        return
+    _file_ids[url] = fid
+    try:
+        await db.put_file_id(url, fid)
+    except Exception as e:
+        print(f"[MEDIA] file_id save failed: {e!r}")
+
+
+async def _forget(url: str) -> None:
+    _file_ids.pop(url, None)
+    _unique_ids.pop(url, None)
+    FILE_CACHE.inc(result="stale")
+    try:
+        await db.forget_file_ids([url])
+    except Exception as e:
+        print(f"[MEDIA] file_id forget failed: {e!r}")
+
+
+async def answer_photo(
+    message: Message,
+    url: str,
+    caption: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> Message:
+    fid = await file_id_for(url)
+    if fid:
+        try:
+            msg = await message.answer_photo(photo=fid, caption=caption, reply_markup=reply_markup)
+            await remember(url, msg)
+            return msg
+        except TelegramBadRequest:
+            await _forget(url)
+    msg = await message.answer_photo(photo=url, caption=caption, reply_markup=reply_markup)
+    await remember(url, msg)
+    return msg
+
+
+async def edit_photo(
+    message: Message,
+    url: str,
+    caption: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> Union[Message, bool]:
+    fid = await file_id_for(url)
+    if fid:
+        try:
+            msg = await message.edit_media(InputMediaPhoto(media=fid, caption=caption), reply_markup=reply_markup)
+            await remember(url, msg)
+            return msg
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                raise
+            await _forget(url)
+    msg = await message.edit_media(InputMediaPhoto(media=url, caption=caption), reply_markup=reply_markup)
+    await remember(url, msg)
+    return msg
+
+
+async def inline_photo(
+    result_id: str,
+    url: str,
+    caption: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> Union[InlineQueryResultCachedPhoto, InlineQueryResultPhoto]:
+    """Инлайн-ответ: по file_id, если картинку уже отправляли, иначе по URL."""
+    fid = await file_id_for(url)
+    if fid:
+        return InlineQueryResultCachedPhoto(
+            id=result_id, photo_file_id=fid, caption=caption, parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup,
+        )
+    return InlineQueryResultPhoto(
+        id=result_id, photo_url=url, thumbnail_url=url, caption=caption, parse_mode=ParseMode.HTML,
+        reply_markup=reply_markup,
+    )
@@ -0,0 +1,193 @@
+# app/metrics.py
+"""
+Минимальный Prometheus-реестр (text exposition format 0.0.4) без внешних
+зависимостей + HTTP-эндпоинт /metrics на aiohttp.
+
+    from . import metrics
+    DB_SECONDS = metrics.histogram("db_query_seconds", "...", ["statement"])
+    with DB_SECONDS.time(statement="fight_by_id"):
+        ...
+    await metrics.start_http_server(settings.METRICS_PORT)
+"""
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[str, ...]
+
+
+def _esc(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_esc(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        head = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(head + self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, doc, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, value: float = 1.0, **labels: str) -> None:
+        k = self._key(labels)
+        self._values[k] = self._values.get(k, 0.0) + value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_num(v)}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, doc, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = float(value)
+
+    def inc(self, value: float = 1.0, **labels: str) -> None:
+        k = self._key(labels)
+        self._values[k] = self._values.get(k, 0.0) + value
+
+    def dec(self, value: float = 1.0, **labels: str) -> None:
+        self.inc(-value, **labels)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_num(v)}" for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [counts по бакетам (не накопительные)..., sum, count]
+        self._values: Dict[LabelKey, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        k = self._key(labels)
+        row = self._values.get(k)
+        if row is None:
+            row = self._values[k] = [0.0] * (len(self.buckets) + 2)
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                row[i] += 1
+                break
+        row[-2] += value
+        row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self) -> List[str]:
+        out: List[str] = []
+        for k, row in self._values.items():
+            acc = 0.0
+            for i, b in enumerate(self.buckets):
+                acc += row[i]
+                le = f'le="{_fmt_num(b)}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, k, le)} {_fmt_num(acc)}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, k)} {_fmt_num(row[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, k)} {_fmt_num(row[-1])}")
+        return out
+
+
+# ===== registry =====
+
+_registry: Dict[str, _Metric] = {}
+_collectors: List[Callable[[], None]] = []
+
+
+def _register(m: _Metric) -> _Metric:
+    # повторный импорт модуля не должен плодить дубликаты
+    existing = _registry.get(m.name)
+    if existing is not None:
+        return existing
+    _registry[m.name] = m
+    return m
+
+
+def counter(name: str, doc: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, doc, labelnames))  # type: ignore[return-value]
+
+
+def gauge(name: str, doc: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return _register(Gauge(name, doc, labelnames))  # type: ignore[return-value]
+
+
+def histogram(name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, doc, labelnames, buckets))  # type: ignore[return-value]
+
+
+def add_collector(fn: Callable[[], None]) -> None:
+    """Колбэк, который обновляет gauge'и прямо перед отдачей /metrics."""
+    _collectors.append(fn)
+
+
+def render() -> str:
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception as e:
+            print(f"[METRICS] collector {fn.__name__} failed: {e!r}")
+    return "\n".join(m.render() for m in _registry.values()) + "\n"
+
+
+# ===== HTTP =====
+
+async def start_http_server(port: int, host: str = "0.0.0.0") -> Optional[object]:
+    """Поднимает /metrics в текущем event loop. port=0 — выключено."""
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def _handle(_request: "web.Request") -> "web.Response":
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", _handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"[METRICS] serving http://{host}:{port}/metrics")
+    return runner
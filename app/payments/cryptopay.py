@@ -1,31 +1,237 @@
 # app/payments/cryptopay.py
 
-import aiohttp
-from typing import Dict, Any, List
+import asyncio
+import random
+import time
+from decimal import Decimal
+from typing import Dict, Any, List, Optional
 from ..config import settings
+from .. import metrics, tracing
+from . import policy
 
 API = "https://pay.crypt.bot/api/"
+TESTNET_API = "https://testnet-pay.crypt.bot/api/"
 
-async def _post(method: str, payload: dict | None = None) -> dict:
-    headers = {"Crypto-Pay-API-Token": settings.CRYPTO_PAY_TOKEN}
-    async with aiohttp.ClientSession(headers=headers) as s:
-        async with s.post(API + method, json=payload or {}) as r:
-            data = await r.json()
+
+def _api_base() -> str:
+    if settings.CRYPTO_PAY_API_URL:
+        return settings.CRYPTO_PAY_API_URL.rstrip("/") + "/"
+    return TESTNET_API if settings.CRYPTO_NETWORK.upper() == "TEST_NET" else API
+
+CP_SECONDS = metrics.histogram("cryptopay_request_seconds", "Crypto Pay API latency", ["method"])
+CP_ERRORS = metrics.counter("cryptopay_errors_total", "Crypto Pay API failures", ["method"])
+CP_RETRIES = metrics.counter("cryptopay_retries_total", "Crypto Pay retries and hedges", ["method", "kind"])
+CP_REJECTED = metrics.counter("cryptopay_breaker_rejected_total", "Calls failed fast by the open breaker", ["method"])
+CP_BREAKER = metrics.gauge("cryptopay_breaker_state", "Crypto Pay circuit breaker: 0 closed, 1 half-open, 2 open")
+
+# сек на одну попытку; остальные методы — CRYPTO_PAY_TIMEOUT_S
+TIMEOUTS: Dict[str, float] = {
+    "getInvoices": 5.0,
+    "getExchangeRates": 5.0,
+    "createInvoice": 8.0,
+    "transfer": 20.0,
+}
+# повтор безопасен только для чтений; transfer не повторяем: после таймаута повтор
+# с тем же spend_id Crypto Pay отклонит, хотя первый перевод прошёл (см. transfer())
+IDEMPOTENT = {"getInvoices", "getTransfers", "getExchangeRates", "getBalance", "getMe"}
+# хеджируем только чтения: дубль запроса ничего не меняет
+HEDGED = {"getInvoices", "getExchangeRates"}
+
+_session: Optional[Any] = None   # aiohttp.ClientSession, создаётся при первом запросе
+_breaker: Optional[policy.CircuitBreaker] = None
+_budget: Optional[policy.RetryBudget] = None
+
+
+class CryptoPayError(RuntimeError):
+    def __init__(self, method: str, error: Any, status: Optional[int] = None):
+        super().__init__(f"CryptoPay {method} error: {error}")
+        self.method = method
+        self.error = error
+        self.status = status
+
+    @property
+    def transient(self) -> bool:
+        return self.status is None or self.status >= 500 or self.status == 429
+
+
+class CryptoPayUnavailable(CryptoPayError):
+    """Breaker открыт — запрос даже не отправлялся."""
+
+
+def breaker() -> policy.CircuitBreaker:
+    global _breaker
+    if _breaker is None:
+        _breaker = policy.CircuitBreaker(
+            settings.CRYPTO_PAY_BREAKER_FAILURES, settings.CRYPTO_PAY_BREAKER_COOLDOWN_S,
+            on_change=_breaker_changed,
+        )
+        CP_BREAKER.set(0)
+    return _breaker
+
+
+def _breaker_changed(state: str) -> None:
+    CP_BREAKER.set(policy.STATE_CODE[state])
+    print(f"[CRYPTOPAY] breaker -> {state}")
+
+
+def _retry_budget() -> policy.RetryBudget:
+    global _budget
+    if _budget is None:
+        _budget = policy.RetryBudget(settings.CRYPTO_PAY_RETRY_BUDGET)
+    return _budget
+
+
+def available() -> bool:
+    """False — Crypto Pay сейчас считается недоступным (breaker open), счёт не создаём."""
+    return breaker().available()
+
+
+def state() -> Dict[str, Any]:
+    b = breaker()
+    return {"state": b.state, "failures": b.failures, "retry_after_s": b.retry_after(),
+            "retry_tokens": _retry_budget().tokens}
+
+
+def _get_session() -> Any:
+    """Одна keep-alive сессия на event loop; aiohttp импортируется только здесь."""
+    global _session
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session._loop is not loop:
+        import aiohttp
+        _session = aiohttp.ClientSession(headers={"Crypto-Pay-API-Token": settings.CRYPTO_PAY_TOKEN})
+    return _session
+
+
+async def close() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _is_transient(e: BaseException) -> bool:
+    import aiohttp   # уже загружен сессией
+    if isinstance(e, CryptoPayError):
+        return e.transient
+    return isinstance(e, (asyncio.TimeoutError, aiohttp.ClientError, OSError))
+
+
+async def _attempt(method: str, payload: dict, timeout: float) -> Any:
+    async def call() -> Any:
+        async with _get_session().post(_api_base() + method, json=payload) as r:
+            try:
+                data = await r.json(content_type=None)
+            except ValueError:
+                raise CryptoPayError(method, f"HTTP {r.status}", r.status)
             if not isinstance(data, dict) or not data.get("ok"):
-                raise RuntimeError(f"CryptoPay API error: {data}")
+                raise CryptoPayError(method, data.get("error") if isinstance(data, dict) else data, r.status)
             return data["result"]
+    return await asyncio.wait_for(call(), timeout)
 
-async def create_invoice(amount_cents: int, asset: str, payload: str) -> dict:
-    amount = amount_cents / 100
-    res = await _post("createInvoice", {"asset": asset, "amount": amount, "payload": payload})
+
+async def _hedged(method: str, payload: dict, timeout: float) -> Any:
+    """Нет ответа за CRYPTO_PAY_HEDGE_MS — параллельно второй такой же запрос, берём первый ответ."""
+    first = asyncio.ensure_future(_attempt(method, payload, timeout))
+    done, _ = await asyncio.wait({first}, timeout=settings.CRYPTO_PAY_HEDGE_MS / 1000)
+    if done or not _retry_budget().withdraw():
+        return await first
+    CP_RETRIES.inc(method=method, kind="hedge")
+    second = asyncio.ensure_future(_attempt(method, payload, timeout))
+    pending = {first, second}
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            ok = [t for t in done if t.exception() is None]
+            if ok or not pending:
+                return (ok or list(done))[0].result()
+    finally:
+        for t in pending:
+            t.cancel()
+
+
+async def _post(method: str, payload: dict | None = None) -> Any:
+    """
+    Таймаут на попытку; транзиентные ошибки идемпотентных методов повторяются
+    с jitter-паузой, пока есть бюджет ретраев; breaker считает транзиентные
+    ошибки и при open отказывает сразу (CryptoPayUnavailable).
+    """
+    payload = payload or {}
+    br = breaker()
+    if not br.allow():
+        CP_REJECTED.inc(method=method)
+        raise CryptoPayUnavailable(method, f"circuit open, retry in {br.retry_after():.0f}s")
+    budget = _retry_budget()
+    budget.deposit()
+    timeout = TIMEOUTS.get(method, settings.CRYPTO_PAY_TIMEOUT_S)
+    hedge = method in HEDGED and settings.CRYPTO_PAY_HEDGE_MS > 0
+    retries = settings.CRYPTO_PAY_RETRIES if method in IDEMPOTENT else 0
+    t0 = time.perf_counter()
+    verdict = False   # breaker уже получил исход этого вызова
+    try:
+        with tracing.span("cryptopay." + method, child_only=True) as sp:
+            for attempt in range(retries + 1):
+                try:
+                    res = await (_hedged if hedge else _attempt)(method, payload, timeout)
+                except Exception as e:
+                    if not _is_transient(e):
+                        br.success()   # API ответил осмысленной ошибкой — сам сервис жив
+                        verdict = True
+                        raise
+                    if attempt >= retries or br.state != policy.CLOSED or not budget.withdraw():
+                        # одна ошибка на логический вызов, а не на каждую попытку
+                        br.failure()
+                        verdict = True
+                        raise
+                    CP_RETRIES.inc(method=method, kind="retry")
+                    # full jitter: 0..base*2^n, не больше 2 с
+                    await asyncio.sleep(random.uniform(0, min(2.0, 0.2 * 2 ** attempt)))
+                    continue
+                br.success()
+                verdict = True
+                if attempt:
+                    sp.set(retries=attempt)
+                return res
+    except Exception:
+        CP_ERRORS.inc(method=method)
+        raise
+    finally:
+        if not verdict:
+            # отмена (проигравший хедж, wait_for, shutdown) — исхода нет, но слот
+            # пробного запроса освобождаем, иначе half_open отказывает навсегда
+            br.release()
+        CP_SECONDS.observe(time.perf_counter() - t0, method=method)
+
+async def create_invoice(
+    amount_cents: int,
+    asset: str,
+    payload: str,
+    expires_in: Optional[int] = None,
+    asset_amount: Optional[Decimal] = None,
+) -> dict:
+    """asset_amount — точная сумма в asset (rates.quote), иначе amount_cents / 100."""
+    amount = str(asset_amount) if asset_amount is not None else amount_cents / 100
+    body: Dict[str, Any] = {"asset": asset, "amount": amount, "payload": payload}
+    if expires_in:
+        body["expires_in"] = int(expires_in)
+    res = await _post("createInvoice", body)
     # нормализуем типы
     res["invoice_id"] = int(res["invoice_id"])
     return res
 
-async def get_invoices(invoice_ids: list[int]) -> list[dict]:
-    # Crypto Pay ждёт строку с id через запятую
-    ids_csv = ",".join(str(i) for i in invoice_ids)
-    res = await _post("getInvoices", {"invoice_ids": ids_csv})
+async def get_invoices(
+    invoice_ids: Optional[list[int]] = None,
+    status: Optional[str] = None,
+    offset: int = 0,
+    count: int = 100,
+) -> list[dict]:
+    """По id — или страница списка (status, offset, count до 1000; новые первыми)."""
+    body: Dict[str, Any] = {"offset": offset, "count": count}
+    if invoice_ids is not None:
+        # Crypto Pay ждёт строку с id через запятую
+        body = {"invoice_ids": ",".join(str(i) for i in invoice_ids)}
+    if status:
+        body["status"] = status
+    res = await _post("getInvoices", body)
     # ВАЖНО: API возвращает {"items": [ {...}, {...} ]}
     items = res.get("items", []) if isinstance(res, dict) else []
     out: list[dict] = []
@@ -40,14 +246,49 @@ async def get_invoices(invoice_ids: list[int]) -> list[dict]:
             out.append(it)
     return out
 
+async def get_transfers(offset: int = 0, count: int = 100, spend_id: Optional[str] = None) -> list[dict]:
+    """Страница переводов приложения (count до 1000; новые первыми) или перевод по spend_id."""
+    body: Dict[str, Any] = {"offset": offset, "count": count}
+    if spend_id is not None:
+        body["spend_id"] = spend_id
+    res = await _post("getTransfers", body)
+    items = res.get("items", []) if isinstance(res, dict) else []
+    return [it for it in items if isinstance(it, dict)]
+
+async def find_transfer(spend_id: str) -> Optional[dict]:
+    items = await get_transfers(count=1, spend_id=spend_id)
+    return next((it for it in items if it.get("spend_id") == spend_id), None)
+
+async def get_exchange_rates() -> list[dict]:
+    res = await _post("getExchangeRates")
+    return [x for x in res if isinstance(x, dict)] if isinstance(res, list) else []
+
 async def transfer(tg_user_id: int, amount_cents: int, asset: str, spend_id: str) -> Dict[str, Any]:
+    """
+    Перевод без авто-повтора. Отказ API сверяется с getTransfers по spend_id:
+    перевод с ним уже есть (повтор после таймаута) — это успех. Транзиентная
+    ошибка (transient) значит «исход неизвестен» — отменять вывод нельзя,
+    только повторить с тем же spend_id.
+    """
     amount = str(amount_cents / 100)
-    return await _post("transfer", {
-        "user_id": str(tg_user_id),
-        "asset": asset,
-        "amount": amount,
-        "spend_id": spend_id,
-    })
+    try:
+        return await _post("transfer", {
+            "user_id": str(tg_user_id),
+            "asset": asset,
+            "amount": amount,
+            "spend_id": spend_id,
+        })
+    except CryptoPayError as e:
+        if e.transient:
+            raise
+        try:
+            done = await find_transfer(spend_id)
+        except Exception as lookup:
+            # отказ не подтверждён — для вызывающего это неизвестный исход
+            raise CryptoPayError("transfer", f"{e.error} (unverified: {lookup!r})") from e
+        if done is not None:
+            return done
+        raise
 
 # частичный/полный возврат через transfer, если используешь
 import uuid
@@ -0,0 +1,97 @@
+# app/payments/policy.py
+"""
+Политика вызовов внешнего API: circuit breaker и бюджет ретраев.
+
+CircuitBreaker: после `threshold` подряд транзиентных ошибок (таймаут, сеть,
+5xx/429) — open: вызовы сразу отказывают, не дожидаясь таймаута. Через
+`cooldown_s` — half_open: проходит один пробный запрос; успех закрывает,
+ошибка открывает снова. threshold=0 — выключен.
+
+RetryBudget: ретраев не больше `ratio` от числа запросов (плюс небольшой
+запас) — при массовой деградации ретраи не умножают нагрузку на апстрим.
+"""
+import time
+from typing import Callable, Optional
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_CODE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown_s: float,
+                 on_change: Optional[Callable[[str], None]] = None):
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._on_change = on_change
+
+    def _set(self, state: str) -> None:
+        if state != self.state:
+            self.state = state
+            if self._on_change is not None:
+                self._on_change(state)
+
+    def _cooled_down(self) -> bool:
+        return time.monotonic() - self.opened_at >= self.cooldown_s
+
+    def available(self) -> bool:
+        """Пропустит ли breaker запрос прямо сейчас (без побочных эффектов)."""
+        if self.threshold <= 0 or self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return self._cooled_down()
+        return not self._probe_in_flight
+
+    def allow(self) -> bool:
+        """Занять слот под запрос: в half_open — только один пробный."""
+        if self.threshold <= 0 or self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if not self._cooled_down():
+                return False
+            self._set(HALF_OPEN)
+            self._probe_in_flight = False
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self._probe_in_flight = False
+        self._set(CLOSED)
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.threshold > 0 and (self.state == HALF_OPEN or self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+            self._set(OPEN)
+
+    def release(self) -> None:
+        """Вызов отменён без исхода: освободить слот пробного запроса, счётчики не трогать."""
+        self._probe_in_flight = False
+
+    def retry_after(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.cooldown_s - (time.monotonic() - self.opened_at))
+
+
+class RetryBudget:
+    def __init__(self, ratio: float, reserve: float = 3.0, cap: float = 20.0):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = reserve
+
+    def deposit(self) -> None:
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
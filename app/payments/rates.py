@@ -0,0 +1,117 @@
+# app/payments/rates.py
+"""
+Курсы Crypto Pay (getExchangeRates) в памяти процесса, обновляются фоном
+(loop) раз в RATES_REFRESH_S — хендлеры курс API не дёргают никогда.
+
+Ставки и сделки — в «центах» расчётного актива (CRYPTO_DEFAULT_ASSET), счёт
+можно оплатить любым активом из CRYPTO_ASSETS. Конвертация детерминированная,
+через Decimal: сумма счёта в активе округляется ВВЕРХ до его точности
+(игрок не недоплачивает ставку).
+"""
+import asyncio
+import time
+from decimal import ROUND_UP, Decimal
+from typing import Dict, List, Optional, Tuple
+
+from ..config import settings
+from .. import metrics
+from . import cryptopay
+
+RATES_AGE = metrics.gauge("cryptopay_rates_age_seconds", "Age of the cached exchange rates")
+RATES_REFRESH = metrics.counter("cryptopay_rates_refresh_total", "Exchange rate refreshes", ["result"])
+
+# знаков после запятой в сумме счёта; остальные активы — DEFAULT_DECIMALS
+DECIMALS: Dict[str, int] = {"USDT": 2, "USDC": 2, "TRX": 2, "TON": 4, "NOT": 2, "LTC": 6, "BNB": 6, "ETH": 6, "BTC": 8}
+DEFAULT_DECIMALS = 6
+
+_CENT = Decimal("0.01")
+
+_usd: Dict[str, Decimal] = {}     # актив -> цена в USD
+_updated_at = 0.0                 # time.monotonic() последнего успешного обновления
+
+
+class RatesUnavailable(RuntimeError):
+    """Курса нет или он старше RATES_MAX_AGE_S."""
+
+
+def unit() -> str:
+    return settings.CRYPTO_DEFAULT_ASSET
+
+
+def _quantum(asset: str) -> Decimal:
+    return Decimal(1).scaleb(-DECIMALS.get(asset, DEFAULT_DECIMALS))
+
+
+def age() -> float:
+    return time.monotonic() - _updated_at if _updated_at else float("inf")
+
+
+def _rate(asset: str) -> Decimal:
+    """Сколько единиц расчётного актива стоит 1 asset."""
+    if asset == unit():
+        return Decimal(1)
+    if age() > settings.RATES_MAX_AGE_S:
+        raise RatesUnavailable(f"rates are {age():.0f}s old")
+    try:
+        return _usd[asset] / _usd[unit()]
+    except KeyError:
+        raise RatesUnavailable(f"no rate for {asset}/{unit()}")
+
+
+def quote(cents: int, asset: str) -> Tuple[Decimal, Decimal]:
+    """
+    Центы расчётного актива -> (сумма счёта в asset, вверх до точности актива;
+    использованный курс) — для счёта и для записи в invoice_wait.
+    """
+    rate = _rate(asset)
+    return (Decimal(cents) * _CENT / rate).quantize(_quantum(asset), rounding=ROUND_UP), rate
+
+
+def assets() -> List[str]:
+    """Активы, которыми сейчас можно оплатить: расчётный всегда, остальные — при свежем курсе."""
+    out = [unit()]
+    for a in (x.strip().upper() for x in settings.CRYPTO_ASSETS.split(",")):
+        if a and a not in out:
+            try:
+                _rate(a)
+            except RatesUnavailable:
+                continue
+            out.append(a)
+    return out
+
+
+def update(items: List[dict]) -> int:
+    """Ответ getExchangeRates -> кеш (только валидные crypto -> USD)."""
+    global _updated_at
+    fresh: Dict[str, Decimal] = {}
+    for it in items:
+        if it.get("is_valid") and it.get("is_crypto") and it.get("target") == "USD":
+            try:
+                r = Decimal(str(it["rate"]))
+            except Exception:
+                continue
+            if r > 0:
+                fresh[str(it["source"]).upper()] = r
+    if fresh:
+        _usd.clear()
+        _usd.update(fresh)
+        _updated_at = time.monotonic()
+    return len(fresh)
+
+
+async def refresh() -> Optional[int]:
+    try:
+        n = update(await cryptopay.get_exchange_rates())
+    except Exception as e:
+        RATES_REFRESH.inc(result="error")
+        print(f"[RATES] refresh failed ({age():.0f}s old): {e!r}")
+        return None
+    RATES_REFRESH.inc(result="ok" if n else "empty")
+    return n
+
+
+async def loop() -> None:
+    while True:
+        await refresh()
+        RATES_AGE.set(min(age(), 10 ** 9))
+        await asyncio.sleep(settings.RATES_REFRESH_S)
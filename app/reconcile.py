@@ -0,0 +1,426 @@
+# app/reconcile.py
+"""
+Сверка Crypto Pay с базой: оплаченные счета -> депозиты и сделки, проведённые
+выводы -> переводы в Crypto Pay и обратно.
+
+Счета (status=paid) и переводы за окно постранично (PAGE, новые первыми)
+копируются COPY во временные таблицы отдельного соединения; расхождения —
+anti-join'ы в SQL, результат читается серверным курсором. В памяти процесса
+одна страница API и PREFETCH строк курсора — сколько бы записей ни было.
+
+Что ищем (окно [since, now - grace); свежее ещё может провести поллер/воркер):
+
+  paid_not_booked        счёт оплачен, депозита invoice:<id> нет (упал finalize,
+                         запись invoice_wait просрочена или удалена)      — repair
+  booked_not_paid        депозит есть, оплаченного счёта в Crypto Pay нет
+  amount_mismatch        депозит не равен amount_cents из payload счёта
+  paid_no_deal           оплачена ставка NEW, сделки с этим счётом нет (деньги на балансе)
+  settled_no_payout      сделка settled, строк payout нет
+  withdrawal_no_transfer вывод списан с баланса (пачка расчёта — с hold), перевода с его spend_id нет — repair
+  transfer_not_booked    перевод прошёл, вывод не проведён (или отменён)   — repair
+
+--repair чинит то, что можно повторить безопасно: счёт проводится обычным
+finalize_invoice (запись invoice_wait восстанавливается из payload счёта),
+перевод повторяется с тем же spend_id (Crypto Pay не заплатит дважды); если
+Crypto Pay отказал окончательно — вывод отменяется обратной проводкой и деньги
+возвращаются на баланс. Остальное — только в отчёт.
+
+    python -m app.reconcile --hours 48
+    python -m app.reconcile --hours 48 --repair --out reconcile.jsonl
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, TextIO, Tuple
+
+import asyncpg
+
+from .config import settings
+from . import db
+from .payments import cryptopay
+
+PAGE = 1000         # максимум count у getInvoices / getTransfers
+PREFETCH = 500      # строк серверного курсора за одну выборку
+SAMPLE_LINES = 5    # сколько расхождений каждого вида печатать в stdout
+
+INVOICE_COLUMNS = (
+    "invoice_id", "status", "asset", "amount", "created_at", "paid_at",
+    "kind", "tg_user_id", "fight_id", "deal_id", "side", "amount_cents", "payload",
+)
+TRANSFER_COLUMNS = ("transfer_id", "spend_id", "tg_user_id", "asset", "amount", "status", "completed_at")
+
+
+# ===== queries =====
+
+# страницы API льются сюда как есть: сдвиг offset (новые счета приходят сверху)
+# даёт дубли, они схлопываются при сборке rc_invoice / rc_transfer
+SQL_STAGE = """
+DROP TABLE IF EXISTS rc_invoice_raw, rc_transfer_raw, rc_invoice, rc_transfer;
+CREATE TEMP TABLE rc_invoice_raw (
+    invoice_id bigint, status text, asset text, amount numeric,
+    created_at timestamptz, paid_at timestamptz,
+    kind text, tg_user_id bigint, fight_id bigint, deal_id bigint, side int, amount_cents bigint,
+    payload text
+);
+CREATE TEMP TABLE rc_transfer_raw (
+    transfer_id bigint, spend_id text, tg_user_id bigint, asset text, amount numeric,
+    status text, completed_at timestamptz
+);
+"""
+
+SQL_BUILD = """
+CREATE TEMP TABLE rc_invoice AS
+    SELECT DISTINCT ON (invoice_id) * FROM rc_invoice_raw ORDER BY invoice_id;
+ALTER TABLE rc_invoice ADD PRIMARY KEY (invoice_id);
+CREATE TEMP TABLE rc_transfer AS
+    SELECT DISTINCT ON (transfer_id) * FROM rc_transfer_raw ORDER BY transfer_id;
+CREATE INDEX ON rc_transfer(spend_id);
+DROP TABLE rc_invoice_raw, rc_transfer_raw;
+ANALYZE rc_invoice;
+ANALYZE rc_transfer;
+"""
+
+# $1 since, $2 cutoff (now - grace) — у всех проверок
+CHECKS: Dict[str, str] = {
+    "paid_not_booked": """
+        SELECT i.invoice_id, i.kind, i.tg_user_id, i.amount_cents, i.asset, i.amount, i.paid_at, i.payload,
+               w.status AS wait_status
+        FROM rc_invoice i
+        LEFT JOIN invoice_wait w ON w.invoice_id = i.invoice_id
+        WHERE i.status = 'paid' AND i.kind IS NOT NULL
+          AND i.paid_at >= $1 AND i.paid_at < $2
+          AND NOT EXISTS (SELECT 1 FROM ledger l WHERE l.txn_ref = 'invoice:' || i.invoice_id)
+        ORDER BY i.invoice_id
+    """,
+    # rc_invoice загружен с запасом назад (INVOICE_TTL_S), так что депозит в начале
+    # окна по счёту, оплаченному чуть раньше, ложно не всплывёт
+    "booked_not_paid": """
+        SELECT substr(l.txn_ref, 9)::bigint AS invoice_id, l.user_id, l.amount_cents, l.created_at
+        FROM ledger l
+        WHERE l.txn_ref LIKE 'invoice:%' AND l.account = 'user'
+          AND l.created_at >= $1 AND l.created_at < $2
+          AND NOT EXISTS (
+            SELECT 1 FROM rc_invoice i
+            WHERE i.invoice_id = substr(l.txn_ref, 9)::bigint AND i.status = 'paid'
+          )
+        ORDER BY l.id
+    """,
+    "amount_mismatch": """
+        SELECT i.invoice_id, i.amount_cents AS invoiced_cents, l.amount_cents AS booked_cents, l.user_id
+        FROM rc_invoice i
+        JOIN ledger l ON l.txn_ref = 'invoice:' || i.invoice_id AND l.account = 'user'
+        WHERE i.status = 'paid' AND i.kind IS NOT NULL
+          AND i.paid_at >= $1 AND i.paid_at < $2
+          AND l.amount_cents <> i.amount_cents
+        ORDER BY i.invoice_id
+    """,
+    # MATCH без сделки — норма: ставку успели сматчить, оплата осталась на балансе
+    "paid_no_deal": """
+        SELECT i.invoice_id, i.fight_id, i.amount_cents, l.user_id
+        FROM rc_invoice i
+        JOIN ledger l ON l.txn_ref = 'invoice:' || i.invoice_id AND l.account = 'user'
+        WHERE i.status = 'paid' AND i.kind = 'NEW'
+          AND i.paid_at >= $1 AND i.paid_at < $2
+          AND NOT EXISTS (SELECT 1 FROM deal d WHERE d.invoice1_id = i.invoice_id)
+          AND NOT EXISTS (SELECT 1 FROM deal d WHERE d.invoice2_id = i.invoice_id)
+          -- сделка создаётся после оплаты, так что в архиве она не старше $1: лишние секции отсекаются
+          AND NOT EXISTS (
+            SELECT 1 FROM deal_archive a
+            WHERE a.created_at >= $1 AND (a.invoice1_id = i.invoice_id OR a.invoice2_id = i.invoice_id)
+          )
+        ORDER BY i.invoice_id
+    """,
+    "settled_no_payout": """
+        SELECT d.id AS deal_id, d.fight_id, d.user1_id, d.user2_id
+        FROM deal d
+        JOIN fight f ON f.id = d.fight_id
+        WHERE d.status = 'settled'
+          AND COALESCE(f.result_at, f.starts_at) >= $1 AND COALESCE(f.result_at, f.starts_at) < $2
+          AND NOT EXISTS (SELECT 1 FROM payout p WHERE p.deal_id = d.id)
+        ORDER BY d.id
+    """,
+    # spend_id: у расчёта — batch_ref (withdraw:<batch_ref> в ledger), у вывода по кнопке — сам txn_ref
+    "withdrawal_no_transfer": """
+        SELECT l.txn_ref, s.spend_id, l.user_id, u.tg_user_id, -l.amount_cents AS cents, l.created_at
+        FROM ledger l
+        JOIN app_user u ON u.id = l.user_id
+        CROSS JOIN LATERAL (
+            SELECT CASE WHEN l.txn_ref ~ '^withdraw:(win|loss|refund|net):' THEN substr(l.txn_ref, 10)
+                        ELSE l.txn_ref END AS spend_id
+        ) s
+        WHERE l.kind = 'withdrawal' AND l.account IN ('user', 'hold') AND l.amount_cents < 0
+          AND l.txn_ref LIKE 'withdraw:%' AND l.txn_ref NOT LIKE '%:rebook'
+          AND l.txn_ref NOT LIKE '%:reversal'
+          AND l.created_at >= $1 AND l.created_at < $2
+          AND NOT EXISTS (SELECT 1 FROM ledger r WHERE r.txn_ref = l.txn_ref || ':reversal')
+          AND NOT EXISTS (SELECT 1 FROM rc_transfer t WHERE t.spend_id = s.spend_id)
+        ORDER BY l.id
+    """,
+    # только наши spend_id: пачки расчёта (<kind>:<id>:<id>) и выводы (withdraw:<user>:<hex>)
+    "transfer_not_booked": """
+        SELECT t.transfer_id, t.spend_id, r.txn_ref, u.id AS user_id, t.tg_user_id,
+               (t.amount * 100)::bigint AS cents, t.completed_at,
+               EXISTS (SELECT 1 FROM ledger x WHERE x.txn_ref = r.txn_ref || ':reversal') AS reversed
+        FROM rc_transfer t
+        CROSS JOIN LATERAL (
+            SELECT CASE WHEN t.spend_id LIKE 'withdraw:%' THEN t.spend_id
+                        ELSE 'withdraw:' || t.spend_id END AS txn_ref
+        ) r
+        LEFT JOIN app_user u ON u.tg_user_id = t.tg_user_id
+        WHERE t.status = 'completed'
+          AND t.completed_at >= $1 AND t.completed_at < $2
+          AND t.spend_id ~ '^((win|loss|refund|net):\\d+:\\d+|withdraw:\\d+:[0-9a-f]+)$'
+          AND (
+            NOT EXISTS (SELECT 1 FROM ledger l WHERE l.txn_ref = r.txn_ref)
+            OR (EXISTS (SELECT 1 FROM ledger x WHERE x.txn_ref = r.txn_ref || ':reversal')
+                AND NOT EXISTS (SELECT 1 FROM ledger b WHERE b.txn_ref = r.txn_ref || ':rebook'))
+          )
+        ORDER BY t.transfer_id
+    """,
+}
+
+SQL_PAYOUT_SENT = "UPDATE payout SET status='sent', sent_at=now() WHERE batch_ref=$1 AND status='sending'"
+
+
+# ===== Crypto Pay -> temp tables =====
+
+def _ts(v: Any) -> Optional[datetime]:
+    if not v:
+        return None
+    try:
+        return datetime.fromisoformat(str(v).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def _dec(v: Any) -> Optional[Decimal]:
+    try:
+        return Decimal(str(v)) if v is not None else None
+    except InvalidOperation:
+        return None
+
+
+def _int(v: Any) -> Optional[int]:
+    try:
+        return int(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _invoice_record(it: Mapping[str, Any]) -> Tuple[Any, ...]:
+    """Счёт Crypto Pay -> строка rc_invoice_raw; payload не от нашего бота — kind=None (не сверяем)."""
+    raw = it.get("payload")
+    try:
+        p = json.loads(raw) if raw else None
+    except ValueError:
+        p = None
+    if not isinstance(p, dict) or p.get("kind") not in ("NEW", "MATCH"):
+        p = {}
+    return (
+        _int(it.get("invoice_id")), it.get("status"), it.get("asset"), _dec(it.get("amount")),
+        _ts(it.get("created_at")), _ts(it.get("paid_at")),
+        p.get("kind"), _int(p.get("tg_user_id")), _int(p.get("fight_id")), _int(p.get("deal_id")),
+        _int(p.get("participant")), _int(p.get("amount_cents")), raw if p else None,
+    )
+
+
+def _transfer_record(it: Mapping[str, Any]) -> Tuple[Any, ...]:
+    return (
+        _int(it.get("transfer_id")), it.get("spend_id"), _int(it.get("user_id")), it.get("asset"),
+        _dec(it.get("amount")), it.get("status"), _ts(it.get("completed_at")),
+    )
+
+
+async def _load(
+    conn: asyncpg.Connection,
+    table: str,
+    columns: Tuple[str, ...],
+    fetch_page: Callable[[int], Awaitable[List[dict]]],
+    to_record: Callable[[Mapping[str, Any]], Tuple[Any, ...]],
+    ts_field: str,
+    horizon: datetime,
+) -> int:
+    """Страницы (новые первыми), пока не дошли до horizon или список не кончился."""
+    offset = n = 0
+    while True:
+        items = await fetch_page(offset)
+        if not items:
+            return n
+        await conn.copy_records_to_table(table, records=[to_record(it) for it in items], columns=list(columns))
+        n += len(items)
+        offset += len(items)
+        oldest = min((t for t in (_ts(it.get(ts_field)) for it in items) if t), default=None)
+        if len(items) < PAGE or (oldest is not None and oldest < horizon):
+            return n
+
+
+# ===== repair =====
+
+async def _repair_invoice(r: Mapping[str, Any]) -> str:
+    invoice_id = int(r["invoice_id"])
+    if r["wait_status"] is None:
+        await db.restore_invoice_wait(invoice_id, r["payload"], r["asset"], r["amount"])
+    res = await db.finalize_invoice(invoice_id)
+    if res is None:
+        # нет пользователя с tg_user_id из payload, или депозит уже провёл поллер
+        return "skipped"
+    return "ok"
+
+
+async def _repair_withdrawal(r: Mapping[str, Any]) -> str:
+    try:
+        await cryptopay.transfer(
+            tg_user_id=int(r["tg_user_id"]),
+            amount_cents=int(r["cents"]),
+            asset=settings.CRYPTO_DEFAULT_ASSET,
+            spend_id=r["spend_id"],
+        )
+    except cryptopay.CryptoPayError as e:
+        if e.transient:
+            return "retry"
+        # Crypto Pay отказал окончательно, и перевода с этим spend_id нет
+        # (cryptopay.transfer сверяет отказ с getTransfers) — деньги обратно на баланс
+        await db.cancel_withdrawal(int(r["user_id"]), r["txn_ref"], int(r["cents"]))
+        return "reversed"
+    except Exception:
+        return "retry"
+    return "ok"
+
+
+async def _repair_transfer(r: Mapping[str, Any]) -> str:
+    if r["user_id"] is None:
+        return "skipped"
+    user_id, cents = int(r["user_id"]), int(r["cents"])
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            if r["reversed"]:
+                # перевод всё-таки ушёл после отмены вывода — списываем повторно
+                await db.post_ledger(conn, f"{r['txn_ref']}:rebook", db.legs_withdrawal(user_id, cents))
+            else:
+                # то же, что делает settlement-воркер после перевода (пачка расчёта — с hold),
+                # или вывод по кнопке, которого нет в ledger
+                legs = (db.legs_withdrawal if r["txn_ref"] == r["spend_id"] else db.legs_hold_withdrawal)
+                await db.post_ledger(conn, r["txn_ref"], legs(user_id, cents))
+                await conn.execute(SQL_PAYOUT_SENT, r["spend_id"])
+    return "ok"
+
+
+REPAIRS: Dict[str, Callable[[Mapping[str, Any]], Awaitable[str]]] = {
+    "paid_not_booked": _repair_invoice,
+    "withdrawal_no_transfer": _repair_withdrawal,
+    "transfer_not_booked": _repair_transfer,
+}
+
+
+# ===== report =====
+
+class Report:
+    def __init__(self, out: Optional[TextIO] = None):
+        self.out = out
+        self.found: Dict[str, int] = {k: 0 for k in CHECKS}
+        self.repaired: Dict[str, Dict[str, int]] = {}
+        self.loaded: Dict[str, int] = {}
+
+    def add(self, kind: str, row: Mapping[str, Any], repair: Optional[str] = None) -> None:
+        self.found[kind] += 1
+        if repair is not None:
+            bucket = self.repaired.setdefault(kind, {})
+            bucket[repair] = bucket.get(repair, 0) + 1
+        item = {"kind": kind, **dict(row)}
+        item.pop("payload", None)
+        if repair is not None:
+            item["repair"] = repair
+        if self.out is not None:
+            self.out.write(json.dumps(item, default=str, ensure_ascii=False) + "\n")
+        if self.found[kind] <= SAMPLE_LINES:
+            print(f"[RECONCILE] {json.dumps(item, default=str, ensure_ascii=False)}")
+
+    def summary(self) -> str:
+        lines = [f"loaded: {', '.join(f'{k} {v}' for k, v in self.loaded.items())}"]
+        for kind, n in self.found.items():
+            fixed = self.repaired.get(kind)
+            lines.append(f"{kind:<24}{n}" + (f"  repair: {fixed}" if fixed else ""))
+        return "\n".join(lines)
+
+
+async def run(
+    since: datetime,
+    grace_s: float = 600.0,
+    repair: bool = False,
+    out: Optional[TextIO] = None,
+) -> Report:
+    """Одна сверка окна [since, now - grace_s). Память — O(PAGE + PREFETCH), не O(окна)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace_s)
+    # счёт, оплаченный в окне, мог быть выставлен раньше — на срок жизни счёта
+    invoice_horizon = since - timedelta(seconds=settings.INVOICE_TTL_S + grace_s)
+    report = Report(out)
+    conn = await db.connect()
+    try:
+        await conn.execute(SQL_STAGE)
+        t0 = time.perf_counter()
+        report.loaded["invoices"] = await _load(
+            conn, "rc_invoice_raw", INVOICE_COLUMNS,
+            lambda off: cryptopay.get_invoices(status="paid", offset=off, count=PAGE),
+            _invoice_record, "created_at", invoice_horizon,
+        )
+        report.loaded["transfers"] = await _load(
+            conn, "rc_transfer_raw", TRANSFER_COLUMNS,
+            lambda off: cryptopay.get_transfers(offset=off, count=PAGE),
+            _transfer_record, "completed_at", since - timedelta(seconds=grace_s),
+        )
+        await conn.execute(SQL_BUILD)
+        print(f"[RECONCILE] loaded {report.loaded} in {time.perf_counter() - t0:.1f}s")
+
+        for kind, sql in CHECKS.items():
+            fix = REPAIRS.get(kind) if repair else None
+            async with conn.transaction():
+                # починка (переводы) может идти дольше idle_in_transaction_session_timeout
+                await conn.execute("SET LOCAL idle_in_transaction_session_timeout = 0")
+                async for row in conn.cursor(sql, since, cutoff, prefetch=PREFETCH):
+                    result = None
+                    if fix is not None:
+                        try:
+                            result = await fix(row)
+                        except Exception as e:
+                            print(f"[RECONCILE] repair {kind} failed: {e!r}")
+                            result = "error"
+                    report.add(kind, row, result)
+    finally:
+        await conn.close()
+    return report
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=48.0, help="window: last N hours")
+    parser.add_argument("--grace-s", type=float, default=600.0, help="skip the most recent N seconds (still in flight)")
+    parser.add_argument("--repair", action="store_true")
+    parser.add_argument("--out", default="", help="write every discrepancy as JSONL")
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--interval", type=int, default=3600)
+    args = parser.parse_args()
+
+    out = open(args.out, "a", encoding="utf-8") if args.out else None
+    try:
+        while True:
+            since = datetime.now(timezone.utc) - timedelta(hours=args.hours)
+            try:
+                report = await run(since, args.grace_s, args.repair, out)
+                print(report.summary())
+            except Exception as ex:
+                print(f"[RECONCILE] ERROR: {ex!r}")
+            if not args.watch:
+                break
+            await asyncio.sleep(args.interval)
+    finally:
+        if out is not None:
+            out.close()
+        await cryptopay.close()
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,16 +1,14 @@
 import asyncio
 from datetime import datetime, timedelta
 
-from aiogram import Bot
 from .config import settings
 from . import db
 
-BOT = Bot(settings.BOT_TOKEN)
-
 async def notify_admins(text: str):
+    from .tg import get_bot   # aiogram грузим, только когда есть что отправить
     for aid in settings.ADMIN_IDS:
         try:
-            await BOT.send_message(aid, text)
+            await get_bot().send_message(aid, text)
         except Exception:
             pass
 
@@ -19,7 +17,7 @@ async def loop():
         try:
             # Найти бои, у которых starts_at прошёл > 1 часа, а статус всё ещё не done
             rows = await db.fetch("""
-                SELECT * FROM fight
+                SELECT id, title, participant1_name, participant2_name, status FROM fight
                 WHERE (status IN ('upcoming','today','live'))
                   AND starts_at IS NOT NULL
                   AND starts_at < now() - interval '1 hour'
@@ -31,7 +29,8 @@ async def loop():
                     await notify_admins(
                         f"⚠️ Пора выставить результат по бою:\n<b>{r['title']}</b>\n"
                         f"{r['participant1_name']} vs {r['participant2_name']}\n"
-                        f"ID: {r['id']}  (status={r['status']})"
+                        f"ID: {r['id']}  (status={r['status']})\n"
+                        f"/results или /close {r['id']}=1"
                     )
             await asyncio.sleep(600)  # каждые 10 минут
         except Exception:
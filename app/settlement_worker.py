@@ -1,64 +1,225 @@
 # app/settlement_worker.py
 import asyncio
-from typing import Mapping, Any, List, Optional
+from typing import Mapping, Any, List, Optional, Set, Tuple
 
 from aiogram import Bot
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
 
 from .config import settings
-from . import db
+from . import db, metrics, tracing
 from .payments import cryptopay
+from .tg import get_bot
 
+SETTLE_BACKLOG = metrics.gauge("settlement_backlog", "Settlement work found in the last tick", ["kind"])
+SETTLE_DONE = metrics.counter("settlement_processed_total", "Settlement attempts", ["kind", "result"])
+SETTLE_TICK_SECONDS = metrics.histogram("settlement_tick_seconds", "Duration of one settlement tick")
 
-# ===== helpers =====
+FIGHT_DONE_CHANNEL = "fight_done"   # NOTIFY из триггера fight_done_notify (db.SCHEMA_SQL)
 
-async def _get_tg_user_id(app_user_id: Optional[int]) -> Optional[int]:
-    if not app_user_id:
-        return None
-    row = await db.fetchrow("SELECT tg_user_id FROM app_user WHERE id=$1", app_user_id)
-    return int(row["tg_user_id"]) if row else None
 
+# ===== helpers =====
 
 def _fmt_usdt(cents: int) -> str:
-    return f"{cents/100:.2f} USDT"
+    return f"{cents/100:.2f} {settings.CRYPTO_DEFAULT_ASSET}"
 
 
 # ===== queries (всё внутри файла, чтобы не править db.py) =====
 
-SQL_DEALS_TO_PAYOUT = """
-SELECT
-  d.*,
-  f.title,
-  f.participant1_name AS p1_name,
-  f.participant2_name AS p2_name,
-  f.winner_participant
-FROM deal d
-JOIN fight f ON f.id = d.fight_id
+# бои, по которым ещё есть что закрывать
+SQL_FIGHTS_TO_SETTLE = """
+SELECT f.id
+FROM fight f
 WHERE f.status = 'done'
-  AND d.status = 'matched'
-ORDER BY d.id
-LIMIT $1
+  AND EXISTS (
+    SELECT 1 FROM deal d
+    WHERE d.fight_id = f.id
+      AND d.status IN ('matched', 'awaiting_match')
+  )
+ORDER BY f.id
 """
 
-SQL_DEALS_TO_REFUND = """
+# Весь расчёт боя одним запросом: победитель/выплата/комиссия по каждой сделке,
+# строки в очередь payout, проводки (как legs_payout / legs_refund) и статусы
+# сделок -> settled, несматченные уходят из книги fight_pool. Повторный запуск по
+# тому же бою ничего не найдёт.
+# winner_participant = 0 — бой отменён (void): обе стороны matched-сделки получают
+# свои ставки назад без комиссии. Для matched-сделок без результата (NULL) ничего не делаем.
+# $3 — куда зачисляем (_credit_account): 'user' (баланс) или 'hold', если выплата
+# уйдёт переводом — тогда до перевода её нельзя ни поставить, ни вывести второй раз.
+SQL_SETTLE_FIGHT = """
+WITH todo AS (
+  SELECT
+    d.id, d.user1_id, d.user2_id, d.status AS was, d.participant1 AS side1,
+    d.amount1_cents AS amount1, COALESCE(d.amount2_cents, 0) AS amount2,
+    d.amount1_cents + COALESCE(d.amount2_cents, 0) AS total,
+    f.winner_participant AS win
+  FROM deal d
+  JOIN fight f ON f.id = d.fight_id
+  WHERE d.fight_id = $1
+    AND f.status = 'done'
+    AND (
+      (d.status = 'matched' AND f.winner_participant IN (0, 1, 2))
+      OR (d.status = 'awaiting_match' AND d.paid1 AND d.user2_id IS NULL)
+    )
+  FOR UPDATE OF d
+), flip AS (
+  UPDATE deal d SET status = 'settled'
+  FROM todo
+  WHERE d.id = todo.id
+), pool AS (
+  UPDATE fight_pool p SET open_count = p.open_count - g.n
+  FROM (
+    SELECT side1, amount1, count(*) AS n FROM todo WHERE was = 'awaiting_match' GROUP BY side1, amount1
+  ) g
+  WHERE p.fight_id = $1 AND p.side = g.side1 AND p.amount_cents = g.amount1
+), calc AS (
+  SELECT
+    id AS deal_id,
+    was = 'matched' AND win IN (1, 2) AS is_win,
+    was = 'matched' AND win = 0 AS is_void,
+    CASE WHEN was = 'matched' AND win = 2 THEN user2_id ELSE user1_id END AS pay_user,
+    CASE WHEN was = 'matched' AND win IN (1, 2) THEN (CASE WHEN win = 2 THEN user1_id ELSE user2_id END) END AS lose_user,
+    user2_id, amount1, amount2, total,
+    CASE WHEN was = 'matched' AND win IN (1, 2) THEN floor(total * $2::float8)::bigint ELSE 0 END AS fee
+  FROM todo
+), queued AS (
+  INSERT INTO payout(deal_id, user_id, kind, amount_cents, fee_cents)
+  SELECT deal_id, pay_user, CASE WHEN is_win THEN 'win' ELSE 'refund' END,
+         CASE WHEN is_void THEN amount1 ELSE total - fee END, fee
+  FROM calc
+  UNION ALL
+  SELECT deal_id, lose_user, 'loss', 0, 0
+  FROM calc WHERE lose_user IS NOT NULL
+  UNION ALL
+  SELECT deal_id, user2_id, 'refund', amount2, 0
+  FROM calc WHERE is_void
+  ON CONFLICT (deal_id, user_id, kind) DO NOTHING
+), legs AS (
+  SELECT 'payout:' || deal_id AS txn_ref, 1 AS leg, 'payout' AS kind, 'escrow' AS account,
+         NULL::bigint AS user_id, -total AS amount_cents, deal_id
+  FROM calc WHERE is_win
+  UNION ALL
+  SELECT 'payout:' || deal_id, 2, 'payout', $3::text, pay_user, total - fee, deal_id FROM calc WHERE is_win
+  UNION ALL
+  SELECT 'payout:' || deal_id, 3, 'fee', 'house', NULL, fee, deal_id FROM calc WHERE is_win
+  UNION ALL
+  SELECT 'refund:' || deal_id, 1, 'refund', 'escrow', NULL, -total, deal_id FROM calc WHERE NOT is_win
+  UNION ALL
+  SELECT 'refund:' || deal_id, 2, 'refund', $3, pay_user,
+         CASE WHEN is_void THEN amount1 ELSE total END, deal_id FROM calc WHERE NOT is_win
+  UNION ALL
+  SELECT 'refund:' || deal_id, 3, 'refund', $3, user2_id, amount2, deal_id FROM calc WHERE is_void
+), led AS (
+  INSERT INTO ledger(txn_ref, leg, kind, account, user_id, amount_cents, deal_id)
+  SELECT txn_ref, leg, kind, account, user_id, amount_cents, deal_id FROM legs
+  ON CONFLICT (txn_ref, leg) DO NOTHING
+  RETURNING id, account, user_id, amount_cents
+), pend AS (
+  INSERT INTO balance_pending(ledger_id, user_id, amount_cents)
+  SELECT id, user_id, amount_cents FROM led WHERE account = 'user'
+)
 SELECT
-  d.*,
-  f.title,
-  f.participant1_name AS p1_name,
-  f.participant2_name AS p2_name
-FROM deal d
+  count(*) FILTER (WHERE is_win) AS paid,
+  count(*) FILTER (WHERE NOT is_win) AS refunded
+FROM calc
+"""
+
+# Ставки без оппонента, которые больше не сматчат: бой начался (DEAL_EXPIRE_AT_START)
+# или ставка старше DEAL_EXPIRE_AFTER_H часов. Пачкой одним запросом: void + минус в
+# fight_pool + refund в очередь payout + проводка (как legs_refund) — дальше их
+# отправляет _drain. $4 — счёт зачисления, как $3 у SQL_SETTLE_FIGHT.
+# SKIP LOCKED: строку, которую прямо сейчас матчат, не ждём — после матча она уже не наша.
+SQL_EXPIRE_STALE = """
+WITH todo AS (
+  SELECT d.id, d.fight_id, d.user1_id, d.participant1 AS side, d.amount1_cents AS amount
+  FROM deal d
+  JOIN fight f ON f.id = d.fight_id
+  WHERE d.status = 'awaiting_match' AND d.paid1 AND d.user2_id IS NULL
+    AND (
+      ($1::boolean AND (f.status IN ('live', 'done') OR f.starts_at <= now()))
+      OR ($2::float8 > 0 AND d.created_at < now() - make_interval(secs => $2::float8 * 3600))
+    )
+  ORDER BY d.id
+  LIMIT $3
+  FOR UPDATE OF d SKIP LOCKED
+), flip AS (
+  UPDATE deal d SET status = 'void'
+  FROM todo
+  WHERE d.id = todo.id
+), pool AS (
+  UPDATE fight_pool p SET open_count = p.open_count - g.n
+  FROM (SELECT fight_id, side, amount, count(*) AS n FROM todo GROUP BY fight_id, side, amount) g
+  WHERE p.fight_id = g.fight_id AND p.side = g.side AND p.amount_cents = g.amount
+), queued AS (
+  INSERT INTO payout(deal_id, user_id, kind, amount_cents, fee_cents)
+  SELECT id, user1_id, 'refund', amount, 0 FROM todo
+  ON CONFLICT (deal_id, user_id, kind) DO NOTHING
+), led AS (
+  INSERT INTO ledger(txn_ref, leg, kind, account, user_id, amount_cents, deal_id)
+  SELECT 'refund:' || id, 1, 'refund', 'escrow', NULL, -amount, id FROM todo
+  UNION ALL
+  SELECT 'refund:' || id, 2, 'refund', $4::text, user1_id, amount, id FROM todo
+  ON CONFLICT (txn_ref, leg) DO NOTHING
+  RETURNING id, account, user_id, amount_cents
+), pend AS (
+  INSERT INTO balance_pending(ledger_id, user_id, amount_cents)
+  SELECT id, user_id, amount_cents FROM led WHERE account = 'user'
+)
+SELECT count(*) FROM todo
+"""
+
+# SETTLE_MODE=batched: все pending-строки получателя -> одна пачка; batch_ref
+# детерминирован и служит spend_id перевода, так что повтор после сбоя не заплатит дважды
+SQL_PAYOUT_CLAIM = """
+WITH g AS (
+  SELECT user_id, max(id) AS last_id
+  FROM payout
+  WHERE status = 'pending'
+  GROUP BY user_id
+  ORDER BY user_id
+  LIMIT $1
+)
+UPDATE payout p
+SET status = 'sending', batch_ref = 'net:' || g.user_id || ':' || g.last_id
+FROM g
+WHERE p.user_id = g.user_id
+  AND p.status = 'pending'
+  AND p.id <= g.last_id
+"""
+
+# SETTLE_MODE=per_deal: пачка = одна строка (перевод и сообщение на сделку)
+SQL_PAYOUT_CLAIM_PER_DEAL = """
+UPDATE payout
+SET status = 'sending', batch_ref = kind || ':' || deal_id || ':' || user_id
+WHERE id IN (SELECT id FROM payout WHERE status = 'pending' ORDER BY id LIMIT $1)
+"""
+
+SQL_PAYOUT_BATCHES = """
+SELECT
+  p.batch_ref, p.user_id, u.tg_user_id,
+  sum(p.amount_cents) AS net_cents,
+  array_agg(p.kind ORDER BY p.id) AS kinds,
+  array_agg(p.amount_cents ORDER BY p.id) AS amounts,
+  array_agg(f.title ORDER BY p.id) AS titles,
+  array_agg(d.invoice1_id ORDER BY p.id) AS invoices
+FROM payout p
+JOIN app_user u ON u.id = p.user_id
+JOIN deal d ON d.id = p.deal_id
 JOIN fight f ON f.id = d.fight_id
-WHERE f.status = 'done'
-  AND d.status = 'awaiting_match'
-  AND d.paid1 = TRUE
-  AND d.user2_id IS NULL
-ORDER BY d.id
+WHERE p.status = 'sending'
+GROUP BY p.batch_ref, p.user_id, u.tg_user_id
 LIMIT $1
 """
 
-# Флаг «закрыта»
-SQL_MARK_SETTLED = "UPDATE deal SET status='settled' WHERE id=$1"
+SQL_PAYOUT_SENT = "UPDATE payout SET status='sent', sent_at=now() WHERE batch_ref=$1 AND status='sending'"
+
+
+def _credit_account() -> str:
+    """
+    Выплаты на баланс — счёт user. Иначе — hold: деньги пользователя, но вне
+    доступного баланса, пока _send_batch не переведёт их (withdraw:<batch_ref>
+    списывает hold) или не вернёт на баланс при окончательном отказе Crypto Pay.
+    """
+    return "user" if settings.PAYOUT_TO_BALANCE else "hold"
 
 
 # ===== notifications =====
@@ -73,169 +234,245 @@ async def _notify(bot: Bot, tg_id: Optional[int], text: str) -> None:
         print(f"[SETTLE] notify fail to {tg_id}: {e!r}")
 
 
-async def _notify_payout(
-    bot: Bot,
-    deal: Mapping[str, Any],
-    winner_tg: Optional[int],
-    loser_tg: Optional[int],
-    payout_cents: int,
-    fee_cents: int,
-) -> None:
-    title = deal["title"]
-    win_side = int(deal["winner_participant"])
-    p1 = deal["p1_name"]
-    p2 = deal["p2_name"]
-
-    if winner_tg:
-        await _notify(
-            bot,
-            winner_tg,
-            (
-                f"✅ <b>Выплата по событию:</b> {title}\n"
-                f"Победил: <b>{'1-й ('+p1+')' if win_side==1 else '2-й ('+p2+')'}</b>\n"
-                f"Начислено: <b>{_fmt_usdt(payout_cents)}</b>\n"
-                f"Комиссия: {_fmt_usdt(fee_cents)}"
-            ),
-        )
-    if loser_tg:
-        await _notify(
-            bot,
-            loser_tg,
-            (
-                f"❌ <b>Проигрыш по событию:</b> {title}\n"
-                f"Победил: <b>{'1-й ('+p1+')' if win_side==1 else '2-й ('+p2+')'}</b>"
-            ),
-        )
-
-
-async def _notify_refund(bot: Bot, tg_id: Optional[int], deal: Mapping[str, Any], amount_cents: int) -> None:
-    if not tg_id:
-        return
-    title = deal["title"]
-    await _notify(
-        bot,
-        tg_id,
-        (
-            f"↩️ <b>Возврат ставки</b>\n"
-            f"Событие: {title}\n"
-            f"Вернули: <b>{_fmt_usdt(amount_cents)}</b>\n"
-            f"Причина: ставка не нашла оппонента до окончания боя."
-        ),
-    )
+SUMMARY_MAX_LINES = 30
+
+
+def _summary_text(b: Mapping[str, Any]) -> str:
+    lines = []
+    for kind, amount, title in zip(b["kinds"], b["amounts"], b["titles"]):
+        if kind == "win":
+            lines.append(f"✅ {title}: +{_fmt_usdt(int(amount))}")
+        elif kind == "refund":
+            lines.append(f"↩️ {title}: возврат {_fmt_usdt(int(amount))} (бой отменён или ставка не нашла оппонента)")
+        else:
+            lines.append(f"❌ {title}: ставка проиграла")
+    if len(lines) > SUMMARY_MAX_LINES:
+        rest = len(lines) - SUMMARY_MAX_LINES
+        lines = lines[:SUMMARY_MAX_LINES] + [f"… и ещё {rest}"]
+
+    net = int(b["net_cents"])
+    where = "на баланс" if settings.PAYOUT_TO_BALANCE else "в CryptoBot"
+    total = f"Итого: <b>{_fmt_usdt(net)}</b> {where}" if net > 0 else "Итого: без начислений"
+    return "🧾 <b>Итоги расчёта</b>\n" + "\n".join(lines) + "\n\n" + total
 
 
 # ===== settlements =====
 
-async def _process_payout(bot: Bot, d: Mapping[str, Any]) -> None:
+async def settle_fight(fight_id: int) -> Tuple[int, int]:
+    """Закрывает все сделки боя одним запросом. Возвращает (выплат, возвратов) в очереди."""
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow(SQL_SETTLE_FIGHT, fight_id, settings.FEE_PCT, _credit_account())
+    paid, refunded = int(row["paid"]), int(row["refunded"])
+    SETTLE_DONE.inc(paid, kind="payout", result="ok")
+    SETTLE_DONE.inc(refunded, kind="refund", result="ok")
+    return paid, refunded
+
+
+async def expire_stale(batch: int = 1000) -> int:
+    """Просроченные ставки без оппонента -> void + возврат в очереди payout. Возвращает число сделок."""
+    if not settings.DEAL_EXPIRE_AT_START and settings.DEAL_EXPIRE_AFTER_H <= 0:
+        return 0
+    total = 0
+    while True:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                n = int(await conn.fetchval(
+                    SQL_EXPIRE_STALE, settings.DEAL_EXPIRE_AT_START, float(settings.DEAL_EXPIRE_AFTER_H), batch,
+                    _credit_account(),
+                ))
+        total += n
+        if n < batch:
+            break
+    if total:
+        SETTLE_DONE.inc(total, kind="expire", result="ok")
+        print(f"[SETTLE] {total} stale open deal(s) voided, refunds queued")
+    return total
+
+
+async def _send_batch(bot: Bot, b: Mapping[str, Any]) -> bool:
     """
-    Выплата победителю по matched-сделке.
-    Комиссия удерживается от общей суммы (ставки обеих сторон).
+    Перевод на сумму пачки + одно сообщение. Повтор идемпотентен по batch_ref. False — не отправлено.
+    Сумма пачки лежит на hold (_credit_account): успех списывает её оттуда, окончательный
+    отказ Crypto Pay возвращает на баланс; неизвестный исход (таймаут) — повтор в следующий тик.
     """
+    ref = b["batch_ref"]
+    user_id = int(b["user_id"])
+    net = int(b["net_cents"])
+    transfer = net > 0 and not settings.PAYOUT_TO_BALANCE
+    text = _summary_text(b)
     try:
-        win = int(d["winner_participant"])
-        if win not in (1, 2):
-            # Корректность данных — без победителя платить нельзя
-            print(f"[SETTLE] skip deal {d['id']}: winner_participant={win!r}")
-            return
+        released = False
+        if transfer:
+            try:
+                await cryptopay.transfer(
+                    tg_user_id=int(b["tg_user_id"]),
+                    amount_cents=net,
+                    asset=settings.CRYPTO_DEFAULT_ASSET,
+                    spend_id=ref,
+                )
+            except cryptopay.CryptoPayError as e:
+                if e.transient:
+                    raise
+                # отказ подтверждён (перевода с этим spend_id нет) — как cancel_withdrawal
+                print(f"[SETTLE] transfer rejected {ref}: {e!r}, crediting balance")
+                released = True
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                if released:
+                    await db.post_ledger(conn, f"withdraw:{ref}:reversal", db.legs_hold_release(user_id, net))
+                elif transfer:
+                    await db.post_ledger(conn, f"withdraw:{ref}", db.legs_hold_withdrawal(user_id, net))
+                await conn.execute(SQL_PAYOUT_SENT, ref)
+        SETTLE_DONE.inc(kind="batch", result="released" if released else "ok")
+        if released:
+            text += f"\n\nПеревод в CryptoBot не прошёл — <b>{_fmt_usdt(net)}</b> зачислены на баланс."
+    except Exception as e:
+        # строки остаются в 'sending' с тем же batch_ref — следующий тик повторит
+        SETTLE_DONE.inc(kind="batch", result="error")
+        print(f"[SETTLE] batch fail {ref}: {e!r}")
+        return False
+    await _notify(bot, b["tg_user_id"], text)
+    return True
+
+
+async def _drain(bot: Bot, batch: int = 100) -> int:
+    """Собирает pending-строки в пачки и отправляет их. Возвращает число отправленных пачек."""
+    claim = SQL_PAYOUT_CLAIM if settings.SETTLE_MODE == "batched" else SQL_PAYOUT_CLAIM_PER_DEAL
+    await db.execute(claim, batch)
+    batches: List[Mapping[str, Any]] = await db.fetch(SQL_PAYOUT_BATCHES, batch)
+    SETTLE_BACKLOG.set(len(batches), kind="batch")
+    sent = 0
+    for b in batches:
+        invoices = [i for i in b["invoices"] if i]
+        # одиночная пачка продолжает трейс своей ставки, сетевая — ссылается на все
+        root = invoices[0] if len(b["kinds"]) == 1 and invoices else None
+        with tracing.span("settle.batch", invoice_id=root, user_id=b["user_id"], deals=len(b["kinds"])) as sp:
+            if root is None:
+                for inv in invoices[:32]:
+                    sp.link_invoice(inv)
+            sent += await _send_batch(bot, b)
+    return sent
 
-        user1_tg = await _get_tg_user_id(d.get("user1_id"))
-        user2_tg = await _get_tg_user_id(d.get("user2_id"))
 
-        a1 = int(d.get("amount1_cents") or 0)
-        a2 = int(d.get("amount2_cents") or 0)
-        total = a1 + a2
+# ===== main loop =====
 
-        fee_cents = int(total * settings.FEE_PCT)
-        payout_cents = total - fee_cents
+async def tick(bot: Bot, batch: int = 100, fights: Optional[List[int]] = None, drain_all: bool = False) -> int:
+    """
+    Один проход: расчёт завершённых боёв + отправка очереди. Возвращает число закрытых сделок.
+    fights — только эти бои (пришли по NOTIFY), без поиска по всем; drain_all —
+    отправлять пачки, пока очередь не опустеет.
+    """
+    settled = 0
+    with SETTLE_TICK_SECONDS.time():
+        # 1) Бои -> очередь payout (по запросу на бой)
+        if fights is None:
+            fights = [int(r["id"]) for r in await db.fetch(SQL_FIGHTS_TO_SETTLE)]
+        SETTLE_BACKLOG.set(len(fights), kind="fight")
+        for fight_id in fights:
+            with tracing.span("settle.fight", fight_id=fight_id) as sp:
+                try:
+                    paid, refunded = await settle_fight(fight_id)
+                except Exception as e:
+                    SETTLE_DONE.inc(kind="fight", result="error")
+                    print(f"[SETTLE] fight {fight_id} FAIL: {e!r}")
+                    continue
+                sp.set(paid=paid, refunded=refunded)
+            settled += paid + refunded
+            print(f"[SETTLE] fight {fight_id}: {paid} payout(s), {refunded} refund(s) queued")
+
+        # 1б) Ставки без оппонента, которые уже не сматчат -> возвраты в ту же очередь
+        try:
+            settled += await expire_stale(batch * 10)
+        except Exception as e:
+            SETTLE_DONE.inc(kind="expire", result="error")
+            print(f"[SETTLE] expire stale FAIL: {e!r}")
 
-        # Кому платим
-        if win == 1:
-            pay_tg = user1_tg
-        else:
-            pay_tg = user2_tg
+        # 2) Очередь -> переводы и уведомления
+        n_batches = await _drain(bot, batch)
+        total = n_batches
+        # неотправленные пачки остаются в очереди — крутимся, только пока всё уходит
+        while drain_all and n_batches >= batch:
+            n_batches = await _drain(bot, batch)
+            total += n_batches
+        if total:
+            print(f"[SETTLE] tick: {total} transfer batch(es) sent")
 
-        if not pay_tg:
-            print(f"[SETTLE] deal {d['id']} winner has no tg_user_id -> skip")
-            return
+        # 3) Свежие проводки -> снапшоты балансов
+        await db.materialize_balances()
+    return settled
 
-        # Выплата (через transfer)
-        await cryptopay.refund(
-            invoice_id=int(d.get("invoice2_id") or d.get("invoice1_id") or 0),  # любой для idempotency
-            amount_cents=payout_cents,
-            tg_user_id=int(pay_tg),
-            asset=settings.CRYPTO_DEFAULT_ASSET,
-        )
-
-        # Пометили закрытой
-        await db.execute(SQL_MARK_SETTLED, d["id"])
-
-        # Уведомления
-        await _notify_payout(
-            bot,
-            winner_tg=pay_tg,
-            loser_tg=user1_tg if pay_tg == user2_tg else user2_tg,
-            deal=d,
-            payout_cents=payout_cents,
-            fee_cents=fee_cents,
-        )
-    except Exception as e:
-        print(f"[SETTLE] payout fail deal={d.get('id')}: {e!r}")
 
+class _Wakeups:
+    """LISTEN fight_done: id боёв из уведомлений + событие «пора работать»."""
 
-async def _process_refund(bot: Bot, d: Mapping[str, Any]) -> None:
-    """
-    Возврат автору одиночной ставки (awaiting_match), когда бой уже done.
-    """
-    try:
-        user1_tg = await _get_tg_user_id(d.get("user1_id"))
-        a1 = int(d.get("amount1_cents") or 0)
-        inv1 = int(d.get("invoice1_id") or 0)
+    def __init__(self) -> None:
+        self.fights: Set[int] = set()
+        self.event = asyncio.Event()
 
-        if not user1_tg or a1 <= 0:
-            print(f"[SETTLE] refund skip deal={d.get('id')} (tg={user1_tg}, amount={a1})")
-            await db.execute(SQL_MARK_SETTLED, d["id"])
+    def on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        try:
+            self.fights.add(int(payload))
+        except ValueError:
             return
+        self.event.set()
 
-        await cryptopay.refund(
-            invoice_id=inv1 or int(d["id"]),
-            amount_cents=a1,
-            tg_user_id=user1_tg,
-            asset=settings.CRYPTO_DEFAULT_ASSET,
-        )
+    def on_lost(self, conn: Any) -> None:
+        self.event.set()
 
-        await db.execute(SQL_MARK_SETTLED, d["id"])
-        await _notify_refund(bot, user1_tg, d, a1)
-    except Exception as e:
-        print(f"[SETTLE] refund fail deal={d.get('id')}: {e!r}")
+    def take(self) -> List[int]:
+        self.event.clear()
+        fights, self.fights = sorted(self.fights), set()
+        return fights
 
 
-# ===== main loop =====
+async def _listen(wake: _Wakeups) -> Optional[Any]:
+    try:
+        conn = await db.connect()
+        conn.add_termination_listener(wake.on_lost)
+        await conn.add_listener(FIGHT_DONE_CHANNEL, wake.on_notify)
+        return conn
+    except Exception as e:
+        print(f"[SETTLE] LISTEN {FIGHT_DONE_CHANNEL} failed, polling every {settings.SETTLE_RETRY_S:.0f}s: {e!r}")
+        return None
+
 
-async def loop(bot: Bot, tick_seconds: int = 5, batch: int = 100) -> None:
+async def loop(bot: Bot, tick_seconds: Optional[float] = None, batch: int = 100) -> None:
+    """
+    Бой стал done -> триггер шлёт NOTIFY fight_done -> расчёт сразу. Полный
+    проход — на старте, после потери LISTEN-соединения и раз в SETTLE_POLL_S.
+    """
+    wake = _Wakeups()
+    listener = None
+    full = True
     while True:
+        if listener is None or listener.is_closed():
+            listener = await _listen(wake)
+            full = True   # пока не слушали, уведомления могли потеряться
         try:
-            # 1) Выплаты победителям
-            to_pay: List[Mapping[str, Any]] = await db.fetch(SQL_DEALS_TO_PAYOUT, batch)
-            print(f"[SETTLE] tick: {len(to_pay)} deal(s) to payout")
-            for d in to_pay:
-                await _process_payout(bot, d)
-
-            # 2) Возвраты за одиночные
-            to_refund: List[Mapping[str, Any]] = await db.fetch(SQL_DEALS_TO_REFUND, batch)
-            print(f"[SETTLE] tick: {len(to_refund)} deal(s) to refund")
-            for d in to_refund:
-                await _process_refund(bot, d)
-
+            if full:
+                await tick(bot, batch, drain_all=True)
+            else:
+                await tick(bot, batch, fights=wake.take(), drain_all=True)
         except Exception as e:
             print(f"[SETTLE] loop FAIL: {e!r}")
 
-        await asyncio.sleep(tick_seconds)
+        timeout = tick_seconds or (settings.SETTLE_POLL_S if listener is not None else settings.SETTLE_RETRY_S)
+        try:
+            await asyncio.wait_for(wake.event.wait(), timeout)
+            full = listener is None or listener.is_closed()
+        except asyncio.TimeoutError:
+            full = True
+        if full:
+            wake.take()
 
 
 async def main() -> None:
-    bot = Bot(settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    tracing.set_service("settlement")
+    bot = get_bot()
+    await metrics.start_http_server(settings.SETTLE_METRICS_PORT, settings.METRICS_HOST)
     await loop(bot)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -1,38 +1,79 @@
 import asyncio
-from datetime import datetime
-from typing import List, Dict, Any
+from typing import List
 
 from . import db
-from .google_sheets import fetch_fights_from_sheet
+from .google_sheets import FightRow, fetch_fights_from_sheet
 
+# временная таблица живёт с соединением (ON COMMIT DELETE ROWS, а не DROP), чтобы
+# закешированный asyncpg план SQL_UPSERT не ссылался на пересозданную таблицу
+SQL_STAGE = """
+CREATE TEMP TABLE IF NOT EXISTS fight_sync (
+    external_id         TEXT,
+    title               TEXT,
+    participant1_name   TEXT,
+    participant2_name   TEXT,
+    photo_url           TEXT,
+    description         TEXT,
+    starts_at           TIMESTAMPTZ,
+    status              TEXT,
+    winner_participant  INT
+) ON COMMIT DELETE ROWS
+"""
+
+# Весь лист одним запросом из staging-таблицы. Неизменённые бои не
+# переписываются (меньше мёртвых строк при опросе каждые 20 с).
+# Возвращает старые photo_url, которые сменились (CTE old видит снимок до апдейта).
+# status/winner боя, закрытого админом из бота (result_by), лист не перетирает.
 SQL_UPSERT = """
-INSERT INTO fight(external_id, title, participant1_name, participant2_name, photo_url, description, starts_at, status, winner_participant)
-VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9)
-ON CONFLICT (external_id) DO UPDATE
-   SET title=EXCLUDED.title,
-       participant1_name=EXCLUDED.participant1_name,
-       participant2_name=EXCLUDED.participant2_name,
-       photo_url=EXCLUDED.photo_url,
-       description=EXCLUDED.description,
-       starts_at=EXCLUDED.starts_at,
-       status=EXCLUDED.status,
-       winner_participant=EXCLUDED.winner_participant
-RETURNING id;
+WITH old AS (
+    SELECT f.external_id, f.photo_url
+    FROM fight f JOIN fight_sync s USING (external_id)
+), up AS (
+    INSERT INTO fight(external_id, title, participant1_name, participant2_name, photo_url, description, starts_at, status, winner_participant)
+    SELECT external_id, title, participant1_name, participant2_name, photo_url, description, starts_at, status, winner_participant
+    FROM fight_sync
+    ON CONFLICT (external_id) DO UPDATE
+       SET title=EXCLUDED.title,
+           participant1_name=EXCLUDED.participant1_name,
+           participant2_name=EXCLUDED.participant2_name,
+           photo_url=EXCLUDED.photo_url,
+           description=EXCLUDED.description,
+           starts_at=EXCLUDED.starts_at,
+           status=CASE WHEN fight.result_by IS NULL THEN EXCLUDED.status ELSE fight.status END,
+           winner_participant=CASE WHEN fight.result_by IS NULL THEN EXCLUDED.winner_participant
+                                   ELSE fight.winner_participant END
+     WHERE (fight.title, fight.participant1_name, fight.participant2_name, fight.photo_url,
+            fight.description, fight.starts_at)
+           IS DISTINCT FROM
+           (EXCLUDED.title, EXCLUDED.participant1_name, EXCLUDED.participant2_name, EXCLUDED.photo_url,
+            EXCLUDED.description, EXCLUDED.starts_at)
+        OR (fight.result_by IS NULL
+            AND (fight.status, fight.winner_participant) IS DISTINCT FROM (EXCLUDED.status, EXCLUDED.winner_participant))
+    RETURNING external_id, photo_url
+)
+SELECT old.photo_url AS old_photo_url
+FROM up JOIN old USING (external_id)
+WHERE old.photo_url IS NOT NULL AND old.photo_url IS DISTINCT FROM up.photo_url
 """
 
+
+async def upsert_rows(rows: List[FightRow]) -> List[str]:
+    """COPY в staging + один upsert. Возвращает photo_url, которые больше не используются."""
+    if not rows:
+        return []
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(SQL_STAGE)
+            await conn.copy_records_to_table(
+                "fight_sync", records=[r.record() for r in rows], columns=list(FightRow.COPY_COLUMNS),
+            )
+            return [r["old_photo_url"] for r in await conn.fetch(SQL_UPSERT)]
+
 async def sync_once():
-    items = fetch_fights_from_sheet()
-    for it in items:
-        fid = await db.fetchval(SQL_UPSERT,
-                                it["external_id"],
-                                it["title"],
-                                it["p1"],
-                                it["p2"],
-                                it["photo_url"],
-                                it["description"],
-                                it["starts_at"],
-                                it["status"],
-                                it["winner"])
+    rows = fetch_fights_from_sheet()
+    stale_photos = await upsert_rows(rows)
+    # сменилась картинка — закешированный file_id старой больше не нужен
+    await db.forget_file_ids(stale_photos)
     # Также можно удалять из БД те external_id, которых нет в таблице — по желанию
 
 async def main():
@@ -55,4 +96,4 @@ async def main():
         print("[SYNC] done.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+# app/tg.py
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+
+from .config import settings
+from .instrumentation import instrument_bot
+
+
+def make_bot() -> Bot:
+    """
+    Bot с HTML по умолчанию и метриками запросов.
+    TELEGRAM_API_URL — свой Bot API сервер (local bot-api или фейк из bench/).
+    """
+    session = None
+    if settings.TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_URL))
+    return instrument_bot(Bot(
+        settings.BOT_TOKEN,
+        session=session,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    ))
+
+
+_bot: Optional[Bot] = None
+
+
+def get_bot() -> Bot:
+    """Общий Bot процесса: создаётся при первом обращении, а не при импорте модуля."""
+    global _bot
+    if _bot is None:
+        _bot = make_bot()
+    return _bot
@@ -0,0 +1,192 @@
+# app/tracing.py
+"""
+Лёгкие трейсы «ставка -> счёт -> оплата -> сделка -> выплата» без внешних сервисов.
+
+Связь между процессами (bot / settlement_worker) — детерминированный trace_id,
+вычисляемый из invoice_id: любой хоп, знающий номер счёта, пишет спаны в тот же
+трейс. Сделка ссылается на трейсы обоих счетов через links + атрибут deal_id.
+
+Спаны копятся в корне трейса и пишутся одной пачкой, когда корень закрыт,
+поэтому корень можно «перепривязать» к счёту уже после createInvoice
+(sp.bind_invoice). Формат — JSONL, поля как в OTLP/JSON (traceId, spanId,
+parentSpanId, startTimeUnixNano, ...). TRACE_FILE пустой — трейсинг выключен.
+
+    with tracing.span("cb_amount", fight_id=fid) as sp:
+        inv = await cryptopay.create_invoice(...)
+        sp.bind_invoice(inv["invoice_id"])
+
+    python -m app.tracing traces.jsonl   # сводка p50/p99 по хопам
+"""
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from .config import settings
+
+SERVICE = "app"
+
+
+def set_service(name: str) -> None:
+    global SERVICE
+    SERVICE = name
+
+
+def trace_id_for_invoice(invoice_id: int) -> str:
+    return hashlib.sha1(f"invoice:{int(invoice_id)}".encode()).hexdigest()[:32]
+
+
+class _Trace:
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start_ns", "end_ns", "attrs", "links", "status")
+
+    def __init__(self, trace: _Trace, name: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attrs = attrs
+        self.links: List[Dict[str, Any]] = []
+        self.status = "ok"
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update({k: v for k, v in attrs.items() if v is not None})
+
+    def bind_invoice(self, invoice_id: int) -> None:
+        """Переключить весь (ещё не выгруженный) трейс на trace_id счёта."""
+        self.attrs["invoice_id"] = int(invoice_id)
+        self.trace.trace_id = trace_id_for_invoice(invoice_id)
+
+    def link_invoice(self, invoice_id: Optional[int], **attrs: Any) -> None:
+        if invoice_id:
+            self.links.append({"traceId": trace_id_for_invoice(invoice_id),
+                               "attributes": {"invoice_id": int(invoice_id), **attrs}})
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.end_ns or time.time_ns()
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "service": SERVICE,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": end,
+            "durationMs": round((end - self.start_ns) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attrs,
+            "links": self.links,
+        }
+
+
+class _NoopSpan:
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def bind_invoice(self, invoice_id: int) -> None:
+        pass
+
+    def link_invoice(self, invoice_id: Optional[int], **attrs: Any) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+_current: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+_out = None
+
+
+def _export(trace: _Trace) -> None:
+    global _out
+    if _out is None:
+        _out = open(settings.TRACE_FILE, "a", encoding="utf-8", buffering=1)
+    _out.write("".join(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + "\n" for s in trace.spans))
+
+
+@contextmanager
+def span(
+    name: str,
+    *,
+    invoice_id: Optional[int] = None,
+    child_only: bool = False,
+    **attrs: Any,
+) -> Iterator[Any]:
+    """
+    Вложенный спан, если в контексте есть открытый родитель; иначе корень
+    нового трейса (trace_id от invoice_id, если он задан).
+    child_only=True — без родителя ничего не пишем (для низкоуровневых вызовов
+    вроде запросов к Crypto Pay, которые делаются и вне трейсов).
+    """
+    if not settings.TRACE_FILE:
+        yield _NOOP
+        return
+
+    parent = _current.get()
+    if parent is not None and parent.end_ns is not None:
+        parent = None   # родитель уже закрыт (например, create_task из хендлера)
+    if parent is None and child_only:
+        yield _NOOP
+        return
+
+    attrs = {k: v for k, v in attrs.items() if v is not None}
+    if invoice_id is not None:
+        attrs["invoice_id"] = int(invoice_id)
+    if parent is None:
+        trace = _Trace(trace_id_for_invoice(invoice_id) if invoice_id else os.urandom(16).hex())
+    else:
+        trace = parent.trace
+    sp = Span(trace, name, parent.span_id if parent else None, attrs)
+    trace.spans.append(sp)
+
+    token = _current.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.status = "error"
+        sp.attrs["error"] = repr(e)
+        raise
+    finally:
+        sp.end_ns = time.time_ns()
+        _current.reset(token)
+        if parent is None:
+            try:
+                _export(trace)
+            except Exception as e:
+                print(f"[TRACE] export failed: {e!r}")
+
+
+# ===== CLI: сводка по хопам =====
+
+def _summary(path: str) -> None:
+    durations: Dict[str, List[float]] = {}
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            durations.setdefault(f"{rec.get('service')}:{rec['name']}", []).append(float(rec["durationMs"]))
+
+    def pct(xs: List[float], q: float) -> float:
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+    print(f"{'hop':<48}{'n':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, xs in sorted(durations.items()):
+        xs.sort()
+        print(f"{name:<48}{len(xs):>8}{pct(xs, .5):>10.1f}{pct(xs, .99):>10.1f}{xs[-1]:>10.1f}")
+
+
+if __name__ == "__main__":
+    import sys
+    _summary(sys.argv[1] if len(sys.argv) > 1 else settings.TRACE_FILE)
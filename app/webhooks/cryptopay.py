@@ -2,7 +2,7 @@ from fastapi import FastAPI, Request, HTTPException
 from pydantic import BaseModel
 
 from ..config import settings
-from ..db import get_pool
+from ..db import acquire, legs_deposit, post_ledger
 from ..payments.cryptopay import verify_signature
 
 app = FastAPI(title="CryptoPay Webhook")
@@ -43,18 +43,8 @@ async def cryptopay_webhook(req: Request):
 
     cents = int(round(inv.amount * 100))
 
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
-            # Идемпотентность по external_ref
-            result = await conn.execute(
-                "INSERT INTO ledger(user_id, kind, amount_cents, external_ref) "
-                "VALUES ($1,'deposit',$2,$3) ON CONFLICT (external_ref) DO NOTHING",
-                user_id, cents, f"invoice:{inv.invoice_id}:{inv.asset}"
-            )
-            if result.endswith("1"):
-                await conn.execute(
-                    "UPDATE app_user SET balance_cents=balance_cents+$1 WHERE id=$2",
-                    cents, user_id
-                )
+            # Идемпотентность по txn_ref; баланс догонит materialize_balances
+            await post_ledger(conn, f"invoice:{inv.invoice_id}", legs_deposit(user_id, cents))
     return {"ok": True}
@@ -0,0 +1,158 @@
+# bench/bench_archive.py
+"""
+Горячие запросы сделок на большой истории: --history settled-сделок (по
+умолчанию 10M, с payout) по завершённым боям, разнесённых по году, плюс живая
+книга по предстоящим боям. Три замера одних и тех же запросов:
+
+  legacy    — история в deal, без частичных индексов горячих статусов;
+  partial   — частичные индексы (deal_open_idx, deal_active_user*_idx);
+  archived  — после archive.archive_once(): история в deal_archive по месяцам.
+
+    PGDATABASE=fightbot_bench python -m bench.bench_archive
+    PGDATABASE=fightbot_bench python -m bench.bench_archive --history 1000000 --reps 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+STEP = 1_000_000
+
+SQL_HISTORY = """
+INSERT INTO deal (fight_id, user1_id, participant1, amount1_cents, paid1, invoice1_id,
+                  user2_id, participant2, amount2_cents, paid2, invoice2_id, status, created_at)
+SELECT f.ids[1 + g % array_length(f.ids, 1)],
+       1 + g % $3, 1, 800, TRUE, 2 * g,
+       1 + (g + 7) % $3, 2, 800, TRUE, 2 * g + 1,
+       'settled', now() - (g % 400) * interval '1 day'
+FROM generate_series($1::bigint, $2::bigint) g,
+     (SELECT array_agg(id) AS ids FROM fight WHERE status = 'done') f
+"""
+
+SQL_HISTORY_PAYOUTS = """
+INSERT INTO payout (deal_id, user_id, kind, amount_cents, fee_cents, status, batch_ref, created_at, sent_at)
+SELECT id, user1_id, 'win', 1440, 160, 'sent', 'win:' || id || ':' || user1_id, created_at, created_at
+FROM deal WHERE id BETWEEN $1 AND $2
+"""
+
+# живая книга: awaiting_match и matched по предстоящим боям
+SQL_LIVE = """
+INSERT INTO deal (fight_id, user1_id, participant1, amount1_cents, paid1, invoice1_id,
+                  user2_id, participant2, amount2_cents, paid2, invoice2_id, status)
+SELECT f.ids[1 + g % array_length(f.ids, 1)],
+       1 + (g * 31) % $2, 1 + g % 2, 100 * (1 + g % 8), TRUE, 1000000000000 + g,
+       CASE WHEN g % 3 = 0 THEN 1 + (g * 17) % $2 END,
+       CASE WHEN g % 3 = 0 THEN 2 - g % 2 END,
+       CASE WHEN g % 3 = 0 THEN 100 * (1 + g % 8) END,
+       g % 3 = 0, NULL,
+       CASE WHEN g % 3 = 0 THEN 'matched' ELSE 'awaiting_match' END
+FROM generate_series(1, $1) g,
+     (SELECT array_agg(id) AS ids FROM fight WHERE status <> 'done') f
+"""
+
+PARTIAL_INDEXES = ("deal_open_idx", "deal_active_user1_idx", "deal_active_user2_idx")
+
+
+async def _sizes() -> Tuple[int, int]:
+    from app import db
+    live = await db.fetchval("SELECT pg_total_relation_size('deal') + pg_total_relation_size('payout')")
+    arch = await db.fetchval("""
+        SELECT COALESCE(sum(pg_total_relation_size(inhrelid)), 0) FROM pg_inherits
+        WHERE inhparent IN ('deal_archive'::regclass, 'payout_archive'::regclass)
+    """)
+    return int(live), int(arch)
+
+
+async def _measure(queries: Dict[str, Callable[[], Any]], reps: int) -> Dict[str, Tuple[float, float]]:
+    out: Dict[str, Tuple[float, float]] = {}
+    for name, run in queries.items():
+        lat: List[float] = []
+        for _ in range(reps):
+            t0 = time.perf_counter()
+            await run()
+            lat.append(time.perf_counter() - t0)
+        lat.sort()
+        out[name] = (statistics.mean(lat) * 1000, lat[int(0.95 * (len(lat) - 1))] * 1000)
+    return out
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, default=10_000_000, help="settled deals")
+    parser.add_argument("--live", type=int, default=30_000, help="open + matched deals")
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--reps", type=int, default=200)
+    parser.add_argument("--force", action="store_true", help="allow a PGDATABASE without 'bench' in its name")
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN")
+    os.environ.setdefault("CRYPTO_PAY_TOKEN", "bench")
+    # сидирование и архивирование — долгие запросы
+    os.environ["PG_STATEMENT_TIMEOUT_MS"] = "0"
+    os.environ["PG_COMMAND_TIMEOUT"] = "3600"
+
+    from app import archive, db, settlement_worker
+    from . import seed
+
+    seed.check_target(args.force)
+    await seed.reset()
+    await seed.seed_users(args.users)
+    fight_ids = await seed.seed_fights(200, done=150)
+    live_fights = fight_ids[150:]
+
+    t0 = time.perf_counter()
+    for lo in range(1, args.history + 1, STEP):
+        hi = min(args.history, lo + STEP - 1)
+        await db.execute(SQL_HISTORY, lo, hi, args.users)
+        await db.execute(SQL_HISTORY_PAYOUTS, lo, hi)
+        print(f"[BENCH] history {hi}/{args.history} ({time.perf_counter() - t0:.0f}s)")
+    await db.execute(SQL_LIVE, args.live, args.users)
+    await db.execute("VACUUM ANALYZE deal")
+    await db.execute("VACUUM ANALYZE payout")
+
+    rnd = random.Random(1)
+    users = lambda: 1 + rnd.randrange(args.users)   # noqa: E731
+    fights = lambda: rnd.choice(live_fights)        # noqa: E731
+    queries: Dict[str, Callable[[], Any]] = {
+        "deals_open": lambda: db.list_open_deals(fights(), stale_ok=False),
+        "deal_find_opposite": lambda: db.q_fetchrow("deal_find_opposite", fights(), 1, 100 * (1 + rnd.randrange(8)), users()),
+        "deals_my_active": lambda: db.list_my_active_deals(users()),
+        "deals_shareable": lambda: db.list_shareable_deals(users()),
+        "fights_to_settle": lambda: db.fetch(settlement_worker.SQL_FIGHTS_TO_SETTLE),
+    }
+
+    results: Dict[str, Dict[str, Tuple[float, float]]] = {}
+    for idx in PARTIAL_INDEXES:
+        await db.execute(f"DROP INDEX IF EXISTS {idx}")
+    results["legacy"] = await _measure(queries, args.reps)
+    sizes = {"legacy": await _sizes()}
+
+    await db.init_db()   # схема заново создаёт частичные индексы
+    await db.execute("ANALYZE deal")
+    results["partial"] = await _measure(queries, args.reps)
+
+    t0 = time.perf_counter()
+    moved = await archive.archive_once()
+    took = time.perf_counter() - t0
+    await db.execute("VACUUM ANALYZE deal")
+    await db.execute("VACUUM ANALYZE payout")
+    results["archived"] = await _measure(queries, args.reps)
+    sizes["archived"] = await _sizes()
+
+    print(f"archived {moved} deals in {took:.0f}s ({moved / max(took, 1e-9):.0f} deals/s), "
+          f"{await db.fetchval('SELECT count(*) FROM pg_inherits WHERE inhparent = $1::regclass', 'deal_archive')} "
+          f"monthly partitions")
+    for state, (live, arch) in sizes.items():
+        print(f"size {state:<9} deal+payout {live / 2 ** 20:8.0f} MiB, archive {arch / 2 ** 20:8.0f} MiB")
+    print(f"{'query':<20}" + "".join(f"{s:>22}" for s in results) + "   (mean / p95 ms)")
+    for name in queries:
+        print(f"{name:<20}" + "".join(f"{r[name][0]:>12.2f} /{r[name][1]:>7.2f}" for r in results.values()))
+
+    await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+# bench/bench_cryptopay.py
+"""
+Клиент Crypto Pay под сбоями: FakeCryptoPay с инъекцией ошибок, БД не нужна.
+
+  flaky   — 20% ответов 503: доля успешных getInvoices с ретраями и без;
+  tail    — 5% ответов медленные (2 с): p99 getInvoices с хеджем и без;
+  outage  — API лежит: сколько ждёт createInvoice (fail fast после открытия
+            breaker) и сколько запросов долетело до апстрима; потом API
+            поднимается, пробный запрос закрывает breaker.
+
+    python -m bench.bench_cryptopay
+    python -m bench.bench_cryptopay --only outage --requests 500
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+
+def _pct(xs: List[float], q: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--cp-port", type=int, default=18082)
+    parser.add_argument("--cp-latency-ms", type=float, default=30.0)
+    parser.add_argument("--only", default="flaky,tail,outage")
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN")
+    os.environ["CRYPTO_PAY_TOKEN"] = "bench"
+    os.environ["CRYPTO_PAY_API_URL"] = f"http://127.0.0.1:{args.cp_port}/api"
+
+    from app.config import get_settings
+    from app.payments import cryptopay
+    from .fakes import FakeCryptoPay
+
+    cfg = get_settings()
+    cp = await FakeCryptoPay(args.cp_port, args.cp_latency_ms).start()
+    inv_ids = [cp._m_createInvoice({"asset": "USDT", "amount": 1})["invoice_id"] for _ in range(50)]
+    only = set(args.only.split(","))
+
+    def configure(**kw: Any) -> None:
+        for k, v in kw.items():
+            setattr(cfg, k, v)
+        cryptopay._breaker = None
+        cryptopay._budget = None
+        cp.calls.clear()
+
+    async def run(call, n: int) -> Tuple[int, List[float], Dict[str, int]]:
+        sem = asyncio.Semaphore(args.concurrency)
+        lat: List[float] = []
+        errors: Dict[str, int] = {}
+        ok = 0
+
+        async def one(i: int) -> None:
+            nonlocal ok
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    await call(i)
+                    ok += 1
+                except Exception as e:
+                    name = type(e).__name__
+                    errors[name] = errors.get(name, 0) + 1
+                lat.append(time.perf_counter() - t0)
+
+        await asyncio.gather(*(one(i) for i in range(n)))
+        return ok, lat, errors
+
+    def get_invoices(i: int):
+        return cryptopay.get_invoices(inv_ids[i % len(inv_ids): i % len(inv_ids) + 5])
+
+    def report(label: str, n: int, res: Tuple[int, List[float], Dict[str, int]]) -> None:
+        ok, lat, errors = res
+        upstream = sum(cp.calls.values())
+        print(f"{label:<28}{ok / n * 100:>7.1f}%{_pct(lat, 0.5):>9.0f}{_pct(lat, 0.99):>9.0f}"
+              f"{upstream:>10}  {errors or ''}")
+
+    print(f"{'scenario':<28}{'ok':>8}{'p50 ms':>9}{'p99 ms':>9}{'upstream':>10}")
+
+    if "flaky" in only:
+        cp.error_rate = 0.2
+        for retries in (0, 2):
+            configure(CRYPTO_PAY_RETRIES=retries, CRYPTO_PAY_HEDGE_MS=0, CRYPTO_PAY_BREAKER_FAILURES=0)
+            report(f"flaky 20% retries={retries}", args.requests, await run(get_invoices, args.requests))
+        cp.error_rate = 0.0
+
+    if "tail" in only:
+        cp.slow_rate, cp.slow_ms = 0.05, 2000
+        for hedge in (0, 150):
+            configure(CRYPTO_PAY_RETRIES=2, CRYPTO_PAY_HEDGE_MS=hedge, CRYPTO_PAY_BREAKER_FAILURES=5)
+            report(f"tail 5%x2s hedge={hedge}ms", args.requests, await run(get_invoices, args.requests))
+        cp.slow_rate = 0.0
+
+    if "outage" in only:
+        cp.down = True
+        for failures in (0, 5):
+            configure(CRYPTO_PAY_RETRIES=2, CRYPTO_PAY_HEDGE_MS=0,
+                      CRYPTO_PAY_BREAKER_FAILURES=failures, CRYPTO_PAY_BREAKER_COOLDOWN_S=2.0)
+            res = await run(lambda i: cryptopay.create_invoice(100, "USDT", "{}"), args.requests)
+            report(f"outage breaker={'on' if failures else 'off'}", args.requests, res)
+        print(f"breaker state: {cryptopay.state()}")
+        cp.down = False
+        await asyncio.sleep(2.1)
+        await cryptopay.get_invoices(inv_ids[:1])
+        print(f"after recovery probe: {cryptopay.state()['state']}")
+
+    await cryptopay.close()
+    await cp.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,178 @@
+# bench/bench_keyboards.py
+"""
+Микро-бенчмарк клавиатур: legacy (сборка pydantic-моделей на каждый вызов,
+как было в bot.py) против app.keyboards (статичные + memo).
+
+  build   — CPU на один вызов kb_* (мкс);
+  update  — CPU процесса на один callback-апдейт «bet_side» через Dispatcher
+            (фейковый Telegram в том же процессе без задержки, БД не нужна).
+            Сборка клавиатуры — малая доля апдейта, поэтому прогоны legacy/new
+            чередуются --rounds раз и печатаются медиана и разброс: если
+            разброс отношения накрывает 1.0, разницы на апдейт нет.
+
+    python -m bench.bench_keyboards --iterations 20000 --updates 3000 --rounds 9
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Mapping
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+AMOUNTS_USDT = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+
+# ===== legacy: как было в bot.py =====
+
+def legacy_kb_main() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📅 События", callback_data="events")],
+        [InlineKeyboardButton(text="🎟 Текущие ставки", callback_data="mybets")],
+        [InlineKeyboardButton(text="📤 Поделиться ставкой", callback_data="share")],
+        [InlineKeyboardButton(text="💰 Баланс", callback_data="balance")],
+    ])
+
+
+def legacy_kb_amounts(fid: int, side: int) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    row: List[InlineKeyboardButton] = []
+    for i, amt in enumerate(AMOUNTS_USDT, start=1):
+        row.append(InlineKeyboardButton(text=f"{amt} USDT", callback_data=f"bet_amt:{fid}:{side}:{amt}"))
+        if i % 3 == 0:
+            rows.append(row); row = []
+    if row: rows.append(row)
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fid}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def legacy_kb_fight(f: Mapping[str, Any]) -> InlineKeyboardMarkup:
+    p1 = f["participant1_name"]; p2 = f["participant2_name"]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"Поставить на {p1}", callback_data=f"bet_side:{f['id']}:1")],
+        [InlineKeyboardButton(text=f"Поставить на {p2}", callback_data=f"bet_side:{f['id']}:2")],
+        [InlineKeyboardButton(text="📜 Открытые ставки", callback_data=f"open:{f['id']}")],
+        [InlineKeyboardButton(text="⬅️ К событиям", callback_data="events")],
+    ])
+
+
+def legacy_kb_share_pick_chat(deal_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📤 Отправить другу", switch_inline_query=f"reply_{deal_id}")],
+        [InlineKeyboardButton(text="⬅️ В меню", callback_data="back_main")],
+    ])
+
+
+def legacy_kb_open_deals(fight_id: int, deals: List[Mapping[str, Any]]) -> InlineKeyboardMarkup:
+    rows = []
+    for d in deals[:20]:
+        side = d["participant1"]; amt = d["amount1_cents"] / 100
+        rows.append([InlineKeyboardButton(
+            text=f"Ответить: {amt:.2f} USDT (на {'P2' if side==1 else 'P1'})",
+            callback_data=f"reply:{d['id']}"
+        )])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"fight:{fight_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def _cpu_us(fn: Callable[[int], Any], iterations: int) -> float:
+    t0 = time.process_time()
+    for i in range(iterations):
+        fn(i)
+    return (time.process_time() - t0) / iterations * 1e6
+
+
+def bench_build(iterations: int, fights: int) -> None:
+    from app import keyboards as kb
+
+    fight = {"id": 1, "participant1_name": "Alpha", "participant2_name": "Bravo"}
+    books = [[{"id": 100 * f + k, "participant1": 1 + k % 2, "amount1_cents": 100 * (1 + k)} for k in range(8)]
+             for f in range(fights)]
+    cases: Dict[str, List[Callable[[int], Any]]] = {
+        "kb_main": [lambda i: legacy_kb_main(), lambda i: kb.kb_main()],
+        "kb_amounts": [lambda i: legacy_kb_amounts(i % fights, 1 + i % 2),
+                       lambda i: kb.kb_amounts(i % fights, 1 + i % 2)],
+        "kb_fight": [lambda i: legacy_kb_fight(fight), lambda i: kb.kb_fight(fight)],
+        "kb_open_deals": [lambda i: legacy_kb_open_deals(i % fights, books[i % fights]),
+                          lambda i: kb.kb_open_deals(i % fights, books[i % fights])],
+        "kb_share_pick_chat": [lambda i: legacy_kb_share_pick_chat(i % 1000),
+                               lambda i: kb.kb_share_pick_chat(i % 1000)],
+    }
+    print(f"{'build':<22}{'legacy us':>12}{'new us':>12}{'x':>8}")
+    for name, (old, new) in cases.items():
+        a, b = _cpu_us(old, iterations), _cpu_us(new, iterations)
+        print(f"{name:<22}{a:>12.2f}{b:>12.2f}{a / b if b else 0:>8.1f}")
+
+
+async def bench_updates(updates: int, fights: int, port: int, rounds: int) -> None:
+    from aiogram.types import Update
+    from app import bot as app_bot
+    from .fakes import FakeTelegram
+
+    tg = await FakeTelegram(port).start()
+    bot = app_bot.bot
+
+    def cb(i: int) -> Update:
+        return Update.model_validate({
+            "update_id": i,
+            "callback_query": {
+                "id": str(i),
+                "chat_instance": "bench",
+                "from": {"id": 7, "is_bot": False, "first_name": "Bench"},
+                "data": f"bet_side:{i % fights}:{1 + i % 2}",
+                "message": {"message_id": i, "date": int(time.time()),
+                            "chat": {"id": 7, "type": "private"}, "text": "menu"},
+            },
+        }, context={"bot": bot})
+
+    async def run() -> float:
+        batch = [cb(i) for i in range(updates)]
+        t0 = time.process_time()
+        for u in batch:
+            await app_bot.dp.feed_update(bot, u)
+        return (time.process_time() - t0) / updates * 1e6
+
+    new_kb = app_bot.kb_amounts
+    times: Dict[str, List[float]] = {"legacy": [], "new": []}
+    ratios: List[float] = []
+    try:
+        await run()                              # прогрев (импорты, пул соединений aiohttp)
+        for r in range(rounds):
+            # чередуем порядок, чтобы дрейф (GC, частота CPU) не доставался одному варианту
+            got: Dict[str, float] = {}
+            for name in (("legacy", "new") if r % 2 == 0 else ("new", "legacy")):
+                app_bot.kb_amounts = legacy_kb_amounts if name == "legacy" else new_kb  # type: ignore[assignment]
+                got[name] = await run()
+                times[name].append(got[name])
+            ratios.append(got["legacy"] / got["new"])
+    finally:
+        app_bot.kb_amounts = new_kb              # type: ignore[assignment]
+        await bot.session.close()
+        await tg.stop()
+    print(f"\n{'update bet_side':<22}{'median':>10}{'min':>10}{'max':>10}   (us CPU, incl. fake Telegram, {rounds} rounds)")
+    for name, xs in times.items():
+        print(f"  {name:<20}{statistics.median(xs):>10.1f}{min(xs):>10.1f}{max(xs):>10.1f}")
+    print(f"  {'legacy/new':<20}{statistics.median(ratios):>10.2f}{min(ratios):>10.2f}{max(ratios):>10.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--fights", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=9)
+    parser.add_argument("--tg-port", type=int, default=18083)
+    args = parser.parse_args()
+
+    # до импорта app: бот смотрит только в локальную заглушку
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN")
+    os.environ.setdefault("CRYPTO_PAY_TOKEN", "bench")
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.tg_port}"
+
+    bench_build(args.iterations, args.fights)
+    asyncio.run(bench_updates(args.updates, args.fights, args.tg_port, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# bench/bench_notify.py
+"""
+Результат боя -> выплата: settlement_worker.loop в фоне против бенч-Postgres
+и заглушек Telegram / Crypto Pay.
+
+  idle     — сколько транзакций делает воркер, пока ничего не происходит
+             (pg_stat_database.xact_commit за окно, минус наши замеры);
+  latency  — UPDATE fight SET status='done' -> все payout отправлены.
+--poll-only имитирует старое поведение: без LISTEN, полный проход каждые 5 с.
+
+    PGDATABASE=fightbot_bench python -m bench.bench_notify --deals 200
+    PGDATABASE=fightbot_bench python -m bench.bench_notify --deals 200 --poll-only
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import List
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--deals", type=int, default=200, help="matched deals per fight")
+    parser.add_argument("--rounds", type=int, default=5, help="fights finished one after another")
+    parser.add_argument("--idle-s", type=float, default=30.0)
+    parser.add_argument("--poll-only", action="store_true")
+    parser.add_argument("--tg-port", type=int, default=18081)
+    parser.add_argument("--cp-port", type=int, default=18082)
+    parser.add_argument("--force", action="store_true", help="allow a PGDATABASE without 'bench' in its name")
+    args = parser.parse_args()
+
+    os.environ["BOT_TOKEN"] = "123456:BENCH-TOKEN"
+    os.environ["CRYPTO_PAY_TOKEN"] = "bench"
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.tg_port}"
+    os.environ["CRYPTO_PAY_API_URL"] = f"http://127.0.0.1:{args.cp_port}/api"
+
+    from app import db, settlement_worker
+    from app.payments import cryptopay
+    from app.tg import get_bot
+    from . import seed
+    from .fakes import FakeCryptoPay, FakeTelegram
+
+    seed.check_target(args.force)
+    tg = await FakeTelegram(args.tg_port).start()
+    cp = await FakeCryptoPay(args.cp_port).start()
+    await seed.reset()
+    await seed.seed_users(500)
+    fight_ids = await seed.seed_fights(args.rounds + 1)
+    for fid in fight_ids[:args.rounds]:
+        await seed.seed_matched_deals(args.deals, fid, 500)
+
+    if args.poll_only:
+        settlement_worker._listen = lambda wake: asyncio.sleep(0)  # type: ignore[assignment]
+    bot = get_bot()
+    worker = asyncio.create_task(settlement_worker.loop(bot, batch=500))
+    await asyncio.sleep(1.0)
+
+    xact_sql = "SELECT xact_commit FROM pg_stat_database WHERE datname = current_database()"
+    before = await db.fetchval(xact_sql)
+    await asyncio.sleep(args.idle_s)
+    after = await db.fetchval(xact_sql)
+    idle_tx = after - before - 1   # минус первый замер
+
+    unsent_sql = "SELECT count(*) FROM payout WHERE status <> 'sent'"
+    open_sql = "SELECT count(*) FROM deal WHERE fight_id=$1 AND status='matched'"
+    lat: List[float] = []
+    for fid in fight_ids[:args.rounds]:
+        t0 = time.perf_counter()
+        await db.execute("UPDATE fight SET status='done', winner_participant=1 WHERE id=$1", fid)
+        while await db.fetchval(open_sql, fid) or await db.fetchval(unsent_sql):
+            await asyncio.sleep(0.02)
+            if time.perf_counter() - t0 > 120:
+                print(f"[BENCH] fight {fid} not paid out after 120s")
+                break
+        lat.append(time.perf_counter() - t0)
+
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
+    print(f"mode            {'poll every 5s' if args.poll_only else 'LISTEN fight_done + safety poll'}")
+    print(f"idle            {idle_tx} transaction(s) in {args.idle_s:.0f}s ({idle_tx / args.idle_s * 60:.1f}/min)")
+    print(f"result->payout  p50 {statistics.median(lat) * 1000:.0f} ms, max {max(lat) * 1000:.0f} ms "
+          f"({args.deals} deals per fight, {len(lat)} fights)")
+    print(f"transfers       {len(cp.transfers)}")
+
+    await bot.session.close()
+    await cryptopay.close()
+    await db.close_pool()
+    await tg.stop()
+    await cp.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+# bench/bench_payout_hold.py
+"""
+Выплата переводом не должна попадать в доступный баланс до перевода: расчёт
+зачисляет её на hold, и пока пачка висит в 'sending' (Crypto Pay лежит),
+get_balance и reserve_withdrawal её не видят. Сценарии на одной сделке 8+8:
+
+  down      — settle, перевод падает транзиентно: баланс не меняется, пачка ждёт;
+  rejected  — Crypto Pay окончательно отказал: выплата возвращается на баланс;
+  ok        — перевод прошёл: баланс не меняется, hold обнуляется.
+
+    PGDATABASE=fightbot_bench python -m bench.bench_payout_hold
+"""
+import argparse
+import asyncio
+import os
+from typing import List, Tuple
+
+SQL_HOLD = "SELECT COALESCE(sum(amount_cents), 0) FROM ledger WHERE account = 'hold' AND user_id = $1"
+SQL_BATCH = "SELECT array_agg(DISTINCT status) FROM payout WHERE deal_id = $1 AND amount_cents > 0"
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tg-port", type=int, default=18081)
+    parser.add_argument("--cp-port", type=int, default=18082)
+    parser.add_argument("--force", action="store_true", help="allow a PGDATABASE without 'bench' in its name")
+    args = parser.parse_args()
+
+    os.environ["BOT_TOKEN"] = "123456:BENCH-TOKEN"
+    os.environ["CRYPTO_PAY_TOKEN"] = "bench"
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.tg_port}"
+    os.environ["CRYPTO_PAY_API_URL"] = f"http://127.0.0.1:{args.cp_port}/api"
+    os.environ["PAYOUT_TO_BALANCE"] = "false"
+    os.environ["DEAL_EXPIRE_AT_START"] = "false"   # бои из сида могут быть «в прошлом»
+
+    from app import db, settlement_worker
+    from app.payments import cryptopay
+    from app.tg import get_bot
+    from . import seed
+    from .fakes import FakeCryptoPay, FakeTelegram
+
+    seed.check_target(args.force)
+    tg = await FakeTelegram(args.tg_port).start()
+    cp = await FakeCryptoPay(args.cp_port).start()
+    await seed.reset()
+    await seed.seed_users(2)
+    fight_ids = await seed.seed_fights(3)
+    winner, loser = 1, 2
+    bot = get_bot()
+
+    async def state(deal_id: int) -> Tuple[int, int, List[str]]:
+        return (await db.get_balance(winner), int(await db.fetchval(SQL_HOLD, winner)),
+                list(await db.fetchval(SQL_BATCH, deal_id) or []))
+
+    rows: List[Tuple[str, str, Tuple[int, int, List[str]]]] = []
+    ok = True
+    for n, (name, mode) in enumerate((("down", "down"), ("rejected", "reject"), ("ok", "ok"))):
+        fid = fight_ids[n]
+        await db.create_deal_after_paid(fid, 1, 800, 10 * n + 1, winner)
+        deal_id = await db.create_deal_after_paid(fid, 2, 800, 10 * n + 2, loser)
+        before = await db.get_balance(winner)
+        rows.append((name, "before settle", await state(deal_id)))
+
+        await db.execute("UPDATE fight SET status='done', winner_participant=1, result_at=now() WHERE id=$1", fid)
+        await settlement_worker.settle_fight(fid)
+        after_settle = await state(deal_id)
+        rows.append((name, "after settle", after_settle))
+        ok &= after_settle[0] == before
+
+        cp.down, cp.reject_transfers = mode == "down", mode == "reject"
+        await settlement_worker._drain(bot)
+        after = await state(deal_id)
+        rows.append((name, "after transfer", after))
+        reserved = await db.reserve_withdrawal(winner, f"withdraw:{winner}:bench{n}")
+        if reserved:
+            await db.cancel_withdrawal(winner, f"withdraw:{winner}:bench{n}", reserved)
+        if mode == "down":
+            ok &= after[0] == before and after[2] == ["sending"] and reserved == before
+        elif mode == "reject":
+            ok &= after[0] == before + after_settle[1] and after[2] == ["sent"]
+        else:
+            ok &= after[0] == before and after[2] == ["sent"]
+        cp.down = cp.reject_transfers = False
+        await settlement_worker._drain(bot)   # пачка «down» уходит, когда Crypto Pay поднялся
+
+    print(f"{'case':<10}{'step':<16}{'balance':>10}{'hold':>8}  payout")
+    for name, step, (bal, hold, st) in rows:
+        print(f"{name:<10}{step:<16}{bal:>10}{hold:>8}  {','.join(st)}")
+    print("balance stays unchanged until the transfer outcome is known:", "OK" if ok else "MISMATCH")
+
+    await cryptopay.close()
+    await bot.session.close()
+    await db.close_pool()
+    await cp.stop()
+    await tg.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
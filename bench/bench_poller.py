@@ -0,0 +1,139 @@
+# bench/bench_poller.py
+"""
+Несколько реплик поллера оплат в одном процессе против бенч-Postgres и
+FakeCryptoPay: каждая со своим ShardLease (своё соединение, свои локи).
+
+Сценарий: волна оплат -> «падение» одной реплики (соединение рвётся без
+unlock, как при kill -9) -> вторая волна; шарды упавшей должны перейти к живым.
+Проверяем, что все счета проведены ровно один раз, и сколько id счетов ушло
+в getInvoices (legacy: каждая реплика опрашивает всё).
+
+    PGDATABASE=fightbot_bench python -m bench.bench_poller --replicas 3 --shards 8
+    PGDATABASE=fightbot_bench python -m bench.bench_poller --replicas 3 --legacy
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--invoices", type=int, default=2000)
+    parser.add_argument("--poll-s", type=float, default=0.5)
+    parser.add_argument("--cp-latency-ms", type=float, default=80.0)
+    parser.add_argument("--cp-port", type=int, default=18082)
+    parser.add_argument("--timeout-s", type=float, default=60.0)
+    parser.add_argument("--legacy", action="store_true", help="no lease: every replica polls every invoice")
+    parser.add_argument("--force", action="store_true", help="allow a PGDATABASE without 'bench' in its name")
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN")
+    os.environ["CRYPTO_PAY_TOKEN"] = "bench"
+    os.environ["CRYPTO_PAY_API_URL"] = f"http://127.0.0.1:{args.cp_port}/api"
+
+    from app import bot as app_bot, db, leases
+    from app.payments import cryptopay
+    from . import seed
+    from .fakes import FakeCryptoPay
+
+    seed.check_target(args.force)
+    cp = await FakeCryptoPay(args.cp_port, args.cp_latency_ms).start()
+    await seed.reset()
+    await seed.seed_users(200)
+    fight_ids = await seed.seed_fights(5)
+    uids = [int(r["id"]) for r in await db.fetch("SELECT id FROM app_user ORDER BY id")]
+
+    for i in range(args.invoices):
+        inv = cp._m_createInvoice({"asset": "USDT", "amount": 1})
+        await db.add_invoice_wait(inv["invoice_id"], "NEW", uids[i % len(uids)], 1 + i % 2, 100,
+                                  fight_id=fight_ids[i % len(fight_ids)], ttl_s=3600)
+
+    polled: List[int] = []
+    get_invoices = cryptopay.get_invoices
+
+    async def counting_get_invoices(ids: List[int]) -> List[dict]:
+        polled.extend(ids)
+        return await get_invoices(ids)
+
+    app_bot.cryptopay.get_invoices = counting_get_invoices  # type: ignore[assignment]
+
+    done: Dict[int, int] = {}
+    owned_log: Dict[int, List[int]] = {}
+
+    async def replica(n: int, lease: Optional[leases.ShardLease]) -> None:
+        done[n] = 0
+        while True:
+            if lease is None:
+                done[n] += await app_bot.payments_tick()
+            else:
+                owned = await lease.refresh()
+                owned_log[n] = owned
+                if owned:
+                    done[n] += await app_bot.payments_tick(lease.shards, owned)
+            await asyncio.sleep(args.poll_s)
+
+    shards = 1 if args.legacy else args.shards
+    lease_list = [None if args.legacy else leases.ShardLease("bench-payments", shards) for _ in range(args.replicas)]
+    tasks = [asyncio.create_task(replica(n, lease)) for n, lease in enumerate(lease_list)]
+
+    # встречные ставки сматчиваются, поэтому считаем проведённые депозиты, а не сделки
+    deposits_sql = "SELECT count(DISTINCT txn_ref) FROM ledger WHERE txn_ref LIKE 'invoice:%'"
+
+    async def wait_paid(target: int) -> bool:
+        deadline = time.monotonic() + args.timeout_s
+        while time.monotonic() < deadline:
+            if await db.fetchval(deposits_sql) >= target:
+                return True
+            await asyncio.sleep(0.1)
+        return False
+
+    invoice_ids = sorted(cp.invoices)
+    half = len(invoice_ids) // 2
+
+    t0 = time.perf_counter()
+    await asyncio.sleep(args.poll_s * 2)      # реплики поделили шарды
+    print(f"[BENCH] shards before failover: {owned_log}")
+    for i in invoice_ids[:half]:
+        cp.invoices[i]["status"] = "paid"
+    ok1 = await wait_paid(half)
+
+    # «kill -9» реплики 0: задача встаёт, соединение рвётся без unlock
+    tasks[0].cancel()
+    if lease_list[0] is not None and lease_list[0]._conn is not None:
+        lease_list[0]._conn.terminate()
+    t_fail = time.perf_counter()
+    for i in invoice_ids[half:]:
+        cp.invoices[i]["status"] = "paid"
+    ok2 = await wait_paid(len(invoice_ids))
+    t_end = time.perf_counter()
+    await asyncio.sleep(args.poll_s * 2)
+    print(f"[BENCH] shards after failover:  {owned_log if not args.legacy else '-'}")
+
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for lease in lease_list:
+        if lease is not None:
+            await lease.release()
+
+    deposits = await db.fetchval(deposits_sql)
+    left = await db.fetchval("SELECT count(*) FROM invoice_wait")
+    print(f"mode            {'legacy (no lease)' if args.legacy else f'lease, {shards} shards'}, replicas={args.replicas}")
+    print(f"finalized       {sum(done.values())} by replica {done}")
+    ok = ok1 and ok2 and deposits == len(invoice_ids) and sum(done.values()) == deposits and not left
+    print(f"deposits        {deposits} of {len(invoice_ids)} invoices, {left} left in invoice_wait  {'OK' if ok else 'FAILED'}")
+    print(f"failover        second wave drained in {t_end - t_fail:.1f}s (total {t_end - t0:.1f}s)")
+    print(f"getInvoices     {cp.calls.get('getInvoices', 0)} calls, {len(polled)} invoice ids polled "
+          f"({len(polled) - len(set(polled))} repeats)")
+
+    await cryptopay.close()
+    await db.close_pool()
+    await cp.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+# bench/bench_queries.py
+"""
+Микро-бенчмарк запросов экрана «события / бой / открытые ставки»:
+  legacy — SELECT * / d.*, новое соединение из пула на каждый запрос;
+  named  — явная проекция колонок (db.STATEMENTS), один conn на «хендлер».
+
+Запуск (нужна живая БД из .env с данными):
+    python -m bench.bench_queries --iterations 2000
+Байты считаются приблизительно — как octet_length текстового представления
+строк на стороне сервера (бинарный протокол asyncpg даёт близкую пропорцию).
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, List, Tuple
+
+from app import db
+
+LEGACY = {
+    "fights_upcoming": """
+        SELECT * FROM fight
+        WHERE status IN ('upcoming','today','live')
+        ORDER BY starts_at NULLS LAST, id
+    """,
+    "fight_by_id": "SELECT * FROM fight WHERE id=$1",
+    "deals_open": """
+        SELECT d.* FROM deal d
+        WHERE d.fight_id = $1 AND d.status = 'awaiting_match'
+        ORDER BY d.id
+    """,
+}
+
+
+async def _bytes(conn, sql: str, *args) -> int:
+    return int(await conn.fetchval(
+        f"SELECT COALESCE(sum(octet_length(t::text)), 0) FROM ({sql}) t", *args
+    ) or 0)
+
+
+async def _legacy_handler(fight_id: int) -> int:
+    rows = 0
+    rows += len(await db.fetch(LEGACY["fights_upcoming"]))
+    rows += 1 if await db.fetchrow(LEGACY["fight_by_id"], fight_id) else 0
+    rows += len(await db.fetch(LEGACY["deals_open"], fight_id))
+    return rows
+
+
+async def _named_handler(fight_id: int) -> int:
+    rows = 0
+    async with db.acquire() as conn:
+        rows += len(await db.q_fetch("fights_upcoming", conn=conn))
+        rows += 1 if await db.get_fight(fight_id, conn=conn) else 0
+        rows += len(await db.list_open_deals(fight_id, conn=conn))
+    return rows
+
+
+async def _measure(handler, fight_ids: List[int], iterations: int, concurrency: int) -> Tuple[int, float]:
+    sem = asyncio.Semaphore(concurrency)
+    total = 0
+
+    async def one(i: int) -> None:
+        nonlocal total
+        async with sem:
+            total += await handler(fight_ids[i % len(fight_ids)])
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(iterations)))
+    return total, time.perf_counter() - t0
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    fight_ids = [int(r["id"]) for r in await db.q_fetch("fights_upcoming")] or [0]
+    fid = fight_ids[0]
+
+    report: List[Tuple[str, Any, Any, Any]] = []
+    async with db.acquire() as conn:
+        for name, sql in LEGACY.items():
+            params = () if "$1" not in sql else (fid,)
+            legacy_b = await _bytes(conn, sql, *params)
+            named_b = await _bytes(conn, db.STATEMENTS[name], *params)
+            report.append((name, legacy_b, named_b, f"{(1 - named_b / legacy_b) * 100:.0f}%" if legacy_b else "-"))
+
+    print(f"{'statement':<20}{'legacy B':>12}{'named B':>12}{'saved':>8}")
+    for name, lb, nb, saved in report:
+        print(f"{name:<20}{lb:>12}{nb:>12}{saved:>8}")
+
+    for label, handler in (("legacy", _legacy_handler), ("named", _named_handler)):
+        await handler(fid)  # прогрев пула и кэша prepared statements
+        rows, dt = await _measure(handler, fight_ids, args.iterations, args.concurrency)
+        print(f"{label:<8} {args.iterations / dt:10.0f} handlers/s  {rows / dt:12.0f} rows/s  ({dt:.2f}s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,148 @@
+# bench/bench_reconcile.py
+"""
+Сверка Crypto Pay <-> база на большом окне: FakeCryptoPay с N оплаченными
+счетами и переводами, в бенч-Postgres — их депозиты и сделки, плюс по --faults
+расхождений каждого вида. Первый проход с --repair, второй — проверка, что
+починенное больше не всплывает (booked_not_paid / settled_no_payout остаются:
+их сверка только репортит).
+
+Пик памяти Python за проход (tracemalloc) не должен расти вместе с N.
+
+    PGDATABASE=fightbot_bench python -m bench.bench_reconcile --invoices 200000
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple
+
+CHUNK = 50_000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invoices", type=int, default=200_000)
+    parser.add_argument("--transfers", type=int, default=20_000)
+    parser.add_argument("--faults", type=int, default=50, help="discrepancies of each kind")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--cp-port", type=int, default=18082)
+    parser.add_argument("--force", action="store_true", help="allow a PGDATABASE without 'bench' in its name")
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN")
+    os.environ["CRYPTO_PAY_TOKEN"] = "bench"
+    os.environ["CRYPTO_PAY_API_URL"] = f"http://127.0.0.1:{args.cp_port}/api"
+
+    from app import db, reconcile
+    from app.payments import cryptopay
+    from . import seed
+    from .fakes import FakeCryptoPay
+
+    seed.check_target(args.force)
+    cp = await FakeCryptoPay(args.cp_port).start()
+    await seed.reset()
+    await seed.seed_users(args.users)
+    fight_ids = await seed.seed_fights(10)
+    users: List[Tuple[int, int]] = [(int(r["id"]), int(r["tg_user_id"]))
+                                    for r in await db.fetch("SELECT id, tg_user_id FROM app_user ORDER BY id")]
+    now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+    k = args.faults
+
+    # --- счета: оплачены в Crypto Pay, проведены в базе; первые k — без депозита и сделки
+    t0 = time.perf_counter()
+    unbooked: List[int] = []
+    for start in range(0, args.invoices, CHUNK):
+        deals, legs = [], []
+        for i in range(start, min(args.invoices, start + CHUNK)):
+            uid, tg = users[i % len(users)]
+            fid, side = fight_ids[i % len(fight_ids)], 1 + i % 2
+            inv = cp._m_createInvoice({"asset": "USDT", "amount": "1.00", "payload": json.dumps(
+                {"kind": "NEW", "participant": side, "amount_cents": 100, "tg_user_id": tg, "fight_id": fid})})
+            inv["status"], inv["paid_at"] = "paid", now
+            if i < k:
+                unbooked.append(inv["invoice_id"])
+                continue
+            deals.append((fid, uid, side, 100, True, inv["invoice_id"], "awaiting_match"))
+            legs += [(f"invoice:{inv['invoice_id']}", 1, "deposit", "cryptopay", None, -100, None),
+                     (f"invoice:{inv['invoice_id']}", 2, "deposit", "user", uid, 100, None)]
+        async with db.acquire() as conn:
+            await conn.copy_records_to_table("deal", records=deals, columns=[
+                "fight_id", "user1_id", "participant1", "amount1_cents", "paid1", "invoice1_id", "status"])
+            await conn.copy_records_to_table("ledger", records=legs, columns=[
+                "txn_ref", "leg", "kind", "account", "user_id", "amount_cents", "deal_id"])
+    # у половины непроведённых запись invoice_wait просрочена, у остальных её нет
+    for inv_id in unbooked[: k // 2]:
+        uid, _ = users[(inv_id - 1) % len(users)]
+        await db.add_invoice_wait(inv_id, "NEW", uid, 1 + (inv_id - 1) % 2, 100,
+                                  fight_id=fight_ids[(inv_id - 1) % len(fight_ids)], ttl_s=0)
+    await db.expire_invoice_waits(grace_s=0)
+
+    async with db.acquire() as conn:
+        # депозиты без оплаченного счёта
+        await conn.copy_records_to_table("ledger", records=[
+            r for j in range(k) for r in (
+                (f"invoice:{10 ** 9 + j}", 1, "deposit", "cryptopay", None, -100, None),
+                (f"invoice:{10 ** 9 + j}", 2, "deposit", "user", users[j][0], 100, None))
+        ], columns=["txn_ref", "leg", "kind", "account", "user_id", "amount_cents", "deal_id"])
+
+        # переводы расчёта: проведены с обеих сторон; k выводов без перевода, k переводов без проводки
+        legs = []
+        for j in range(args.transfers):
+            uid, tg = users[j % len(users)]
+            spend_id = f"win:{j + 1}:{uid}"
+            cp._m_transfer({"spend_id": spend_id, "user_id": tg, "asset": "USDT", "amount": "1.0"})
+            legs += [(f"withdraw:{spend_id}", 1, "withdrawal", "user", uid, -100, None),
+                     (f"withdraw:{spend_id}", 2, "withdrawal", "cryptopay", None, 100, None)]
+        for j in range(k):
+            uid, tg = users[j % len(users)]
+            ref = f"withdraw:{uid}:{uuid.uuid4().hex[:12]}"
+            legs += [(ref, 1, "withdrawal", "user", uid, -250, None), (ref, 2, "withdrawal", "cryptopay", None, 250, None)]
+            cp._m_transfer({"spend_id": f"net:{uid}:{10 ** 6 + j}", "user_id": tg, "asset": "USDT", "amount": "3.0"})
+        await conn.copy_records_to_table("ledger", records=legs, columns=[
+            "txn_ref", "leg", "kind", "account", "user_id", "amount_cents", "deal_id"])
+
+        # settled-сделки без payout
+        await conn.execute("UPDATE fight SET status='done', winner_participant=1, result_at=now() WHERE id=$1",
+                           fight_ids[-1])
+        await conn.copy_records_to_table("deal", records=[
+            (fight_ids[-1], users[j][0], 1, 100, False, "settled") for j in range(k)
+        ], columns=["fight_id", "user1_id", "participant1", "amount1_cents", "paid1", "status"])
+        await conn.execute("ANALYZE")
+    print(f"[BENCH] seeded {args.invoices} invoices, {args.transfers + k} transfers "
+          f"in {time.perf_counter() - t0:.1f}s")
+
+    expected = {
+        "paid_not_booked": k, "booked_not_paid": k, "amount_mismatch": 0, "paid_no_deal": 0,
+        "settled_no_payout": k, "withdrawal_no_transfer": k, "transfer_not_booked": k,
+    }
+    after_repair = dict(expected, paid_not_booked=0, withdrawal_no_transfer=0, transfer_not_booked=0)
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+
+    for name, repair, want in (("repair", True, expected), ("recheck", False, after_repair)):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        report = await reconcile.run(since, grace_s=0, repair=repair)
+        took = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        ok = report.found == want
+        print(f"{name:<8} {took:6.1f}s  peak {peak / 2 ** 20:6.1f} MiB  "
+              f"{'OK' if ok else 'MISMATCH'}  {report.found}")
+        if report.repaired:
+            print(f"         repaired {report.repaired}")
+
+    deals = await db.fetchval(
+        "SELECT count(*) FROM deal WHERE invoice1_id = ANY($1::bigint[]) OR invoice2_id = ANY($1::bigint[])", unbooked)
+    print(f"deals for unbooked invoices after repair: {deals} of {len(unbooked)}")
+
+    await cryptopay.close()
+    await db.close_pool()
+    await cp.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
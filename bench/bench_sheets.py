@@ -0,0 +1,145 @@
+# bench/bench_sheets.py
+"""
+Разбор листа боёв: legacy (dict на строку, strptime в цикле с исключениями)
+против google_sheets.parse_sheet (по колонкам, кеш форматов дат).
+
+    python -m bench.bench_sheets --rows 50000
+    PGDATABASE=fightbot_bench python -m bench.bench_sheets --rows 50000 --db   # + upsert: по строке vs COPY
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from .fakes import FakeWorksheet, fight_rows
+
+
+# ===== legacy: как было в google_sheets / sync_fights =====
+
+def legacy_parse_dt(s: str) -> Optional[datetime]:
+    s = (s or "").strip()
+    if not s:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(s, fmt)
+        except Exception:
+            pass
+    return None
+
+
+def legacy_parse(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    items: List[Dict[str, Any]] = []
+    for r in records:
+        items.append({
+            "external_id": str(r.get("external_id") or "").strip() or None,
+            "title": (r.get("title") or "").strip(),
+            "p1": (r.get("p1") or "").strip(),
+            "p2": (r.get("p2") or "").strip(),
+            "photo_url": (r.get("photo_url") or "").strip() or None,
+            "starts_at": legacy_parse_dt(r.get("starts_at") or ""),
+            "status": (r.get("status") or "upcoming").strip().lower(),
+            "description": (r.get("description") or "").strip() or None,
+            "winner": int(r.get("winner") or 0) if str(r.get("winner") or "").strip().isdigit() else None,
+        })
+    return items
+
+
+LEGACY_UPSERT = """
+INSERT INTO fight(external_id, title, participant1_name, participant2_name, photo_url, description, starts_at, status, winner_participant)
+VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9)
+ON CONFLICT (external_id) DO UPDATE
+   SET title=EXCLUDED.title, participant1_name=EXCLUDED.participant1_name,
+       participant2_name=EXCLUDED.participant2_name, photo_url=EXCLUDED.photo_url,
+       description=EXCLUDED.description, starts_at=EXCLUDED.starts_at,
+       status=EXCLUDED.status, winner_participant=EXCLUDED.winner_participant
+"""
+
+
+def make_rows(n: int, bad_pct: float) -> List[Dict[str, Any]]:
+    """Реалистичный лист: карды по вечерам (даты повторяются), немного мусора."""
+    rnd = random.Random(42)
+    rows = fight_rows(n, done=n // 3)
+    for i, r in enumerate(rows):
+        day = 1 + (i // 12) % 28
+        r["starts_at"] = f"2030-03-{day:02d} {18 + i % 5}:00" if i % 4 else f"{day:02d}.03.2030 20:00"
+        if rnd.random() < bad_pct:
+            r[rnd.choice(["starts_at", "winner", "status"])] = "??"
+    return rows
+
+
+async def bench_db(rows: List[Any], legacy_items: List[Dict[str, Any]]) -> None:
+    from app import db, sync_fights
+    from . import seed
+
+    seed.check_target(False)
+    await db.init_db()
+
+    async def wipe() -> None:
+        await db.execute("DELETE FROM fight WHERE external_id LIKE 'bench-%'")
+
+    await wipe()
+    t0 = time.perf_counter()
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            for it in legacy_items:
+                if it["external_id"] and it["status"] in ("upcoming", "today", "live", "done"):
+                    await conn.execute(LEGACY_UPSERT, it["external_id"], it["title"], it["p1"], it["p2"],
+                                       it["photo_url"], it["description"], it["starts_at"], it["status"],
+                                       it["winner"] if it["winner"] in (1, 2) else None)
+    legacy = time.perf_counter() - t0
+
+    await wipe()
+    t0 = time.perf_counter()
+    await sync_fights.upsert_rows(rows)
+    copy_first = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    await sync_fights.upsert_rows(rows)   # повторный опрос: ничего не изменилось
+    copy_again = time.perf_counter() - t0
+    await wipe()
+    await db.close_pool()
+    print(f"upsert per row {legacy * 1000:>10.0f} ms")
+    print(f"upsert COPY    {copy_first * 1000:>10.0f} ms   (unchanged re-sync {copy_again * 1000:.0f} ms)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--bad-pct", type=float, default=0.01)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--db", action="store_true", help="also time the DB upsert (bench database)")
+    args = parser.parse_args()
+
+    from app import google_sheets
+
+    ws = FakeWorksheet(make_rows(args.rows, args.bad_pct))
+    records = ws.get_all_records()
+    values = ws.get_all_values()
+
+    def best(fn) -> float:
+        out = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            fn()
+            out.append(time.perf_counter() - t0)
+        return min(out)
+
+    legacy = best(lambda: legacy_parse(records))
+    new = best(lambda: google_sheets.parse_sheet(values, timezone.utc))
+    rows, errors = google_sheets.parse_sheet(values, timezone.utc)
+    legacy_items = legacy_parse(records)
+    lost = sum(1 for it in legacy_items if it["starts_at"] is None)
+
+    print(f"rows={args.rows}")
+    print(f"parse legacy   {legacy * 1000:>10.0f} ms   ({args.rows / legacy:,.0f} rows/s, {lost} dates silently dropped)")
+    print(f"parse columnar {new * 1000:>10.0f} ms   ({args.rows / new:,.0f} rows/s, {len(errors)} row errors reported)")
+    print(f"speedup        {legacy / new:>10.1f}x")
+
+    if args.db:
+        asyncio.run(bench_db(rows, legacy_items))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# bench/bench_startup.py
+"""
+Холодный старт точек входа: `python -X importtime -c "import <module>"` в
+отдельном процессе (без запуска main), сумма по самому модулю + самые
+тяжёлые зависимости. БД, сеть и .env не нужны — импорт не должен их трогать.
+
+    python -m bench.bench_startup --save startup.json
+    python -m bench.bench_startup --baseline startup.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+MODULES = [
+    "app.db",
+    "app.sync_fights",
+    "app.reminder_worker",
+    "app.settlement_worker",
+    "app.bot",
+]
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def _run(module: str) -> Tuple[float, Dict[str, int], float]:
+    """(суммарный импорт модуля, мкс), {пакет: собственное время, мкс}, wall процесса (мс)."""
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=os.environ.copy(),
+    )
+    wall = (time.perf_counter() - t0) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+
+    total = 0.0
+    top: Dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if not m:
+            continue
+        self_us, cum_us, name = int(m[1]), int(m[2]), m[4]
+        if name == module:
+            total = cum_us
+        # собственное время модулей, сгруппированное по пакету верхнего уровня
+        root = name.split(".")[0]
+        top[root] = top.get(root, 0) + self_us
+    return total, top, wall
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--modules", default=",".join(MODULES))
+    parser.add_argument("--baseline", help="JSON from a previous --save to compare against")
+    parser.add_argument("--save", help="write results as JSON")
+    args = parser.parse_args()
+
+    baseline: Optional[Dict[str, Dict[str, float]]] = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+
+    result: Dict[str, Dict[str, float]] = {}
+    print(f"{'module':<24}{'import ms':>11}{'wall ms':>10}{'Δ import':>10}   heaviest deps")
+    for module in args.modules.split(","):
+        runs = [_run(module) for _ in range(args.repeat)]
+        imp = statistics.median(r[0] for r in runs) / 1000
+        wall = statistics.median(r[2] for r in runs)
+        deps: List[Tuple[str, int]] = sorted(runs[-1][1].items(), key=lambda kv: -kv[1])
+        heavy = ", ".join(f"{n} {us / 1000:.0f}" for n, us in deps[:args.top])
+
+        delta = ""
+        b = (baseline or {}).get(module)
+        if b and b.get("import_ms"):
+            delta = f"{(imp / b['import_ms'] - 1) * 100:+.0f}%"
+        print(f"{module:<24}{imp:>11.1f}{wall:>10.1f}{delta:>10}   {heavy}")
+        result[module] = {"import_ms": imp, "wall_ms": wall}
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
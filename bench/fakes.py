@@ -0,0 +1,257 @@
+# bench/fakes.py
+"""
+Локальные заглушки внешних сервисов для бенчмарков:
+  FakeTelegram  — Bot API (любой метод, ответы в формате Telegram);
+  FakeCryptoPay — Crypto Pay API (createInvoice / getInvoices / transfer / getExchangeRates);
+  FakeWorksheet — вместо gspread-листа для sync_fights.
+У серверов есть искусственная задержка (latency_ms), чтобы имитировать сеть.
+"""
+import asyncio
+import itertools
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+
+class _FakeServer:
+    def __init__(self, port: int, latency_ms: float = 0.0):
+        self.port = port
+        self.latency_ms = latency_ms
+        self.calls: Dict[str, int] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _app(self) -> web.Application:
+        raise NotImplementedError
+
+    async def _delay(self, method: str) -> None:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+
+    async def start(self) -> "_FakeServer":
+        self._runner = web.AppRunner(self._app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+        return self
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeTelegram(_FakeServer):
+    """POST /bot<token>/<method> -> {"ok": true, "result": ...}"""
+
+    BOT_USER = {"id": 100500, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    def __init__(self, port: int, latency_ms: float = 0.0):
+        super().__init__(port, latency_ms)
+        self._msg_ids = itertools.count(1000)
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        return app
+
+    async def _form(self, request: web.Request) -> Dict[str, Any]:
+        if request.content_type.startswith("multipart/"):
+            out: Dict[str, Any] = {}
+            reader = await request.multipart()
+            async for part in reader:
+                out[part.name] = await part.text()
+            return out
+        return dict(await request.post())
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        await self._delay(method)
+        data = await self._form(request)
+        m = method.lower()
+        if m == "getme":
+            result: Any = self.BOT_USER
+        elif m.startswith("send") or m.startswith("edit"):
+            result = self._message(data)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        raw_chat = str(data.get("chat_id") or "1")
+        chat_id = int(raw_chat) if raw_chat.lstrip("-").isdigit() else 1
+        msg: Dict[str, Any] = {
+            "message_id": next(self._msg_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.BOT_USER,
+        }
+        if "photo" in data or "media" in data:
+            fid = f"bench-file-{msg['message_id']}"
+            msg["photo"] = [{"file_id": fid, "file_unique_id": fid, "width": 800, "height": 500}]
+            msg["caption"] = data.get("caption") or ""
+        else:
+            msg["text"] = data.get("text") or ""
+        return msg
+
+
+class FakeApiError(Exception):
+    def __init__(self, code: int, name: str):
+        super().__init__(name)
+        self.code, self.name = code, name
+
+
+class FakeCryptoPay(_FakeServer):
+    """
+    Счета живут в памяти; mark_all_paid() — «волна оплат».
+    Инъекция сбоев (меняются на лету): down — все запросы 503; error_rate — доля
+    503; slow_rate/slow_ms — доля медленных ответов (хвост латентности);
+    reject_transfers — transfer окончательно отклоняется (400).
+    """
+
+    RATES = {"USDT": "1", "TON": "5.2", "BTC": "62000", "ETH": "3100", "USDC": "1"}
+
+    def __init__(self, port: int, latency_ms: float = 0.0, seed: int = 1):
+        super().__init__(port, latency_ms)
+        self._ids = itertools.count(1)
+        self.invoices: Dict[int, Dict[str, Any]] = {}
+        self.transfers: List[Dict[str, Any]] = []
+        self.down = False
+        self.error_rate = 0.0
+        self.slow_rate = 0.0
+        self.slow_ms = 0.0
+        self.reject_transfers = False
+        self._rnd = random.Random(seed)
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/{method}", self._handle)
+        return app
+
+    def mark_all_paid(self) -> int:
+        n = 0
+        for inv in self.invoices.values():
+            if inv["status"] == "active":
+                inv["status"] = "paid"
+                inv["paid_at"] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+                n += 1
+        return n
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        body = await request.json() if request.can_read_body else {}
+        await self._delay(method)
+        if self.slow_rate and self._rnd.random() < self.slow_rate:
+            await asyncio.sleep(self.slow_ms / 1000)
+        if self.down or (self.error_rate and self._rnd.random() < self.error_rate):
+            return web.Response(status=503, text="Service Unavailable")
+        handler = getattr(self, "_m_" + method, None)
+        if handler is None:
+            return web.json_response({"ok": False, "error": {"code": 405, "name": "METHOD_NOT_FOUND"}})
+        try:
+            return web.json_response({"ok": True, "result": handler(body)})
+        except FakeApiError as e:
+            return web.json_response({"ok": False, "error": {"code": e.code, "name": e.name}})
+
+    def _m_createInvoice(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        inv_id = next(self._ids)
+        inv = {
+            "invoice_id": inv_id,
+            "status": "active",
+            "asset": body.get("asset", "USDT"),
+            "amount": str(body.get("amount")),
+            "payload": body.get("payload"),
+            "bot_invoice_url": f"https://t.me/CryptoBot?start=bench{inv_id}",
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        }
+        self.invoices[inv_id] = inv
+        return inv
+
+    def _m_getInvoices(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        ids = [int(x) for x in str(body.get("invoice_ids") or "").split(",") if x.strip()]
+        if ids:
+            items = [self.invoices[i] for i in ids if i in self.invoices]
+        else:
+            # как в Crypto Pay: новые первыми
+            status = body.get("status")
+            offset = int(body.get("offset") or 0)
+            items = list(itertools.islice(
+                (i for i in reversed(self.invoices.values()) if not status or i["status"] == status),
+                offset, offset + int(body.get("count") or 100),
+            ))
+        return {"items": items}
+
+    def _m_transfer(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        if self.reject_transfers:
+            raise FakeApiError(400, "INSUFFICIENT_FUNDS")
+        # как в Crypto Pay: один перевод на spend_id, повтор отклоняется
+        for tr in self.transfers:
+            if body.get("spend_id") and tr["spend_id"] == body.get("spend_id"):
+                raise FakeApiError(400, "SPEND_ID_ALREADY_USED")
+        tr = {
+            "transfer_id": len(self.transfers) + 1,
+            "spend_id": body.get("spend_id"),
+            "user_id": int(body.get("user_id") or 0),
+            "asset": body.get("asset"),
+            "amount": str(body.get("amount")),
+            "status": "completed",
+            "completed_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        }
+        self.transfers.append(tr)
+        return tr
+
+    def _m_getTransfers(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        if body.get("spend_id"):
+            return {"items": [tr for tr in self.transfers if tr["spend_id"] == body["spend_id"]]}
+        offset = int(body.get("offset") or 0)
+        end = max(0, len(self.transfers) - offset)
+        start = max(0, end - int(body.get("count") or 100))
+        return {"items": self.transfers[start:end][::-1]}   # новые первыми
+
+    def _m_getExchangeRates(self, body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [
+            {"is_valid": True, "is_crypto": True, "is_fiat": False, "source": a, "target": "USD", "rate": r}
+            for a, r in self.RATES.items()
+        ]
+
+
+class FakeWorksheet:
+    """Достаточно для google_sheets.fetch_fights_from_sheet: get_all_records / get_all_values."""
+
+    HEADERS = ["external_id", "title", "p1", "p2", "photo_url", "starts_at", "status", "description", "winner"]
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.rows = rows
+
+    def get_all_records(self, expected_headers: Optional[List[str]] = None, **_: Any) -> List[Dict[str, Any]]:
+        return [dict(r) for r in self.rows]
+
+    def get_all_values(self, *_: Any, **__: Any) -> List[List[str]]:
+        return [self.HEADERS] + [[str(r.get(h, "") if r.get(h) is not None else "") for h in self.HEADERS] for r in self.rows]
+
+
+def fight_rows(n: int, done: int = 0) -> List[Dict[str, Any]]:
+    """n боёв для листа; первые `done` — завершены с победителем 1."""
+    rows = []
+    for i in range(1, n + 1):
+        rows.append({
+            "external_id": f"bench-{i}",
+            "title": f"Bench Fight {i}",
+            "p1": f"Alpha{i}",
+            "p2": f"Bravo{i}",
+            "photo_url": f"https://picsum.photos/seed/bench{i}/800/500",
+            "starts_at": "2030-01-01 20:00",
+            "status": "done" if i <= done else "upcoming",
+            "description": "bench",
+            "winner": 1 if i <= done else "",
+        })
+    return rows
+
+
+def install_fake_sheet(ws: FakeWorksheet) -> None:
+    from app import google_sheets
+    google_sheets._ws = lambda: ws  # type: ignore[assignment]
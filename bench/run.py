@@ -0,0 +1,224 @@
+# bench/run.py
+"""
+Сквозной бенчмарк «вечер боёв» против локальных заглушек Telegram / Crypto Pay /
+Google Sheets и сидированной Postgres (PGDATABASE должна содержать «bench»).
+
+    PGDATABASE=fightbot_bench python -m bench.run --save baseline.json
+    PGDATABASE=fightbot_bench python -m bench.run --baseline baseline.json
+    PGDATABASE=fightbot_bench python -m bench.run --only settle --settle-mode batched
+
+Стадии:
+  browse    — шторм навигации по каталогу (events / fight / open / back_main);
+  checkout  — всплеск выбора суммы (bet_amt -> createInvoice -> invoice_wait);
+  payments  — волна подтверждений оплат (все счета paid -> финализация);
+  settle    — расчёт N сматченных сделок завершённого боя.
+По каждой стадии: throughput (ops/s) и p50/p99 латентности одной операции.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.wall = 0.0
+
+    def pct(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        xs = sorted(self.latencies)
+        return xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+
+    def as_dict(self) -> Dict[str, float]:
+        n = len(self.latencies)
+        return {
+            "ops": n,
+            "errors": self.errors,
+            "ops_per_s": n / self.wall if self.wall else 0.0,
+            "p50_ms": self.pct(0.50),
+            "p99_ms": self.pct(0.99),
+        }
+
+
+async def _drive(stage: Stage, jobs: List[Callable[[], Awaitable[Any]]], concurrency: int) -> Stage:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(job: Callable[[], Awaitable[Any]]) -> None:
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                await job()
+            except Exception as e:
+                stage.errors += 1
+                if stage.errors <= 3:
+                    print(f"[BENCH] {stage.name} error: {e!r}")
+            stage.latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(j) for j in jobs))
+    stage.wall = time.perf_counter() - t0
+    return stage
+
+
+def _report(stages: List[Stage], baseline: Optional[Dict[str, Dict[str, float]]]) -> Dict[str, Dict[str, float]]:
+    out = {s.name: s.as_dict() for s in stages}
+    print(f"\n{'stage':<10}{'ops':>8}{'err':>6}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'Δ ops/s':>10}{'Δ p99':>9}")
+    for name, r in out.items():
+        d_ops = d_p99 = ""
+        b = (baseline or {}).get(name)
+        if b and b.get("ops_per_s"):
+            d_ops = f"{(r['ops_per_s'] / b['ops_per_s'] - 1) * 100:+.0f}%"
+        if b and b.get("p99_ms"):
+            d_p99 = f"{(r['p99_ms'] / b['p99_ms'] - 1) * 100:+.0f}%"
+        print(f"{name:<10}{r['ops']:>8}{r['errors']:>6}{r['ops_per_s']:>12.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{d_ops:>10}{d_p99:>9}")
+    return out
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--fights", type=int, default=30)
+    parser.add_argument("--browse", type=int, default=5000, help="callback updates in the browse storm")
+    parser.add_argument("--checkouts", type=int, default=1000)
+    parser.add_argument("--settle-deals", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--tg-latency-ms", type=float, default=30.0)
+    parser.add_argument("--cp-latency-ms", type=float, default=80.0)
+    parser.add_argument("--tg-port", type=int, default=18081)
+    parser.add_argument("--cp-port", type=int, default=18082)
+    parser.add_argument("--only", default="browse,checkout,payments,settle")
+    parser.add_argument("--settle-mode", choices=["per_deal", "batched"], default="per_deal")
+    parser.add_argument("--baseline", help="JSON from a previous --save to compare against")
+    parser.add_argument("--save", help="write results as JSON")
+    parser.add_argument("--force", action="store_true", help="allow a PGDATABASE without 'bench' in its name")
+    args = parser.parse_args()
+
+    # до импорта app: бот и Crypto Pay смотрят только в локальные заглушки
+    os.environ["BOT_TOKEN"] = "123456:BENCH-TOKEN"
+    os.environ["CRYPTO_PAY_TOKEN"] = "bench"
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.tg_port}"
+    os.environ["CRYPTO_PAY_API_URL"] = f"http://127.0.0.1:{args.cp_port}/api"
+    os.environ["SETTLE_MODE"] = args.settle_mode
+
+    from aiogram.types import Update
+    from app import bot as app_bot, db, keyboards, settlement_worker
+    from app.payments import cryptopay
+    from . import seed
+    from .fakes import FakeCryptoPay, FakeTelegram
+
+    seed.check_target(args.force)
+    tg = await FakeTelegram(args.tg_port, args.tg_latency_ms).start()
+    cp = await FakeCryptoPay(args.cp_port, args.cp_latency_ms).start()
+    bot = app_bot.bot
+    only = set(args.only.split(","))
+
+    await seed.reset()
+    await seed.seed_users(args.users)
+    fight_ids = await seed.seed_fights(args.fights)
+    print(f"[BENCH] seeded users={args.users} fights={len(fight_ids)}")
+
+    update_ids = iter(range(1, 10**9))
+
+    def cb(tg_id: int, data: str) -> Update:
+        uid = next(update_ids)
+        return Update.model_validate({
+            "update_id": uid,
+            "callback_query": {
+                "id": str(uid),
+                "chat_instance": "bench",
+                "from": {"id": tg_id, "is_bot": False, "first_name": "Bench"},
+                "data": data,
+                "message": {
+                    "message_id": uid,
+                    "date": int(time.time()),
+                    "chat": {"id": tg_id, "type": "private"},
+                    "text": "menu",
+                },
+            },
+        }, context={"bot": bot})
+
+    def feed(update: Update) -> Callable[[], Awaitable[Any]]:
+        return lambda: app_bot.dp.feed_update(bot, update)
+
+    def user_tg(i: int) -> int:
+        return seed.TG_BASE + i % args.users
+
+    stages: List[Stage] = []
+
+    if "browse" in only:
+        pattern = ["events", "fight:{f}", "open:{f}", "bet_side:{f}:1", "back_main"]
+        jobs = [
+            feed(cb(user_tg(i), pattern[i % len(pattern)].format(f=fight_ids[i % len(fight_ids)])))
+            for i in range(args.browse)
+        ]
+        stages.append(await _drive(Stage("browse"), jobs, args.concurrency))
+
+    if "checkout" in only or "payments" in only:
+        amounts = keyboards.stake_amounts()
+        jobs = [
+            feed(cb(user_tg(i), f"bet_amt:{fight_ids[i % len(fight_ids)]}:{1 + i % 2}:{amounts[i % 4]}"))
+            for i in range(args.checkouts)
+        ]
+        stages.append(await _drive(Stage("checkout"), jobs, args.concurrency))
+        # авто-проверки из cb_amount опрашивают оплату 30 с — в стадии payments работает только поллер
+        for t in asyncio.all_tasks():
+            if "auto_check_and_finalize" in repr(t.get_coro()):
+                t.cancel()
+
+    if "payments" in only:
+        cp.mark_all_paid()
+        pending = await db.pending_invoice_ids()
+        stage = Stage("payments")
+        finalize = app_bot.finalize_paid_invoice
+        jobs = [lambda inv_id=inv_id: finalize(inv_id, "bench") for inv_id in pending]
+        stages.append(await _drive(stage, jobs, args.concurrency))
+
+    if "settle" in only:
+        done_fight = fight_ids[0]
+        await db.execute("UPDATE fight SET status='done', winner_participant=1 WHERE id=$1", done_fight)
+        await seed.seed_matched_deals(args.settle_deals, done_fight, args.users)
+
+        stage = Stage("settle")
+        # латентность = один тик воркера (расчёт боя одним запросом + отправка пачек)
+        remaining_sql = "SELECT count(*) FROM deal WHERE fight_id=$1 AND status='matched'"
+        unsent_sql = "SELECT count(*) FROM payout WHERE status <> 'sent'"
+        t0 = time.perf_counter()
+        left = await db.fetchval(unsent_sql) + await db.fetchval(remaining_sql, done_fight)
+        while left:
+            t1 = time.perf_counter()
+            await settlement_worker.tick(bot, batch=500)
+            stage.latencies.append(time.perf_counter() - t1)
+            now_left = await db.fetchval(unsent_sql) + await db.fetchval(remaining_sql, done_fight)
+            if now_left >= left:   # не продвинулись — дальше будет то же самое
+                print(f"[BENCH] settle stalled with {now_left} deal(s)/payout row(s) left")
+                break
+            left = now_left
+        stage.wall = time.perf_counter() - t0
+        stages.append(stage)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    result = _report(stages, baseline)
+    print(f"\nTelegram calls: {sum(tg.calls.values())} {tg.calls}")
+    print(f"Crypto Pay calls: {sum(cp.calls.values())} {cp.calls}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+
+    await bot.session.close()
+    await cryptopay.close()
+    await db.close_pool()
+    await tg.stop()
+    await cp.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+# bench/seed.py
+"""
+Сидирование бенч-базы. Работает только с БД, в имени которой есть «bench»
+(или с --force): все таблицы public-схемы очищаются.
+
+    PGDATABASE=fightbot_bench python -m bench.seed --users 5000 --fights 50
+"""
+import argparse
+import asyncio
+from typing import List
+
+from app import db, sync_fights
+from app.config import settings
+
+from .fakes import FakeWorksheet, fight_rows, install_fake_sheet
+
+TG_BASE = 10_000_000
+
+
+def check_target(force: bool) -> None:
+    if "bench" not in settings.PGDATABASE and not force:
+        raise SystemExit(f"refusing to wipe PGDATABASE={settings.PGDATABASE!r}: name must contain 'bench' (or use --force)")
+
+
+async def reset() -> None:
+    await db.init_db()
+    async with db.acquire() as conn:
+        tables = [r["tablename"] for r in await conn.fetch(
+            "SELECT tablename FROM pg_tables WHERE schemaname='public'"
+        )]
+        if tables:
+            await conn.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+
+
+async def seed_users(n: int) -> None:
+    async with db.acquire() as conn:
+        await conn.copy_records_to_table(
+            "app_user",
+            records=[(TG_BASE + i, f"bench{i}") for i in range(n)],
+            columns=["tg_user_id", "username"],
+        )
+
+
+async def seed_fights(n: int, done: int = 0) -> List[int]:
+    """Бои заводятся через настоящий sync_fights поверх фейкового листа."""
+    install_fake_sheet(FakeWorksheet(fight_rows(n, done)))
+    await sync_fights.sync_once()
+    rows = await db.fetch("SELECT id FROM fight ORDER BY id")
+    return [int(r["id"]) for r in rows]
+
+
+async def seed_matched_deals(n: int, fight_id: int, users: int, amount_cents: int = 800) -> None:
+    """n сматченных сделок по одному бою: user1 на P1, user2 на P2."""
+    async with db.acquire() as conn:
+        uids = [int(r["id"]) for r in await conn.fetch("SELECT id FROM app_user ORDER BY id LIMIT $1", users)]
+        recs = []
+        for i in range(n):
+            u1 = uids[i % len(uids)]
+            u2 = uids[(i + 1) % len(uids)]
+            recs.append((fight_id, u1, 1, amount_cents, True, 1_000_000 + 2 * i,
+                         u2, 2, amount_cents, True, 1_000_001 + 2 * i, "matched"))
+        await conn.copy_records_to_table(
+            "deal",
+            records=recs,
+            columns=["fight_id", "user1_id", "participant1", "amount1_cents", "paid1", "invoice1_id",
+                     "user2_id", "participant2", "amount2_cents", "paid2", "invoice2_id", "status"],
+        )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--fights", type=int, default=50)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    check_target(args.force)
+    await reset()
+    await seed_users(args.users)
+    ids = await seed_fights(args.fights)
+    print(f"[SEED] users={args.users} fights={len(ids)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())